@@ -2,12 +2,13 @@
 import requests
 import os
 from django.conf import settings
-import subprocess
 import dj_database_url
 import zipfile
 import shutil
 import logging
 
+from ..utils.land_polygons import load_land_polygons
+
 logger = logging.getLogger(__name__)
 
 
@@ -73,19 +74,12 @@ def load_land_vectors(db_conn=None, url=None):
     else:
         file_name = download_filename
 
-    cmd = 'ogr2ogr -s_srs EPSG:3857 -t_srs EPSG:4326 -f "PostgreSQL" ' \
-          'PG:"host={host} user={user} password={password} dbname={name} port={port}" ' \
-          '{file} land_polygons'.format(host=database['HOST'],
-                                        user=database['USER'],
-                                        password=database['PASSWORD'].replace('$', '\$'),
-                                        name=database['NAME'],
-                                        port=database['PORT'],
-                                        file=file_name)
     logger.info("Loading land data...")
-    exit_code = subprocess.call(cmd, shell=True)
-
-    if exit_code:
-        logger.error("There was an error importing the land data.")
+    try:
+        stats = load_land_polygons(file_name, database=database, srid=3857)
+    except Exception as e:
+        logger.error("There was an error importing the land data: {0}".format(e))
+        stats = None
 
     if file_dir:
         shutil.rmtree(file_dir)
@@ -96,6 +90,7 @@ def load_land_vectors(db_conn=None, url=None):
         pass
     finally:
         logger.info("Finished loading land data.")
+    return stats
 
 
 
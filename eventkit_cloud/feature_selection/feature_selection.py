@@ -5,7 +5,7 @@ import unicodedata
 from yaml.constructor import ConstructorError
 from yaml.scanner import ScannerError
 from yaml.parser import ParserError
-from sql import SQLValidator
+from sql import SQLValidator, OverpassFilter, overpass_string
 
 CREATE_TEMPLATE = """CREATE TABLE {0}(
 fid INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -22,6 +22,27 @@ SELECT gpkgAddSpatialIndex('{0}', 'geom');
 UPDATE '{0}' SET geom=AsGPB(geom);
 """
 
+# Routes each row of a source table to the themes it belongs to, with one scan of the table.
+# Each themes<n> column is a bitmask of the themes the row matches.
+ROUTE_TEMPLATE = """CREATE TEMP TABLE {0}_themes AS SELECT fid, {1} FROM {0};
+"""
+EXTRACT_TEMPLATE = """CREATE TABLE {0}(
+fid INTEGER PRIMARY KEY AUTOINCREMENT,
+geom {1},
+{2}
+);
+INSERT INTO {0}(geom, {3}) select geom, {3} from {4} WHERE fid IN (SELECT fid FROM {4}_themes WHERE {5} & {6});
+"""
+# For theme tables extracted from spatialite geometries, which only need converting to GPB once.
+EXTRACT_INDEX_TEMPLATE = """
+INSERT INTO gpkg_contents (table_name, data_type,identifier,srs_id) VALUES ('{0}','features','{0}','4326');
+INSERT INTO gpkg_geometry_columns VALUES ('{0}', 'geom', '{1}', '4326', '0', '0');
+SELECT gpkgAddSpatialIndex('{0}', 'geom');
+UPDATE '{0}' SET geom=AsGPB(geom);
+"""
+# Bits used in each themes<n> bitmask, SQLite integers are signed 64 bit.
+THEME_MASK_BITS = 62
+
 WKT_TYPE_MAP = {
     'points':'POINT',
     'lines':'MULTILINESTRING',
@@ -40,6 +61,13 @@ OGR2OGR_TABLENAMES = {
     'polygons':'multipolygons'
 }
 
+# OSM element types which can produce features of each geometry type.
+OVERPASS_ELEMENT_TYPES = {
+    'points':['node'],
+    'lines':['way'],
+    'polygons':['way','relation']
+}
+
 ZIP_README = """
 This thematic file was generated by the HOT Exports Tool.
 For more information, visit http://export.hotosm.org . 
@@ -190,6 +218,27 @@ class FeatureSelection(object):
             return theme['where']
         return ' OR '.join(map(lambda x:'"' + x + '" IS NOT NULL',theme['select']))
 
+    def overpass_filters(self):
+        """
+        Overpass QL tag filters selecting the elements needed by the themes, by OSM element type.
+        Each filter is a chain of tag conditions and an element is needed if it matches any filter.
+        """
+        filters = {}
+        for theme in self.themes:
+            theme_filters = []
+            if 'where' in self.doc[theme]:
+                clauses = self.doc[theme]['where']
+                if not isinstance(clauses,list):
+                    clauses = [clauses]
+                for clause in clauses:
+                    theme_filters += OverpassFilter(clause).filters()
+            else:
+                theme_filters = ['[{0}]'.format(overpass_string(key)) for key in self.key_selections(theme)]
+            for geom_type in self.geom_types(theme):
+                for element_type in OVERPASS_ELEMENT_TYPES[geom_type]:
+                    filters.setdefault(element_type,set()).update(theme_filters)
+        return dict((element_type,sorted(f)) for element_type,f in filters.iteritems())
+
     def zip_readme(self,theme):
         columns = []
         for key in self.key_selections(theme):
@@ -247,12 +296,7 @@ class FeatureSelection(object):
         create_sqls = []
         index_sqls = []
         for theme in self.themes:
-            key_selections = ['"{0}"'.format(key) for key in self.key_selections(theme)]
-
-            # if any of these 5 keys in selection, add z_index
-            if any([x in self.key_selections(theme) for x in ['highway','railway','bridge','tunnel','layer']]):
-                    key_selections.append('"z_index"')
-
+            key_selections = self.theme_columns(theme)
             filter_clause = self.filter_clause(theme)
             for geom_type in self.geom_types(theme):
                 dst_tablename = slugify(theme) + '_' + geom_type
@@ -271,3 +315,61 @@ class FeatureSelection(object):
                     WKT_TYPE_MAP[geom_type]
                 ))
         return create_sqls, index_sqls
+
+    def theme_columns(self,theme):
+        key_selections = ['"{0}"'.format(key) for key in self.key_selections(theme)]
+        # if any of these 5 keys in selection, add z_index
+        if any([x in self.key_selections(theme) for x in ['highway','railway','bridge','tunnel','layer']]):
+            key_selections.append('"z_index"')
+        return key_selections
+
+    @property
+    def extraction_sqls(self):
+        """
+        Like sqls, but each source table is scanned once for all of the themes instead of once per theme,
+        the theme tables are created in the same order and with the same rows.
+        The source tables must hold spatialite geometries, the index sqls convert each theme table to GPB once.
+        """
+        route_sqls = []
+        create_sqls = []
+        drop_sqls = []
+        index_sqls = []
+        routes = {}
+        for geom_type in ['points','lines','polygons']:
+            themes = [theme for theme in self.themes if geom_type in self.geom_types(theme)]
+            if not themes:
+                continue
+            src_tablename = OGR2OGR_TABLENAMES[geom_type]
+            masks = []
+            for start in range(0, len(themes), THEME_MASK_BITS):
+                masks.append(' | '.join(['(CASE WHEN ({0}) THEN {1} ELSE 0 END)'.format(
+                    self.filter_clause(theme), 1 << bit) for bit, theme in enumerate(themes[start:start + THEME_MASK_BITS])]))
+                routes.update(dict(((theme, geom_type), ('themes{0}'.format(len(masks) - 1), 1 << bit))
+                                   for bit, theme in enumerate(themes[start:start + THEME_MASK_BITS])))
+            route_sqls.append(ROUTE_TEMPLATE.format(
+                src_tablename,
+                ','.join(['{0} AS themes{1}'.format(mask, index) for index, mask in enumerate(masks)])
+            ))
+            drop_sqls.append('DROP TABLE {0}_themes;\n'.format(src_tablename))
+
+        for theme in self.themes:
+            key_selections = self.theme_columns(theme)
+            for geom_type in self.geom_types(theme):
+                dst_tablename = slugify(theme) + '_' + geom_type
+                src_tablename = OGR2OGR_TABLENAMES[geom_type]
+                cols = OSM_ID_TAGS[geom_type] + key_selections
+                mask_column, bit = routes[(theme, geom_type)]
+                create_sqls.append(EXTRACT_TEMPLATE.format(
+                    dst_tablename,
+                    WKT_TYPE_MAP[geom_type],
+                    ','.join([col + self.col_type(col) for col in cols]),
+                    ','.join(cols),
+                    src_tablename,
+                    mask_column,
+                    bit
+                ))
+                index_sqls.append(EXTRACT_INDEX_TEMPLATE.format(
+                    dst_tablename,
+                    WKT_TYPE_MAP[geom_type]
+                ))
+        return route_sqls + create_sqls + drop_sqls, index_sqls
@@ -107,3 +107,56 @@ class OsmfilterRule(object):
 
     def rule(self):
         return self._rule(self._parse_result.asDict())
+
+
+def overpass_string(token):
+    token = token.strip()
+    if len(token) > 1 and token[0] == token[-1] and token[0] in '"\'':
+        token = token[1:-1]
+    return '"' + token.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def overpass_regex_string(token):
+    token = overpass_string(token)[1:-1]
+    return ''.join(['\\\\' + c if c in '.^$*+?()[]{}|' else c for c in token])
+
+
+class OverpassFilter(object):
+    """
+    Converts a WHERE clause to Overpass QL tag filters.
+
+    Overpass can't express OR inside a filter chain, so the clause is expanded into a list of alternatives (one
+    filter chain each) which are unioned in the query.  Conditions Overpass can't evaluate (numeric comparisons) are
+    relaxed to a check that the key exists, so the filters select a superset of the clause; the clause itself is still
+    applied to the downloaded data.
+    """
+    def __init__(self, s):
+        self._parse_result = whereExpression.parseString(s, parseAll=True)
+
+    def _condition(self, t):
+        if 'expression' in t:
+            return self._expression(t['expression'])
+        key = overpass_string(t['columnName'])
+        if 'notnull' in t:
+            return ['[{0}]'.format(key)]
+        if 'in' in t:
+            values = '|'.join([overpass_regex_string(r) for r in t['rval']])
+            return ['[{0}~"^({1})$"]'.format(key, values)]
+        if t['binop'] in ('=', '!='):
+            return ['[{0}{1}{2}]'.format(key, t['binop'], overpass_string(t['rval'][0]))]
+        return ['[{0}]'.format(key)]
+
+    def _expression(self, t):
+        # The grammar chains conditions to the right, apply SQL precedence (AND before OR) to the flattened chain.
+        alternatives = []
+        conjunction = ['']
+        while t:
+            conjunction = [left + right for left in conjunction for right in self._condition(t['condition'])]
+            if 'or' in t:
+                alternatives += conjunction
+                conjunction = ['']
+            t = t.get('expression')
+        return alternatives + conjunction
+
+    def filters(self):
+        return self._expression(self._parse_result.asDict()['expression'])
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import sqlite3
 import unittest
-from ..feature_selection import FeatureSelection
+from ..feature_selection import FeatureSelection, OGR2OGR_TABLENAMES, slugify
 
 ZIP_README = """
 This thematic file was generated by the HOT Exports Tool.
@@ -99,6 +100,35 @@ class TestFeatureSelection(unittest.TestCase):
         self.assertEquals(f.key_union('points'), ['building','name'])
         self.assertEquals(f.filter_clause('buildings'),'building IS NOT NULL')
 
+    def test_overpass_filters(self):
+        y = '''
+        waterways:
+            types:
+                - lines
+                - polygons
+            select:
+                - name
+                - waterway
+        buildings:
+            types:
+                - points
+                - polygons
+            select:
+                - name
+                - building
+            where:
+                - building = 'yes' and name IS NOT NULL
+                - amenity IN ('school','hospital')
+        '''
+        f = FeatureSelection(y)
+        buildings = ['["amenity"~"^(school|hospital)$"]','["building"="yes"]["name"]']
+        waterways = ['["name"]','["waterway"]']
+        self.assertEquals(f.overpass_filters(), {
+            'node': buildings,
+            'way': sorted(buildings + waterways),
+            'relation': sorted(buildings + waterways)
+        })
+
     def test_sql_list(self):
         y = '''
         waterways:
@@ -141,6 +171,79 @@ class TestFeatureSelection(unittest.TestCase):
         self.assertEquals(create_sqls[0],'CREATE TABLE roads_lines(\nfid INTEGER PRIMARY KEY AUTOINCREMENT,\ngeom MULTILINESTRING,\nosm_id TEXT,"highway" TEXT,"z_index" TEXT\n);\nINSERT INTO roads_lines(geom, osm_id,"highway","z_index") select geom, osm_id,"highway","z_index" from lines WHERE ("highway" IS NOT NULL);\n')
 
 
+    def extract_themes(self, f, create_sqls):
+        # source tables as left by ogr2ogr, with plain text standing in for the geometries
+        conn = sqlite3.connect(':memory:')
+        cur = conn.cursor()
+        for geom_type in ['points', 'lines', 'polygons']:
+            table = OGR2OGR_TABLENAMES[geom_type]
+            keys = sorted(set(key.strip('"') for key in f.key_union(geom_type)))
+            cols = ['osm_id', 'osm_way_id'] if geom_type == 'polygons' else ['osm_id']
+            cols += ['"{0}"'.format(key) for key in keys]
+            cur.execute('CREATE TABLE {0}(fid INTEGER PRIMARY KEY AUTOINCREMENT,geom TEXT,{1},z_index SMALLINT DEFAULT 0)'.format(
+                table, ','.join(col + ' TEXT' for col in cols)))
+            for fid in range(1, 200):
+                values = ['id{0}'.format(fid) for col in cols if not col.startswith('"')]
+                values += [None if (fid + index) % (index + 2) else 'value{0}'.format(fid % 3)
+                           for index in range(len(keys))]
+                cur.execute('INSERT INTO {0}(geom,{1},z_index) VALUES (?,{2},?)'.format(
+                    table, ','.join(cols), ','.join('?' * len(cols))), ['geom{0}'.format(fid)] + values + [fid % 10])
+        for query in create_sqls:
+            cur.executescript(query)
+        tables = {}
+        for theme in f.themes:
+            for geom_type in f.geom_types(theme):
+                table = slugify(theme) + '_' + geom_type
+                tables[table] = cur.execute('SELECT * FROM {0}'.format(table)).fetchall()
+        tables['sqlite_master'] = cur.execute('SELECT type, name, sql FROM sqlite_master').fetchall()
+        tables['sqlite_temp_master'] = cur.execute('SELECT * FROM sqlite_temp_master').fetchall()
+        conn.close()
+        return tables
+
+    def test_extraction_sqls(self):
+        y = '''
+        buildings:
+            types:
+                - points
+                - polygons
+            select:
+                - name
+                - addr:housenumber
+            where: name IS NOT NULL OR "addr:housenumber" = 'value1'
+        roads:
+            types:
+                - lines
+            select:
+                - highway
+                - name
+        amenities:
+            types:
+                - polygons
+            select:
+                - amenity
+                - name
+            where: amenity IN ('value0','value2')
+        '''
+        f = FeatureSelection(y)
+        create_sqls, index_sqls = f.extraction_sqls
+        self.assertEquals(len(create_sqls), 3 + 4 + 3)
+        self.assertEquals(create_sqls[0], 'CREATE TEMP TABLE points_themes AS SELECT fid, (CASE WHEN (name IS NOT NULL OR "addr:housenumber" = \'value1\') THEN 1 ELSE 0 END) AS themes0 FROM points;\n')
+        self.assertIn('CREATE TABLE buildings_points(\nfid INTEGER PRIMARY KEY AUTOINCREMENT,\ngeom POINT,\nosm_id TEXT,"name" TEXT,"addr:housenumber" TEXT\n);\nINSERT INTO buildings_points(geom, osm_id,"name","addr:housenumber") select geom, osm_id,"name","addr:housenumber" from points WHERE fid IN (SELECT fid FROM points_themes WHERE themes0 & 1);\n', create_sqls)
+        self.assertNotIn('GeomFromGPB', ''.join(index_sqls))
+
+        # the same theme tables, rows and fids as running a query per theme
+        self.assertEquals(self.extract_themes(f, create_sqls), self.extract_themes(f, f.sqls[0]))
+
+    def test_extraction_sqls_many_themes(self):
+        # more themes than fit in one bitmask column
+        y = '\n'.join(['theme{0}:\n    types:\n        - points\n    select:\n        - key{1}'.format(index, index % 7)
+                        for index in range(130)])
+        f = FeatureSelection(y)
+        self.assertTrue(f.valid)
+        create_sqls, index_sqls = f.extraction_sqls
+        self.assertIn('AS themes2 FROM points', create_sqls[0])
+        self.assertEquals(self.extract_themes(f, create_sqls), self.extract_themes(f, f.sqls[0]))
+
     def test_unsafe_yaml(self):
         y = '''
         !!python/object:feature_selection.feature_selection.FeatureSelection
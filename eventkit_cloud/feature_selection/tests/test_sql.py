@@ -2,7 +2,7 @@
 from __future__ import absolute_import
 
 import unittest
-from ..sql import SQLValidator, OsmfilterRule
+from ..sql import SQLValidator, OsmfilterRule, OverpassFilter
 
 class TestSQLValidator(unittest.TestCase):
 
@@ -92,3 +92,32 @@ class TestOsmfilterRule(unittest.TestCase):
         self.assertEqual(s.rule(),"( name1=foo or name2=bar )")
         s = OsmfilterRule("(name1 = 'foo' and name2 = 'bar') or name3 = 'baz'")
         self.assertEqual(s.rule(),"( ( name1=foo and name2=bar ) or name3=baz )")
+
+
+class TestOverpassFilter(unittest.TestCase):
+
+    def test_basic(self):
+        s = OverpassFilter("name = 'some value'")
+        self.assertEqual(s.filters(),['["name"="some value"]'])
+        s = OverpassFilter('"addr:housenumber" != "1"')
+        self.assertEqual(s.filters(),['["addr:housenumber"!="1"]'])
+
+    def test_notnull(self):
+        s = OverpassFilter("name is not null")
+        self.assertEqual(s.filters(),['["name"]'])
+
+    def test_comparison_is_relaxed(self):
+        s = OverpassFilter("level > 4")
+        self.assertEqual(s.filters(),['["level"]'])
+
+    def test_basic_list(self):
+        s = OverpassFilter("name IN ('val1','val.2')")
+        self.assertEqual(s.filters(),['["name"~"^(val1|val\\\\.2)$"]'])
+
+    def test_and_or(self):
+        s = OverpassFilter("name1 = 'foo' or name2 = 'bar'")
+        self.assertEqual(s.filters(),['["name1"="foo"]','["name2"="bar"]'])
+        s = OverpassFilter("name1 = 'foo' and name2 = 'bar' or name3 = 'baz'")
+        self.assertEqual(s.filters(),['["name1"="foo"]["name2"="bar"]','["name3"="baz"]'])
+        s = OverpassFilter("(name1 = 'foo' or name2 = 'bar') and name3 = 'baz'")
+        self.assertEqual(s.filters(),['["name1"="foo"]["name3"="baz"]','["name2"="bar"]["name3"="baz"]'])
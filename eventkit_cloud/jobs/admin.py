@@ -122,6 +122,7 @@ class DataProviderForm(forms.ModelForm):
                   'export_provider_type',
                   'level_from',
                   'level_to',
+                  'max_concurrency',
                   'config',
                   'user',
                   'license',
@@ -145,7 +146,7 @@ class DataProviderForm(forms.ModelForm):
             except (ConfigurationError, SeedConfigurationError) as e:
                 raise forms.ValidationError(e.message)
 
-        elif service_type in ['osm', 'osm-generic']:
+        elif service_type in ['osm', 'osm-generic', 'osm-local']:
             if not config:
                 raise forms.ValidationError("Configuration is required for OSM data providers")
             from ..feature_selection.feature_selection import FeatureSelection
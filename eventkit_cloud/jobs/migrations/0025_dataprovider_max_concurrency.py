@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2018-03-20 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0024_auto_20180313_2039'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataprovider',
+            name='max_concurrency',
+            field=models.IntegerField(blank=True, help_text='The most requests a tile export will make to this service at once.  Exports start from the last concurrency which worked well and back off when the service is throttling or failing. Defaults to MAPPROXY_CONCURRENCY.', null=True, verbose_name='Maximum concurrent requests'),
+        ),
+    ]
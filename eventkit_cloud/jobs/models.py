@@ -152,6 +152,11 @@ class DataProvider(UIDMixin, TimeStampedModelMixin):
                                      help_text="This determines the starting zoom level a tile export will seed from")
     level_to = models.IntegerField(verbose_name="Seed to level", default=10, null=True, blank=True,
                                    help_text="This determine what zoom level your tile export will seed to")
+    max_concurrency = models.IntegerField(verbose_name="Maximum concurrent requests", null=True, blank=True,
+                                          help_text="The most requests a tile export will make to this service at "
+                                                    "once.  Exports start from the last concurrency which worked "
+                                                    "well and back off when the service is throttling or failing. "
+                                                    "Defaults to MAPPROXY_CONCURRENCY.")
     config = models.TextField(default='', null=True, blank=True,
                               verbose_name="Configuration",
                               help_text="This is an optional field to put in additional configuration.")
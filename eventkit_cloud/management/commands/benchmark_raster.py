@@ -0,0 +1,66 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy
+from django.core.management import BaseCommand
+from osgeo import gdal, osr
+
+from ...utils.gdalutils import get_raster_options, get_raster_profile
+
+
+class Command(BaseCommand):
+    help = "Reports the throughput of gdalwarp on a synthetic raster with the raster profile for each thread count."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=8192, help="The width and height of the raster in pixels.")
+        parser.add_argument('--threads', type=int, nargs='+',
+                            help="The thread counts to run with, defaults to powers of two up to the cores.")
+        parser.add_argument('--format', default='GTiff', help="The output format.")
+
+    def handle(self, *args, **options):
+        cores = multiprocessing.cpu_count()
+        threads = options.get('threads') or [count for count in [2 ** n for n in range(8)] if count < cores] + [cores]
+        profile = get_raster_profile()
+        self.stdout.write("Warp memory {0}MB, block cache {1}MB, {2} cores.".format(
+            profile['warp_memory'], profile['cache_max'], cores))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmp_dir, 'source.tif')
+            create_raster(source, options['size'])
+            megapixels = options['size'] ** 2 / 1000000.0
+            baseline = None
+            for count in threads:
+                out = os.path.join(tmp_dir, 'out_{0}'.format(count))
+                cmd = "gdalwarp {0} -t_srs EPSG:3857 -of {1} {2} {3}".format(
+                    get_raster_options(threads=count), options['format'], source, out)
+                start = time.time()
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.check_call(cmd.split(), stdout=devnull)
+                throughput = megapixels / (time.time() - start)
+                os.remove(out)
+                baseline = baseline or throughput
+                self.stdout.write("{0} threads: {1:.1f} megapixels/s, {2:.2f}x of {3}, {4:.1f} megapixels/s per thread"
+                                  .format(count, throughput, throughput / baseline, threads[0], throughput / count))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def create_raster(path, size, block_rows=512):
+    """
+    Writes a tiled 3 band GeoTIFF of noise covering 10 degrees square.
+    """
+    ds = gdal.GetDriverByName('GTiff').Create(path, size, size, 3, gdal.GDT_Byte, ['TILED=YES'])
+    ds.SetGeoTransform([0, 10.0 / size, 0, 10, 0, -10.0 / size])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    for row in range(0, size, block_rows):
+        rows = min(block_rows, size - row)
+        for band in range(1, 4):
+            ds.GetRasterBand(band).WriteArray(numpy.random.randint(0, 256, (rows, size)).astype(numpy.uint8), 0, row)
+    ds = None
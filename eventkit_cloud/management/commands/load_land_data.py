@@ -5,4 +5,7 @@ class Command(BaseCommand):
     help = "Loads land data required for the OSM pipeline."
 
     def handle(self, *args, **options):
-        load_land_vectors()
\ No newline at end of file
+        stats = load_land_vectors()
+        if stats:
+            self.stdout.write("Loaded {rows} land polygons as {pieces} pieces in {seconds:.1f}s "
+                              "({rows_per_second:.0f} rows/s).".format(**stats))
@@ -0,0 +1,14 @@
+from django.core.management import BaseCommand
+from ...utils.overpass_cache import OverpassCache
+
+
+class Command(BaseCommand):
+    help = "Reports the hit rate and size of the Overpass extract cache."
+
+    def handle(self, *args, **options):
+        cache = OverpassCache.from_settings()
+        if not cache:
+            self.stdout.write("The overpass cache is not configured, set OVERPASS_CACHE_DIR to enable it.")
+            return
+        for name, value in sorted(cache.stats().items()):
+            self.stdout.write("{0}: {1}".format(name, value))
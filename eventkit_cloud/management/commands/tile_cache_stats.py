@@ -0,0 +1,16 @@
+from django.core.management import BaseCommand
+from ...utils.tile_cache import TileCache
+
+
+class Command(BaseCommand):
+    help = "Reports the hit rate and size of the shared tile cache of each provider."
+
+    def handle(self, *args, **options):
+        caches = TileCache.all_from_settings()
+        if not caches:
+            self.stdout.write("The tile cache is not configured or empty, set TILE_CACHE_DIR to enable it.")
+            return
+        for cache in caches:
+            self.stdout.write(cache.provider)
+            for name, value in sorted(cache.stats().items()):
+                self.stdout.write("    {0}: {1}".format(name, value))
@@ -0,0 +1,21 @@
+from django.core.management import BaseCommand
+from ...utils.regional_extracts import get_regional_extracts
+
+
+class Command(BaseCommand):
+    help = "Applies OSM change files to the regional PBFs used by osm-local providers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pbf-dir', dest='pbf_dir', default=None,
+                            help='The directory of regional PBFs, defaults to OSM_LOCAL_PBF_DIR.')
+
+    def handle(self, *args, **options):
+        extracts = get_regional_extracts(options.get('pbf_dir'))
+        if not extracts:
+            self.stdout.write("No regional PBFs were found, set OSM_LOCAL_PBF_DIR or pass --pbf-dir.")
+            return
+        for extract in extracts:
+            if extract.update():
+                self.stdout.write("Updated {0}".format(extract.pbf))
+            else:
+                self.stdout.write("{0} is up to date".format(extract.pbf))
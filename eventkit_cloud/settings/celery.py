@@ -33,6 +33,10 @@ CELERYBEAT_SCHEDULE = {
     'expire-runs': {
         'task': 'Expire Runs',
         'schedule': crontab(minute='0', hour='0', day_of_week='*')
+    },
+    'update-regional-extracts': {
+        'task': 'Update Regional Extracts',
+        'schedule': crontab(minute='*/15')
     }
 }
 
@@ -133,6 +133,94 @@ http://wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL#timeout
 
 OVERPASS_TIMEOUT = os.getenv('OVERPASS_TIMEOUT', 1600)  # query timeout in seconds
 
+"""
+Overpass tiling settings
+
+Bounding boxes larger than OVERPASS_TILE_MIN_AREA (in square degrees) with more than OVERPASS_TILE_MAX_NODES nodes
+are split into tiles of about OVERPASS_TILE_MAX_NODES nodes, which are fetched by OVERPASS_TILE_WORKERS concurrent
+requests and merged.  A failing tile is retried OVERPASS_TILE_RETRIES times and then split into quarters, at most
+OVERPASS_TILE_MAX_SPLITS times.
+"""
+
+OVERPASS_TILE_MIN_AREA = float(os.getenv('OVERPASS_TILE_MIN_AREA', 0.25))
+OVERPASS_TILE_MAX_NODES = int(os.getenv('OVERPASS_TILE_MAX_NODES', 2000000))
+OVERPASS_TILE_WORKERS = int(os.getenv('OVERPASS_TILE_WORKERS', 4))
+OVERPASS_TILE_RETRIES = int(os.getenv('OVERPASS_TILE_RETRIES', 2))
+OVERPASS_TILE_MAX_SPLITS = int(os.getenv('OVERPASS_TILE_MAX_SPLITS', 2))
+OVERPASS_TILE_COUNT_TIMEOUT = int(os.getenv('OVERPASS_TILE_COUNT_TIMEOUT', 60))  # node count timeout in seconds
+
+"""
+Overpass filter setting
+
+When enabled, OSM exports only query overpass for the elements the job's feature selection needs rather than every
+element in the bounding box.  Disabled by default, so exports download all of the data in the bounding box.
+"""
+
+OVERPASS_FILTER_QUERY = 't' in os.getenv('OVERPASS_FILTER_QUERY', 'false').lower()
+
+"""
+Overpass cache settings
+
+Raw overpass extracts are cached in OVERPASS_CACHE_DIR, keyed by the bounding box (rounded to
+OVERPASS_CACHE_BBOX_PRECISION decimal places) and the query.  Extracts are reused for OVERPASS_CACHE_TTL seconds and the
+least recently used extracts are evicted once the cache is larger than OVERPASS_CACHE_MAX_SIZE bytes.
+The cache is disabled unless OVERPASS_CACHE_DIR is set.
+"""
+
+OVERPASS_CACHE_DIR = os.getenv('OVERPASS_CACHE_DIR', None)
+OVERPASS_CACHE_MAX_SIZE = int(os.getenv('OVERPASS_CACHE_MAX_SIZE', 10737418240))  # 10GB
+OVERPASS_CACHE_TTL = int(os.getenv('OVERPASS_CACHE_TTL', 60 * 60 * 24))  # 1 day
+OVERPASS_CACHE_BBOX_PRECISION = int(os.getenv('OVERPASS_CACHE_BBOX_PRECISION', 5))
+
+"""
+OSM streaming conversion setting
+
+When enabled, the overpass response is piped straight into osmconvert and only the PBF is written to the staging
+directory.  Tiled and cached extracts are on disk already and are converted from file, streamed extracts are not
+stored in the overpass cache.
+"""
+
+OSM_STREAMING_CONVERSION = 't' in os.getenv('OSM_STREAMING_CONVERSION', 'false').lower()
+
+"""
+Local OSM settings
+
+osm-local providers extract data from a regional or planet PBF on local disk instead of querying overpass.  The url of
+the provider is the path of the PBF, relative paths are resolved against OSM_LOCAL_PBF_DIR.  osmconvert reads the whole
+PBF for each extract, so the url may instead name a directory of pre-cut regional extracts (such as
+OSM_LOCAL_PBF_DIR itself), and each export then reads the smallest extract whose header bounds cover its bounding box.
+
+The PBFs in OSM_LOCAL_PBF_DIR are kept current by the Update Regional Extracts task, which applies the change files
+(.osc) placed in <region>.changes next to each PBF.  If OSM_LOCAL_UPDATE_URL is set to an OSM replication server
+(e.g. https://planet.openstreetmap.org/replication) the diffs published since each PBF was last updated are fetched and
+applied as well.
+"""
+
+OSM_LOCAL_PBF_DIR = os.getenv('OSM_LOCAL_PBF_DIR', None)
+OSM_LOCAL_UPDATE_URL = os.getenv('OSM_LOCAL_UPDATE_URL', None)
+
+"""
+Thematic GeoPackage settings
+
+When a GeoPackage is created per theme, GEOPACKAGE_THEME_WORKERS processes create the themes concurrently.
+"""
+
+GEOPACKAGE_THEME_WORKERS = int(os.getenv('GEOPACKAGE_THEME_WORKERS', 4))
+
+"""
+WFS paging settings
+
+WFS exports first ask the service how many features the layer has in the bounding box.  Layers with more than
+WFS_PAGE_SIZE features are fetched from WFS 2.0 services in pages of WFS_PAGE_SIZE features, by as many concurrent
+requests as the provider allows or else WFS_PAGE_WORKERS, and appended to the GeoPackage as they arrive.  A failing page
+is retried WFS_PAGE_RETRIES times.  Other layers, and services which can't count the features, are fetched in a single
+request.  Set WFS_PAGE_SIZE to 0 to always use a single request.
+"""
+
+WFS_PAGE_SIZE = int(os.getenv('WFS_PAGE_SIZE', 10000))
+WFS_PAGE_WORKERS = int(os.getenv('WFS_PAGE_WORKERS', 4))
+WFS_PAGE_RETRIES = int(os.getenv('WFS_PAGE_RETRIES', 2))
+
 # Authentication Settings
 
 AUTHENTICATION_BACKENDS = tuple()
@@ -318,8 +406,70 @@ AWS_ACCESS_KEY = AWS_ACCESS_KEY or os.environ.get('AWS_ACCESS_KEY')
 AWS_SECRET_KEY = AWS_SECRET_KEY or os.environ.get('AWS_SECRET_KEY')
 
 
+"""
+Tile seeding concurrency
+
+The number of requests a raster export starts out making to a provider at once, and the most it makes to providers
+without a max_concurrency of their own.  The concurrency is adjusted to each provider between zoom levels.
+"""
+
 MAPPROXY_CONCURRENCY = os.environ.get('MAPPROXY_CONCURRENCY', 1)
 
+"""
+Tile seeding retries
+
+Seeding is checkpointed next to the export, a failed seed is resumed from its last checkpoint up to
+MAPPROXY_SEED_RETRIES times before the export fails.
+"""
+
+MAPPROXY_SEED_RETRIES = int(os.getenv('MAPPROXY_SEED_RETRIES', 2))
+
+"""
+Tile seeding progress
+
+The progress of a raster export is written to its task at most every PROGRESS_UPDATE_INTERVAL seconds, unless it has
+advanced by PROGRESS_UPDATE_DELTA percent since it was last written.
+"""
+
+PROGRESS_UPDATE_INTERVAL = int(os.getenv('PROGRESS_UPDATE_INTERVAL', 10))
+PROGRESS_UPDATE_DELTA = float(os.getenv('PROGRESS_UPDATE_DELTA', 1))
+
+"""
+Shared tile cache settings
+
+Raster exports of a provider are seeded from a GeoPackage of its tiles in TILE_CACHE_DIR, so tiles exported by an
+earlier run are not requested from the provider again.  Tiles are refetched after TILE_CACHE_TTL seconds and the oldest
+tiles are evicted once the cache of a provider is larger than TILE_CACHE_MAX_SIZE bytes.
+The cache is disabled unless TILE_CACHE_DIR is set.
+"""
+
+TILE_CACHE_DIR = os.getenv('TILE_CACHE_DIR', None)
+TILE_CACHE_MAX_SIZE = int(os.getenv('TILE_CACHE_MAX_SIZE', 10737418240))  # 10GB
+TILE_CACHE_TTL = int(os.getenv('TILE_CACHE_TTL', 60 * 60 * 24 * 7))  # 1 week
+
+"""
+Raster processing profile
+
+gdalwarp warps with RASTER_THREADS threads in chunks of up to RASTER_WARP_MEMORY MB, and gdalwarp and gdal_translate
+cache up to RASTER_CACHE_MAX MB of raster blocks.  By default the cores and half of the memory of the host are shared
+between the RASTER_WORKER_TASKS tasks a worker runs at once.
+"""
+
+RASTER_WORKER_TASKS = int(os.getenv('RASTER_WORKER_TASKS', os.getenv('CONCURRENCY', 1)))
+RASTER_THREADS = os.getenv('RASTER_THREADS', None)
+RASTER_WARP_MEMORY = os.getenv('RASTER_WARP_MEMORY', None)
+RASTER_CACHE_MAX = os.getenv('RASTER_CACHE_MAX', None)
+
+"""
+GDAL execution
+
+ogr2ogr, gdalwarp and gdal_translate commands run through the GDAL python bindings in a child process of the task,
+which reports their progress and stops them when the task is canceled.  Set GDAL_IN_PROCESS to false to run them in a
+shell instead.
+"""
+
+GDAL_IN_PROCESS = 'f' not in os.getenv('GDAL_IN_PROCESS', 'true').lower()
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -12,7 +12,7 @@ import traceback
 from zipfile import ZipFile, ZIP_DEFLATED
 
 from django.conf import settings
-from django.contrib.gis.geos import Polygon
+from django.contrib.gis.geos import GEOSGeometry, Polygon
 
 from django.core.cache import caches
 from django.core.mail import EmailMultiAlternatives
@@ -29,7 +29,8 @@ from audit_logging.celery_support import UserDetailsBase
 from ..ui.helpers import get_style_files, generate_qgs_style
 from ..celery import app, TaskPriority
 from ..utils import (
-    kml, overpass, pbf, s3, shp, external_service, wfs, wcs, arcgis_feature_service, sqlite, geopackage, gdalutils
+    kml, overpass, pbf, s3, shp, external_service, wfs, wcs, arcgis_feature_service, sqlite, geopackage, gdalutils,
+    land_polygons
 )
 from ..utils.hotosm_geopackage import Geopackage
 from ..utils.geopackage import add_file_metadata
@@ -363,47 +364,96 @@ class FormatTask(ExportTask):
 
 def osm_data_collection_pipeline(
         export_task_record_uid, stage_dir, job_name='no_job_name_specified', url=None, slug=None,
-        bbox=None, user_details=None, config=None):
+        bbox=None, selection=None, user_details=None, config=None):
     """
     Collects data from OSM & produces a thematic gpkg as a subtask of the task referenced by export_provider_task_id.
     bbox expected format is an iterable of the form [ long0, lat0, long1, lat1 ]
+    selection is an optional geojson file with the polygon to clip the data to, otherwise it is clipped to the bbox.
     """
+    if config is None:
+        logger.error("No configuration was provided for OSM export")
+        raise RuntimeError("The configuration field is required for OSM data providers")
+
+    feature_selection = FeatureSelection.example(config)
+
     # --- Overpass Query
     op = overpass.Overpass(
         bbox=bbox, stage_dir=stage_dir, slug=slug, url=url,
         job_name=job_name, task_uid=export_task_record_uid,
-        raw_data_filename='{}_query.osm'.format(job_name)
+        raw_data_filename='{}_query.osm'.format(job_name),
+        feature_selection=feature_selection if settings.OVERPASS_FILTER_QUERY else None
     )
 
-    osm_data_filename = op.run_query(user_details=user_details, subtask_percentage=60)  # run the query
-
-    # --- Convert Overpass result to PBF
-    osm_filename = os.path.join(stage_dir, osm_data_filename)
     pbf_filename = os.path.join(stage_dir, '{}_query.pbf'.format(job_name))
-    pbf_filepath = pbf.OSMToPBF(osm=osm_filename, pbffile=pbf_filename, task_uid=export_task_record_uid).convert()
+    if settings.OSM_STREAMING_CONVERSION:
+        # --- Stream the Overpass result straight to PBF
+        pbf_filepath = op.run_query_to_pbf(pbf_filename, user_details=user_details, subtask_percentage=60)
+    else:
+        osm_data_filename = op.run_query(user_details=user_details, subtask_percentage=60)  # run the query
 
-    # --- Generate thematic gpkg from PBF
-    geopackage_filepath = os.path.join(stage_dir, '{}.gpkg'.format(job_name))
+        # --- Convert Overpass result to PBF
+        osm_filename = os.path.join(stage_dir, osm_data_filename)
+        # Extracts served from a cached extract of a larger area are clipped to the bbox during the conversion.
+        pbf_filepath = pbf.OSMToPBF(osm=osm_filename, pbffile=pbf_filename, task_uid=export_task_record_uid,
+                                    bbox=op.clip_bbox).convert()
 
+    if selection:
+        # --- Drop the data outside of the selection before it is ingested
+        pbf_filepath = pbf.PBFExtract(
+            pbf=pbf_filepath, pbffile=os.path.join(stage_dir, '{}_selection.pbf'.format(job_name)),
+            boundary=selection, task_uid=export_task_record_uid
+        ).extract()
+
+    update_progress(export_task_record_uid, progress=75)
+    return pbf_to_thematic_gpkg(export_task_record_uid, pbf_filepath, stage_dir, job_name, bbox, selection,
+                                feature_selection)
+
+
+def osm_local_data_collection_pipeline(
+        export_task_record_uid, stage_dir, job_name='no_job_name_specified', url=None, bbox=None, selection=None,
+        config=None):
+    """
+    Extracts data from a local regional PBF & produces a thematic gpkg as a subtask of the task referenced by
+    export_provider_task_id.
+    bbox expected format is an iterable of the form [ long0, lat0, long1, lat1 ]
+    selection is an optional geojson file with the polygon to extract, otherwise the bbox is extracted.
+    """
     if config is None:
         logger.error("No configuration was provided for OSM export")
         raise RuntimeError("The configuration field is required for OSM data providers")
 
     feature_selection = FeatureSelection.example(config)
-    update_progress(export_task_record_uid, progress=75)
-    geom = Polygon.from_bbox(bbox)
+
+    # --- Extract the area from the regional PBF
+    pbf_filepath = pbf.PBFExtract(
+        pbf=pbf.get_local_pbf(url, bbox=bbox), pbffile=os.path.join(stage_dir, '{}_extract.pbf'.format(job_name)),
+        boundary=selection or bbox, task_uid=export_task_record_uid
+    ).extract()
+
+    update_progress(export_task_record_uid, progress=50)
+    return pbf_to_thematic_gpkg(export_task_record_uid, pbf_filepath, stage_dir, job_name, bbox, selection,
+                                feature_selection)
+
+
+def pbf_to_thematic_gpkg(export_task_record_uid, pbf_filepath, stage_dir, job_name, bbox, selection,
+                         feature_selection):
+    """
+    Generates the thematic gpkg for feature_selection from an OSM PBF and adds the land polygons.
+    The features and land polygons are clipped to the selection geojson file if there is one, otherwise to the bbox.
+    """
+    # --- Generate thematic gpkg from PBF
+    geopackage_filepath = os.path.join(stage_dir, '{}.gpkg'.format(job_name))
+
+    if selection:
+        with open(selection) as selection_file:
+            geom = GEOSGeometry(selection_file.read(), srid=4326)
+    else:
+        geom = Polygon.from_bbox(bbox)
     g = Geopackage(pbf_filepath, geopackage_filepath, stage_dir, feature_selection, geom)
     g.run()
 
     # --- Add the Land Boundaries polygon layer
-    database = settings.DATABASES['feature_data']
-    in_dataset = 'PG:"dbname={name} host={host} user={user} password={password} port={port}"'.format(host=database['HOST'],
-                                        user=database['USER'],
-                                        password=database['PASSWORD'].replace('$', '\$'),
-                                        port=database['PORT'],
-                                        name=database['NAME'])
-
-    gdalutils.clip_dataset(boundary=bbox, in_dataset=in_dataset, out_dataset=geopackage_filepath, table="land_polygons", fmt='gpkg')
+    land_polygons.add_land_polygons(geopackage_filepath, geom)
 
     ret_geopackage_filepath = g.results[0].parts[0]
     assert(ret_geopackage_filepath == geopackage_filepath)
@@ -432,15 +482,43 @@ def osm_data_collection_task(
     if user_details is None:
         user_details = {'username': 'username not set in osm_data_collection_task'}
 
+    # The pipeline clips the data to the selection, so the geopackage doesn't need to be clipped again.
+    selection = parse_result(result, 'selection')
     gpkg_filepath = osm_data_collection_pipeline(
-        task_uid, stage_dir, slug=provider_slug, job_name=job_name, bbox=bbox, user_details=user_details,
-        url=overpass_url, config=config
+        task_uid, stage_dir, slug=provider_slug, job_name=job_name, bbox=bbox, selection=selection,
+        user_details=user_details, url=overpass_url, config=config
     )
 
+    result['result'] = gpkg_filepath
+    result['geopackage'] = gpkg_filepath
+
+    result = add_metadata_task(result=result, job_uid=run.job.uid, provider_slug=provider_slug)
+
+    logger.debug("exit run for {0}".format(self.name))
+
+    return result
+
+
+@app.task(name="OSM Extract (.gpkg)", bind=True, base=FormatTask, abort_on_error=True)
+def osm_local_data_collection_task(
+        self, result=None, stage_dir=None, run_uid=None, provider_slug=None, pbf_url=None, task_uid=None,
+        job_name='no_job_name_specified', bbox=None, user_details=None, config=None, *args, **kwargs):
+    """
+    Extracts data from a local regional PBF & produces a thematic gpkg as a subtask of the task referenced by
+    export_provider_task_id.
+    bbox expected format is an iterable of the form [ long0, lat0, long1, lat1 ]
+    """
+    from .models import ExportRun
+
+    logger.debug("enter run for {0}".format(self.name))
+
+    result = result or {}
+    run = ExportRun.objects.get(uid=run_uid)
+
     selection = parse_result(result, 'selection')
-    if selection:
-        logger.debug("Calling clip_dataset with boundary={}, in_dataset={}".format(selection, gpkg_filepath))
-        gpkg_filepath = gdalutils.clip_dataset(boundary=selection, in_dataset=gpkg_filepath, fmt=None)
+    gpkg_filepath = osm_local_data_collection_pipeline(
+        task_uid, stage_dir, job_name=job_name, url=pbf_url, bbox=bbox, selection=selection, config=config
+    )
 
     result['result'] = gpkg_filepath
     result['geopackage'] = gpkg_filepath
@@ -589,17 +667,10 @@ def geopackage_export_task(self, result={}, run_uid=None, task_uid=None,
     run = ExportRun.objects.get(uid=run_uid)
     task = ExportTaskRecord.objects.get(uid=task_uid)
 
-    selection = parse_result(result, 'selection')
-    if selection:
-        gpkg = parse_result(result, 'result')
-        gdalutils.clip_dataset(boundary=selection, in_dataset=gpkg, fmt=None)
-
+    pipeline = get_dataset_pipeline(result, task_uid=task_uid).convert('gpkg')
+    result.update(pipeline.run(out_dataset=get_format_dataset(result, 'gpkg')))
+    result['geopackage'] = result['result']
     add_metadata_task(result=result, job_uid=run.job.uid, provider_slug=task.export_provider_task.slug)
-    gpkg = parse_result(result, 'result')
-    gpkg = gdalutils.convert(dataset=gpkg, fmt='gpkg', task_uid=task_uid)
-
-    result['result'] = gpkg
-    result['geopackage'] = gpkg
     return result
 
 
@@ -612,15 +683,9 @@ def geotiff_export_task(self, result=None, run_uid=None, task_uid=None, stage_di
     from .models import ExportRun
     result = result or {}
 
-    gtiff = parse_result(result, 'result')
-    selection = parse_result(result, 'selection')
-    if selection:
-        gdalutils.clip_dataset(boundary=selection, in_dataset=gtiff, fmt=None)
-
-    gtiff = gdalutils.convert(dataset=gtiff, fmt='gtiff', task_uid=task_uid)
-
-    result['result'] = gtiff
-    result['geotiff'] = gtiff
+    pipeline = get_dataset_pipeline(result, task_uid=task_uid).convert('gtiff')
+    result.update(pipeline.run(out_dataset=get_format_dataset(result, 'tif')))
+    result['geotiff'] = result['result']
     return result
 
 
@@ -641,19 +706,14 @@ def clip_export_task(self, result=None, run_uid=None, task_uid=None, stage_dir=N
     result = result or {}
     # self.update_task_state(result=result, task_uid=task_uid)
 
-    dataset = parse_result(result, 'result')
-    selection = parse_result(result, 'selection')
-    if selection:
-        dataset = gdalutils.clip_dataset(boundary=selection, in_dataset=dataset, fmt=None)
-
-    result['result'] = dataset
+    result.update(get_dataset_pipeline(result, task_uid=task_uid).run())
     return result
 
 
 @app.task(name='WFSExport', bind=True, base=ExportTask, abort_on_error=True)
 def wfs_export_task(self, result=None, layer=None, config=None, run_uid=None, task_uid=None, stage_dir=None,
                     job_name=None, bbox=None, service_url=None, name=None, service_type=None, user_details=None,
-                    *args, **kwargs):
+                    max_concurrency=None, *args, **kwargs):
     """
     Class defining geopackage export for WFS service.
     """
@@ -662,7 +722,8 @@ def wfs_export_task(self, result=None, layer=None, config=None, run_uid=None, ta
     gpkg = os.path.join(stage_dir, '{0}.gpkg'.format(job_name))
     try:
         w2g = wfs.WFSToGPKG(gpkg=gpkg, bbox=bbox, service_url=service_url, name=name, layer=layer,
-                            config=config, service_type=service_type, task_uid=task_uid)
+                            config=config, service_type=service_type, task_uid=task_uid,
+                            max_concurrency=max_concurrency)
         out = w2g.convert()
         result['result'] = out
         result['geopackage'] = out
@@ -688,6 +749,8 @@ def wcs_export_task(self, result=None, layer=None, config=None, run_uid=None, ta
         wcs_conv.convert()
         result['result'] = out
         result['geotiff'] = out
+        result['driver'] = 'gtiff'
+        result['raster'] = True
         return result
     except Exception as e:
         logger.error('Raised exception in WCS service export: %s', str(e))
@@ -795,10 +858,13 @@ def bounds_export_task(self, result={}, run_uid=None, task_uid=None, stage_dir=N
     return result
 
 
-@app.task(name='Raster export (.gpkg)', bind=True, base=FormatTask, abort_on_error=True)
+# Seeding is checkpointed, so a raster export lost with its worker is redelivered and continues where it stopped.
+@app.task(name='Raster export (.gpkg)', bind=True, base=FormatTask, abort_on_error=True, acks_late=True,
+          reject_on_worker_lost=True)
 def external_raster_service_export_task(self, result=None, layer=None, config=None, run_uid=None, task_uid=None,
                                         stage_dir=None, job_name=None, bbox=None, service_url=None, level_from=None,
-                                        level_to=None, name=None, service_type=None, *args, **kwargs):
+                                        level_to=None, name=None, service_type=None, max_concurrency=None, *args,
+                                        **kwargs):
     """
     Class defining geopackage export for external raster service.
     """
@@ -817,10 +883,13 @@ def external_raster_service_export_task(self, result=None, layer=None, config=No
                                                                  service_url=service_url, name=name, layer=layer,
                                                                  config=config, level_from=level_from,
                                                                  level_to=level_to, service_type=service_type,
-                                                                 task_uid=task_uid, selection=selection)
+                                                                 task_uid=task_uid, selection=selection,
+                                                                 max_concurrency=max_concurrency)
         gpkg = w2g.convert()
         result['result'] = gpkg
         result['geopackage'] = gpkg
+        result['driver'] = 'gpkg'
+        result['raster'] = True
         add_metadata_task(result=result, job_uid=run.job.uid, provider_slug=task.export_provider_task.slug)
 
         return result
@@ -1063,6 +1132,26 @@ def finalize_export_provider_task(result=None, export_provider_task_uid=None,
     return result
 
 
+@app.task(name='Join Format Tasks', base=UserDetailsBase)
+def join_format_tasks(result=None, *args, **kwargs):
+    """
+    Combines the results of the format tasks of a provider, which run in parallel, into one result for the tasks that
+    follow.  The provider is canceled if any format task was canceled, and failed if any format task failed.
+    """
+    results = [task_result for task_result in result or [] if task_result]
+    joined = {}
+    for task_result in results:
+        joined.update(task_result)
+    statuses = [task_result.get('status') for task_result in results]
+    if TaskStates.CANCELED.value in statuses:
+        joined['status'] = TaskStates.CANCELED.value
+    elif TaskStates.FAILED.value in statuses:
+        joined['status'] = TaskStates.FAILED.value
+    else:
+        joined['status'] = TaskStates.SUCCESS.value
+    return joined
+
+
 @app.task(name='Zip File Task', bind=False, base=UserDetailsBase)
 def zip_file_task(include_files, run_uid=None, file_name=None, adhoc=False, static_files=None, *args, **kwargs):
     """
@@ -1494,12 +1583,41 @@ def update_progress(task_uid, progress=None, subtask_percentage=100.0, estimated
     # will be invalid and throw an error.
     connection.close()
 
-    export_task = ExportTaskRecord.objects.get(uid=task_uid)
+    fields = {}
     if absolute_progress:
-        export_task.progress = absolute_progress
+        fields['progress'] = absolute_progress
     if estimated_finish:
-        export_task.estimated_finish = estimated_finish
-    export_task.save()
+        fields['estimated_finish'] = estimated_finish
+    # Only the progress is written, saving the whole record would also add an entry to the audit log.
+    ExportTaskRecord.objects.filter(uid=task_uid).update(**fields)
+
+
+def get_dataset_pipeline(task_result, task_uid=None):
+    """
+    Starts a DatasetPipeline for the result of the previous task, clipped to the selection if there is one.
+    The driver of the dataset is taken from the task result when the previous task recorded it.
+    :param task_result: The result of the previous task.
+    :param task_uid: A task uid to update.
+    :return: A DatasetPipeline which further stages can be added to.
+    """
+    pipeline = gdalutils.DatasetPipeline(dataset=parse_result(task_result, 'result'),
+                                         driver=parse_result(task_result, 'driver'),
+                                         raster=parse_result(task_result, 'raster'), task_uid=task_uid)
+    selection = parse_result(task_result, 'selection')
+    if selection:
+        pipeline.clip(selection)
+    return pipeline
+
+
+def get_format_dataset(task_result, extension):
+    """
+    :param task_result: The result of the task which produced the source dataset.
+    :param extension: The file extension of the format.
+    :return: The source dataset if it is already in the format, otherwise a file next to it, so that the source isn't
+    replaced while other formats are being made from it.
+    """
+    dataset = parse_result(task_result, 'result')
+    return '{0}.{1}'.format(os.path.splitext(dataset)[0], extension)
 
 
 def parse_result(task_result, key=''):
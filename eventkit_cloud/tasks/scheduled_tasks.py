@@ -63,6 +63,17 @@ def expire_runs():
             run.save()
 
 
+@app.task(name='Update Regional Extracts')
+def update_regional_extracts_task():
+    """
+    Applies OSM change files to the regional PBFs used by osm-local providers.
+    """
+    from eventkit_cloud.utils.regional_extracts import update_regional_extracts
+    updated = update_regional_extracts()
+    logger.info('Updated {0} regional extracts.'.format(len(updated)))
+    return updated
+
+
 def send_warning_email(date=None, url=None, addr=None, job_name=None):
     """
     Args:
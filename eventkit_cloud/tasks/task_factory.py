@@ -26,6 +26,7 @@ from ..tasks.models import ExportRun, DataProviderTaskRecord
 from ..tasks.task_runners import create_export_task_record
 from .task_runners import (
     ExportOSMTaskRunner,
+    ExportOSMLocalTaskRunner,
     ExportWFSTaskRunner,
     ExportWCSTaskRunner,
     ExportExternalRasterServiceTaskRunner,
@@ -44,6 +45,7 @@ class TaskFactory:
 
     def __init__(self,):
         self.type_task_map = {'osm': ExportOSMTaskRunner,
+                              'osm-local': ExportOSMLocalTaskRunner,
                               'wfs': ExportWFSTaskRunner,
                               'wms': ExportExternalRasterServiceTaskRunner,
                               'wcs': ExportWCSTaskRunner,
@@ -15,6 +15,8 @@ from eventkit_cloud.tasks.export_tasks import (
     external_raster_service_export_task,
     arcgis_feature_service_export_task,
     osm_data_collection_task,
+    osm_local_data_collection_task,
+    join_format_tasks,
     TaskStates)
 
 from eventkit_cloud.tasks.models import ExportTaskRecord, DataProviderTaskRecord
@@ -47,6 +49,7 @@ class ExportOSMTaskRunner(TaskRunner):
     """
     Run OSM Export Tasks; Essentially, collect data and convert to thematic gpkg, then run output formats.
     """
+    data_collection_task = osm_data_collection_task
 
     def run_task(self, provider_task_uid=None, user=None, run=None, stage_dir=None, worker=None, **kwargs):
         """
@@ -105,30 +108,28 @@ class ExportOSMTaskRunner(TaskRunner):
         """
         Create a celery chain which gets a gpkg of osm data & runs export formats
         """
-        if export_tasks:
-            format_tasks = chain(
-                task.get('obj').s(
-                    run_uid=run.uid, stage_dir=stage_dir, job_name=job_name, task_uid=task.get('task_uid'),
-                    user_details=user_details, locking_task_key=data_provider_task_record.uid
-                ).set(queue=worker, routing_key=worker)
-                for format_ignored, task in export_tasks.iteritems()
-            )
-        else:
-            format_tasks = None
+        format_tasks = get_format_tasks([
+            task.get('obj').s(
+                run_uid=run.uid, stage_dir=stage_dir, job_name=job_name, task_uid=task.get('task_uid'),
+                user_details=user_details
+            ).set(queue=worker, routing_key=worker)
+            for format_ignored, task in export_tasks.iteritems()
+        ], worker=worker)
 
         bbox = run.job.extents
 
         osm_data_collection_task_record = create_export_task_record(
-            task_name=osm_data_collection_task.name,
+            task_name=self.data_collection_task.name,
             export_provider_task=data_provider_task_record, worker=worker,
-            display=getattr(osm_data_collection_task, "display", False)
+            display=getattr(self.data_collection_task, "display", False)
         )
 
-        osm_gpkg_task = osm_data_collection_task.s(
-            run_uid=run.uid, provider_slug=provider_task.provider.slug, overpass_url=provider_task.provider.url,
+        osm_gpkg_task = self.data_collection_task.s(
+            run_uid=run.uid, provider_slug=provider_task.provider.slug,
             stage_dir=stage_dir, export_provider_task_record_uid=data_provider_task_record.uid, worker=worker,
             job_name=job_name, bbox=bbox, user_details=user_details, task_uid=osm_data_collection_task_record.uid,
-            config=provider_task.provider.config, locking_task_key=data_provider_task_record.uid
+            config=provider_task.provider.config, locking_task_key=data_provider_task_record.uid,
+            **self.get_source_kwargs(provider_task.provider)
         )
 
         if format_tasks:
@@ -138,6 +139,23 @@ class ExportOSMTaskRunner(TaskRunner):
 
         return data_provider_task_record.uid, tasks
 
+    def get_source_kwargs(self, provider):
+        """
+        :param provider: The DataProvider being exported.
+        :return: The keyword arguments telling the data collection task where to get the data from.
+        """
+        return {'overpass_url': provider.url}
+
+
+class ExportOSMLocalTaskRunner(ExportOSMTaskRunner):
+    """
+    Run OSM Export Tasks against a locally stored regional PBF instead of an Overpass server.
+    """
+    data_collection_task = osm_local_data_collection_task
+
+    def get_source_kwargs(self, provider):
+        return {'pbf_url': provider.url}
+
 
 class ExportWFSTaskRunner(TaskRunner):
     """
@@ -208,6 +226,7 @@ class ExportWFSTaskRunner(TaskRunner):
                                          layer=provider_task.provider.layer,
                                          bbox=bbox,
                                          service_url=provider_task.provider.url,
+                                         max_concurrency=provider_task.provider.max_concurrency,
                                          user_details=user_details,
                                          locking_task_key=export_provider_task.uid).set(queue=worker, routing_key=worker))
 
@@ -222,14 +241,15 @@ class ExportWFSTaskRunner(TaskRunner):
                               .set(queue=worker, routing_key=worker))
 
             if len(export_tasks) > 0:
-                format_tasks = chain(task.get('obj').s(run_uid=run.uid,
-                                                       stage_dir=stage_dir,
-                                                       job_name=job_name,
-                                                       task_uid=task.get('task_uid'),
-                                                       user_details=user_details).set(queue=worker, routing_key=worker)
-                                     for task_name, task
-                                     in
-                                     export_tasks.iteritems() if task is not None)
+                format_tasks = get_format_tasks([task.get('obj').s(run_uid=run.uid,
+                                                                   stage_dir=stage_dir,
+                                                                   job_name=job_name,
+                                                                   task_uid=task.get('task_uid'),
+                                                                   user_details=user_details).set(queue=worker,
+                                                                                                  routing_key=worker)
+                                                 for task_name, task
+                                                 in
+                                                 export_tasks.iteritems() if task is not None], worker=worker)
 
                 task_chain = (task_chain | format_tasks)
 
@@ -325,14 +345,15 @@ class ExportWCSTaskRunner(TaskRunner):
                               .set(queue=worker, routing_key=worker))
 
             if len(export_tasks) > 0:
-                format_tasks = chain(task.get('obj').s(run_uid=run.uid,
-                                                       stage_dir=stage_dir,
-                                                       job_name=job_name,
-                                                       task_uid=task.get('task_uid'),
-                                                       user_details=user_details).set(queue=worker, routing_key=worker)
-                                     for task_name, task
-                                     in
-                                     export_tasks.iteritems() if task is not None)
+                format_tasks = get_format_tasks([task.get('obj').s(run_uid=run.uid,
+                                                                   stage_dir=stage_dir,
+                                                                   job_name=job_name,
+                                                                   task_uid=task.get('task_uid'),
+                                                                   user_details=user_details).set(queue=worker,
+                                                                                                  routing_key=worker)
+                                                 for task_name, task
+                                                 in
+                                                 export_tasks.iteritems() if task is not None], worker=worker)
 
                 task_chain = (task_chain | format_tasks)
 
@@ -430,15 +451,15 @@ class ExportArcGISFeatureServiceTaskRunner(TaskRunner):
                     queue=worker, routing_key=worker))
 
             if len(export_tasks) > 0:
-                format_tasks = chain(task.get('obj').s(run_uid=run.uid,
-                                                       stage_dir=stage_dir,
-                                                       job_name=job_name,
-                                                       task_uid=task.get('task_uid'),
-                                                       user_details=user_details,
-                                                       locking_task_key=export_provider_task.uid).set(queue=worker, routing_key=worker)
-                                     for task_name, task
-                                     in
-                                     export_tasks.iteritems() if task is not None)
+                format_tasks = get_format_tasks([task.get('obj').s(run_uid=run.uid,
+                                                                   stage_dir=stage_dir,
+                                                                   job_name=job_name,
+                                                                   task_uid=task.get('task_uid'),
+                                                                   user_details=user_details).set(queue=worker,
+                                                                                                  routing_key=worker)
+                                                 for task_name, task
+                                                 in
+                                                 export_tasks.iteritems() if task is not None], worker=worker)
 
                 task_chain = (task_chain | format_tasks)
 
@@ -522,6 +543,7 @@ class ExportExternalRasterServiceTaskRunner(TaskRunner):
                                                                  service_url=provider_task.provider.url,
                                                                  level_from=provider_task.provider.level_from,
                                                                  level_to=provider_task.provider.level_to,
+                                                                 max_concurrency=provider_task.provider.max_concurrency,
                                                                  service_type=service_type,
                                                                  user_details=user_details,
                                                                  locking_task_key=export_provider_task.uid).set(queue=worker,
@@ -532,6 +554,23 @@ class ExportExternalRasterServiceTaskRunner(TaskRunner):
             return None, None
 
 
+def get_format_tasks(format_tasks, worker=None):
+    """
+    Format tasks only read the dataset of the provider, so they run side by side as a group, and their results are
+    joined before the provider is zipped and finalized.  They don't take the lock of the provider, since a task waiting
+    for the lock is requeued outside of the group.
+
+    :param format_tasks: A list of signatures of the format tasks.
+    :param worker: The celery worker assigned this task.
+    :return: A celery signature running the format tasks, or None if there are none.
+    """
+    if not format_tasks:
+        return None
+    if len(format_tasks) == 1:
+        return format_tasks[0]
+    return chain(group(format_tasks), join_format_tasks.s().set(queue=worker, routing_key=worker))
+
+
 def create_format_task(task_format):
     task_fq_name = export_task_registry[task_format]
     # instantiate the required class.
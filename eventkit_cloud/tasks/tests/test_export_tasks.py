@@ -6,6 +6,7 @@ import logging
 import os
 import signal
 import sys
+import tempfile
 import uuid
 
 from django.conf import settings
@@ -34,8 +35,8 @@ from ..export_tasks import (
     kml_export_task, external_raster_service_export_task, geopackage_export_task,
     shp_export_task, arcgis_feature_service_export_task, update_progress,
     zip_file_task, pick_up_run_task, cancel_export_provider_task, kill_task, TaskStates, zip_export_provider,
-    bounds_export_task, parse_result, finalize_export_provider_task,
-    FormatTask, wait_for_providers_task, example_finalize_run_hook_task
+    bounds_export_task, parse_result, finalize_export_provider_task, join_format_tasks, get_format_dataset,
+    FormatTask, wait_for_providers_task, example_finalize_run_hook_task, osm_data_collection_pipeline
 )
 
 
@@ -164,17 +165,18 @@ class TestExportTasks(ExportTaskBase):
         self.assertEquals(TaskStates.RUNNING.value, run_task.status)
 
     @patch('eventkit_cloud.tasks.export_tasks.add_metadata_task')
-    @patch('eventkit_cloud.utils.gdalutils.convert')
-    @patch('eventkit_cloud.utils.gdalutils.clip_dataset')
+    @patch('eventkit_cloud.utils.gdalutils.DatasetPipeline')
     @patch('celery.app.task.Task.request')
-    def test_run_gpkg_export_task(self, mock_request, mock_clip, mock_convert, mock_add_metadata_task):
+    def test_run_gpkg_export_task(self, mock_request, mock_pipeline, mock_add_metadata_task):
         celery_uid = str(uuid.uuid4())
         type(mock_request).id = PropertyMock(return_value=celery_uid)
         job_name = self.job.name.lower()
         expected_output_path = os.path.join(os.path.join(settings.EXPORT_STAGING_ROOT.rstrip('\/'), str(self.run.uid)),
                                             '{}.gpkg'.format(job_name))
         expected_provider_slug = "slug"
-        mock_convert.return_value = expected_output_path
+        pipeline = mock_pipeline.return_value
+        pipeline.convert.return_value = pipeline
+        pipeline.run.return_value = {'result': expected_output_path, 'driver': 'gpkg', 'raster': True}
 
         previous_task_result = {'result': expected_output_path}
         stage_dir = settings.EXPORT_STAGING_ROOT + str(self.run.uid) + '/'
@@ -189,25 +191,30 @@ class TestExportTasks(ExportTaskBase):
         result = geopackage_export_task.run(run_uid=self.run.uid, result=previous_task_result, task_uid=str(saved_export_task.uid),
                                             stage_dir=stage_dir, job_name=job_name)
         mock_add_metadata_task.assert_called_once_with(result=result, job_uid=self.run.job.uid, provider_slug=expected_provider_slug)
-        mock_clip.assert_not_called()
-        mock_convert.assert_called_once_with(dataset=expected_output_path, fmt='gpkg',
-                                             task_uid=str(saved_export_task.uid))
-        mock_convert.reset_mock()
+        mock_pipeline.assert_called_once_with(dataset=expected_output_path, driver=None, raster=None,
+                                              task_uid=str(saved_export_task.uid))
+        pipeline.clip.assert_not_called()
+        pipeline.convert.assert_called_once_with('gpkg')
         self.assertEquals(expected_output_path, result['result'])
+        self.assertEquals(('gpkg', True), (result['driver'], result['raster']))
         # test the tasks update_task_state method
         run_task = ExportTaskRecord.objects.get(celery_uid=celery_uid)
         self.assertIsNotNone(run_task)
         self.assertEquals(TaskStates.RUNNING.value, run_task.status)
 
-        mock_clip.return_value = expected_output_path
+        # the selection is clipped in the same pass, with the driver the previous task recorded
+        mock_pipeline.reset_mock()
+        pipeline.clip.return_value = pipeline
         expected_geojson = "test.geojson"
-        previous_task_result = {'result': expected_output_path, "selection": expected_geojson}
+        previous_task_result = {'result': expected_output_path, "selection": expected_geojson, 'driver': 'gtiff',
+                                'raster': True}
         result = geopackage_export_task.run(run_uid=self.run.uid, result=previous_task_result,
                                             task_uid=str(saved_export_task.uid), stage_dir=stage_dir, job_name=job_name)
-        mock_clip.assert_called_once_with(boundary=expected_geojson, in_dataset=expected_output_path,
-                                          fmt=None)
-        mock_convert.assert_called_once_with(dataset=expected_output_path, fmt='gpkg',
-                                             task_uid=str(saved_export_task.uid))
+        mock_pipeline.assert_called_once_with(dataset=expected_output_path, driver='gtiff', raster=True,
+                                              task_uid=str(saved_export_task.uid))
+        pipeline.clip.assert_called_once_with(expected_geojson)
+        pipeline.convert.assert_called_once_with('gpkg')
+        pipeline.run.assert_called_once_with(out_dataset=expected_output_path)
         self.assertEquals(expected_output_path, result['result'])
         self.assertEquals(expected_output_path, result['geopackage'])
 
@@ -555,12 +562,11 @@ class TestExportTasks(ExportTaskBase):
             name="test_task"
         ).uid
         estimated = timezone.now()
-        export_task_instance = Mock(progress=0, estimated_finish=None)
-        export_task.objects.get.return_value = export_task_instance
         update_progress(saved_export_task_uid, progress=50, estimated_finish=estimated)
         mock_close.assert_called_once()
-        self.assertEquals(export_task_instance.progress, 50)
-        self.assertEquals(export_task_instance.estimated_finish, estimated)
+        export_task.objects.filter.assert_called_once_with(uid=saved_export_task_uid)
+        export_task.objects.filter.return_value.update.assert_called_once_with(progress=50,
+                                                                               estimated_finish=estimated)
 
     @patch('eventkit_cloud.tasks.export_tasks.kill_task')
     def test_cancel_task(self, mock_kill_task):
@@ -610,6 +616,24 @@ class TestExportTasks(ExportTaskBase):
         returned_result = parse_result(task_result, "test")
         self.assertEqual(expected_result, returned_result)
 
+    def test_get_format_dataset(self):
+        self.assertEqual('/stage/job.gpkg', get_format_dataset({'result': '/stage/job.gpkg'}, 'gpkg'))
+        self.assertEqual('/stage/job.tif', get_format_dataset({'result': '/stage/job.gpkg'}, 'tif'))
+
+    def test_join_format_tasks(self):
+        shp_result = {'result': 'job_shp.zip', 'status': TaskStates.SUCCESS.value}
+        kml_result = {'result': 'job.kml', 'status': TaskStates.SUCCESS.value}
+        result = join_format_tasks.run(result=[shp_result, None, kml_result])
+        self.assertEqual({'result': 'job.kml', 'status': TaskStates.SUCCESS.value}, result)
+
+        failed_result = {'status': TaskStates.FAILED.value}
+        result = join_format_tasks.run(result=[shp_result, failed_result, kml_result])
+        self.assertEqual(TaskStates.FAILED.value, result['status'])
+
+        canceled_result = {'status': TaskStates.CANCELED.value}
+        result = join_format_tasks.run(result=[canceled_result, failed_result, kml_result])
+        self.assertEqual(TaskStates.CANCELED.value, result['status'])
+
     def test_finalize_export_provider_task(self):
         worker_name = "test_worker"
         task_pid = 55
@@ -919,3 +943,59 @@ class FinalizeRunHookTaskTests(ExportTaskBase):
     @patch('eventkit_cloud.tasks.models.ExportRun')
     def test_finalize_run_hook_task_record_task_state_no_run_uid(self, ExportRun, record_task_state):
         self.assertRaises(ValueError, example_finalize_run_hook_task)
+
+
+class TestOSMDataCollectionPipeline(TestCase):
+
+    def setUp(self, ):
+        self.stage_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, self.stage_dir)
+        self.config = """
+        buildings:
+            select:
+                - building
+        """
+        self.bbox = [-10.85, 6.25, -10.62, 6.40]
+
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    @patch('eventkit_cloud.tasks.export_tasks.land_polygons')
+    @patch('eventkit_cloud.tasks.export_tasks.Geopackage')
+    @patch('eventkit_cloud.tasks.export_tasks.pbf')
+    @patch('eventkit_cloud.tasks.export_tasks.overpass')
+    def test_selection_clipped_before_ingest(self, mock_overpass, mock_pbf, mock_geopackage, mock_land_polygons,
+                                             mock_update_progress):
+        selection = os.path.join(self.stage_dir, 'selection.geojson')
+        with open(selection, 'w') as f:
+            f.write('{"type": "Polygon", "coordinates": '
+                    '[[[-10.85, 6.25], [-10.62, 6.25], [-10.85, 6.40], [-10.85, 6.25]]]}')
+        self.addCleanup(os.remove, selection)
+        geopackage_filepath = os.path.join(self.stage_dir, 'job.gpkg')
+        mock_overpass.Overpass.return_value.run_query.return_value = 'job_query.osm'
+        mock_overpass.Overpass.return_value.clip_bbox = None
+        mock_pbf.OSMToPBF.return_value.convert.return_value = 'job_query.pbf'
+        mock_pbf.PBFExtract.return_value.extract.return_value = 'job_selection.pbf'
+        mock_geopackage.return_value.results = [Mock(parts=[geopackage_filepath])]
+
+        with self.settings(OSM_STREAMING_CONVERSION=False):
+            result = osm_data_collection_pipeline('task_uid', self.stage_dir, job_name='job', bbox=self.bbox,
+                                                  selection=selection, config=self.config)
+
+        self.assertEqual(result, geopackage_filepath)
+        mock_pbf.PBFExtract.assert_called_once_with(pbf='job_query.pbf',
+                                                    pbffile=os.path.join(self.stage_dir, 'job_selection.pbf'),
+                                                    boundary=selection, task_uid='task_uid')
+        # The geopackage is built from the clipped PBF and clipped to the selection polygon, not the bbox.
+        input_pbf, output_gpkg, stage_dir, feature_selection, geom = mock_geopackage.call_args[0]
+        self.assertEqual(input_pbf, 'job_selection.pbf')
+        self.assertEqual(len(geom.coords[0]), 4)
+        mock_land_polygons.add_land_polygons.assert_called_once_with(geopackage_filepath, geom)
+
+        mock_pbf.PBFExtract.reset_mock()
+        mock_land_polygons.add_land_polygons.reset_mock()
+        with self.settings(OSM_STREAMING_CONVERSION=False):
+            osm_data_collection_pipeline('task_uid', self.stage_dir, job_name='job', bbox=self.bbox,
+                                         config=self.config)
+        mock_pbf.PBFExtract.assert_not_called()
+        geom = mock_geopackage.call_args[0][4]
+        self.assertEqual(geom.extent, tuple(self.bbox))
+        mock_land_polygons.add_land_polygons.assert_called_once_with(geopackage_filepath, geom)
@@ -10,7 +10,7 @@ from django.template.loader import get_template
 
 from eventkit_cloud.jobs.models import Job
 from eventkit_cloud.tasks.models import ExportRun
-from eventkit_cloud.tasks.scheduled_tasks import expire_runs, send_warning_email
+from eventkit_cloud.tasks.scheduled_tasks import expire_runs, send_warning_email, update_regional_extracts_task
 from mock import patch
 
 logger = logging.getLogger(__name__)
@@ -99,4 +99,11 @@ class TestEmailNotifications(TestCase):
         alternatives().send.assert_called_once()
 
 
+class TestUpdateRegionalExtractsTask(TestCase):
 
+    @patch('eventkit_cloud.utils.regional_extracts.update_regional_extracts')
+    def test_update_regional_extracts(self, update_regional_extracts):
+        update_regional_extracts.return_value = ['/data/osm/africa.osm.pbf']
+        self.assertEqual('Update Regional Extracts', update_regional_extracts_task.name)
+        self.assertEqual(update_regional_extracts_task.run(), ['/data/osm/africa.osm.pbf'])
+        update_regional_extracts.assert_called_once_with()
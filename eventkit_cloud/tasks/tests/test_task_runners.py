@@ -10,11 +10,14 @@ from django.contrib.gis.geos import GEOSGeometry, Polygon
 from django.test import TestCase
 from django.db.utils import DatabaseError
 
-from eventkit_cloud.jobs.models import ExportFormat, Job, Region, DataProviderTask, DataProvider
+from eventkit_cloud.jobs.models import (ExportFormat, Job, Region, DataProviderTask, DataProvider,
+                                        DataProviderType)
 
 from ..task_runners import (
-    ExportOSMTaskRunner, ExportExternalRasterServiceTaskRunner, create_export_task_record
+    ExportOSMTaskRunner, ExportOSMLocalTaskRunner, ExportExternalRasterServiceTaskRunner, create_export_task_record,
+    get_format_tasks
 )
+from ..export_tasks import osm_local_data_collection_task
 from ..task_factory import create_run
 
 logger = logging.getLogger(__name__)
@@ -68,6 +71,32 @@ class TestExportTaskRunner(TestCase):
         self.assertEquals(len(tasks), 2)
 
 
+    @patch('eventkit_cloud.tasks.task_runners.chain')
+    def test_run_osm_local_task(self, mock_chain):
+        provider = DataProvider.objects.create(
+            name='OSM Local', slug='osm-local', url='liberia.osm.pbf',
+            config=DataProvider.objects.get(slug='osm').config,
+            export_provider_type=DataProviderType.objects.get(type_name='osm-local'))
+        provider_task = DataProviderTask.objects.create(provider=provider)
+        provider_task.formats.add(self.shp_task)
+        self.job.provider_tasks.add(provider_task)
+        run = self.job.runs.first()
+
+        provider_task_record_uid, tasks = ExportOSMLocalTaskRunner().run_task(
+            provider_task_uid=provider_task.uid, run=run, stage_dir='/stage/osm-local', worker="some_worker")
+
+        self.assertEquals(mock_chain.return_value, tasks)
+        data_collection_task, format_task = mock_chain.call_args[0]
+        # The data is extracted from the regional PBF rather than queried from overpass.
+        self.assertEquals(osm_local_data_collection_task.name, data_collection_task.task)
+        self.assertEquals('liberia.osm.pbf', data_collection_task.kwargs['pbf_url'])
+        self.assertNotIn('overpass_url', data_collection_task.kwargs)
+        self.assertEquals(list(run.job.extents), list(data_collection_task.kwargs['bbox']))
+        self.assertEquals('ESRI Shapefile Format', format_task.task)
+        tasks = run.provider_tasks.get(uid=provider_task_record_uid).tasks.all()
+        self.assertEquals(set([osm_local_data_collection_task.name, 'ESRI Shapefile Format']),
+                          set(task.name for task in tasks))
+
     @patch('eventkit_cloud.tasks.task_runners.chain')
     @patch('eventkit_cloud.tasks.export_tasks.shp_export_task')
     def test_run_wms_task(self, mock_shp, mock_chain):
@@ -93,6 +122,25 @@ class TestExportTaskRunner(TestCase):
         run = self.job.runs.first()
         self.assertIsNotNone(run)
 
+    @patch('eventkit_cloud.tasks.task_runners.join_format_tasks')
+    @patch('eventkit_cloud.tasks.task_runners.group')
+    @patch('eventkit_cloud.tasks.task_runners.chain')
+    def test_get_format_tasks(self, mock_chain, mock_group, mock_join):
+        shp_task = Mock()
+        kml_task = Mock()
+        join_task = mock_join.s.return_value.set.return_value
+
+        self.assertIsNone(get_format_tasks([], worker="some_worker"))
+        self.assertEquals(shp_task, get_format_tasks([shp_task], worker="some_worker"))
+        mock_chain.assert_not_called()
+
+        # Several formats run as a group, which is joined before the next task.
+        format_tasks = get_format_tasks([shp_task, kml_task], worker="some_worker")
+        self.assertEquals(mock_chain.return_value, format_tasks)
+        mock_group.assert_called_once_with([shp_task, kml_task])
+        mock_join.s.return_value.set.assert_called_once_with(queue="some_worker", routing_key="some_worker")
+        mock_chain.assert_called_once_with(mock_group.return_value, join_task)
+
     @patch('eventkit_cloud.tasks.task_runners.ExportTaskRecord')
     def test_create_export_task_record(self, mock_export_task):
         from ..export_tasks import TaskStates
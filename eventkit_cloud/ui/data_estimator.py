@@ -1,44 +1,243 @@
+import hashlib
+import json
+import math
+
+import numpy
 from mapproxy import srs as mapproxy_srs
 from mapproxy import grid as mapproxy_grid
 from eventkit_cloud.jobs.models import DataProvider
+from django.core.cache import caches
 from django.core.exceptions import ObjectDoesNotExist
 
+# The estimates are cached, since the UI asks for them each time the area of interest changes.
+cache = caches['default']
+TILE_COUNT_TIMEOUT = 60 * 60 * 24
+BYTES_PER_TILE_TIMEOUT = 60 * 60
+
+# Levels with more tiles than this in the bounding box of the selection are estimated from the coarser levels.
+MAX_COUNTED_TILES = 1 << 20
+
+# The number of recent raster exports of a provider its size per tile is learned from.
+BYTES_PER_TILE_SAMPLES = 20
+RASTER_TASK_NAME = 'Raster export (.gpkg)'
+
+# Web mercator doesn't reach the poles.
+MAX_MERCATOR_LATITUDE = 85.0511287798
 
-def get_size_estimate(provider, bbox, srs='3857'):
+# Tiles the selection only touches within this fraction of a tile aren't counted.
+TILE_EPSILON = 1e-7
+
+
+def get_size_estimate(provider, bbox=None, srs='3857', geometry=None):
     """
     Args:
         provider: The name of the provider, corresponds to the name field in Export Provider model
         bbox: A bbox in the format of an array
         srs: An EPSG code for the map being used.
+        geometry: The selection as a GeoJSON geometry in EPSG:4326, defaults to the bbox.
 
-    Returns: Estimated size in GB
+    Returns: The number of tiles, the estimated size in GB and the number of tiles of each level.
     """
     try:
         provider = DataProvider.objects.get(name=provider)
     except ObjectDoesNotExist:
         return None
-    levels = range(provider.level_from, provider.level_to+1)
-    req_srs = mapproxy_srs.SRS(srs)
-    bbox = mapproxy_grid.grid_bbox(bbox, mapproxy_srs.SRS(4326), req_srs)
+    if geometry is None:
+        geometry = get_bbox_geometry(bbox)
+    tiles = get_tile_counts(geometry, provider.level_from, provider.level_to, srs)
+    total_tiles = sum(tiles)
+    return [total_tiles, get_gb_estimate(total_tiles, bytes_per_tile=get_bytes_per_tile(provider)), tiles]
 
-    tile_size = (256, 256)
-    tile_grid = mapproxy_grid.TileGrid(srs, tile_size=tile_size, levels=len(levels))
-    total_tiles = 0
-    tiles = []
-    for level in levels:
-        # get_affected_level_tiles() returns a list with three
-        # things: first a tuple with the bounding box, second
-        # the height and width in tiles, and third a list of tile
-        # coordinate tuples. result[1] gives the tuple with
-        # the width/height of the desired set of tiles.
-        result = tile_grid.get_affected_level_tiles(bbox, int(level))
-        total_tiles += result[1][0] * result[1][1]
-        tiles.append(result[1][0] * result[1][1])
-    return [total_tiles, get_gb_estimate(total_tiles), tiles]
-
-
-def get_gb_estimate(total_tiles, tile_width=256, tile_height=256):
+
+def get_gb_estimate(total_tiles, tile_width=256, tile_height=256, bytes_per_tile=None):
+    if bytes_per_tile:
+        return total_tiles * bytes_per_tile / 1024.0 ** 3
     # the literal number there is the average pixels/GB ratio for tiles.
     gigs_per_pixel_constant = 0.0000000006
     return total_tiles*tile_width*tile_height*gigs_per_pixel_constant
 
+
+def get_bytes_per_tile(provider):
+    """
+    Learns the average size of a tile of the provider from its recent raster exports.
+
+    Args:
+        provider: A DataProvider.
+
+    Returns: The average bytes per tile, or None if the provider has no completed raster exports.
+    """
+    from eventkit_cloud.tasks.models import FileProducingTaskResult
+
+    key = 'tile_bytes_{0}'.format(provider.slug)
+    bytes_per_tile = cache.get(key)
+    if bytes_per_tile is not None:
+        return bytes_per_tile or None
+    total_bytes = 0
+    total_tiles = 0
+    results = FileProducingTaskResult.objects.filter(
+        export_task__name=RASTER_TASK_NAME, export_task__export_provider_task__slug=provider.slug, size__gt=0
+    ).select_related('export_task__export_provider_task__run__job').order_by('-id')[:BYTES_PER_TILE_SAMPLES]
+    for result in results:
+        the_geom = result.export_task.export_provider_task.run.job.the_geom
+        if the_geom is None:
+            continue
+        tiles = sum(get_tile_counts(json.loads(the_geom.geojson), provider.level_from, provider.level_to))
+        if tiles:
+            # Sizes are stored in MB.
+            total_bytes += result.size * 1024 * 1024
+            total_tiles += tiles
+    bytes_per_tile = float(total_bytes) / total_tiles if total_tiles else 0
+    cache.set(key, bytes_per_tile, BYTES_PER_TILE_TIMEOUT)
+    return bytes_per_tile or None
+
+
+def get_bbox_geometry(bbox):
+    west, south, east, north = bbox
+    return {'type': 'Polygon', 'coordinates': [[[west, south], [east, south], [east, north], [west, north],
+                                                [west, south]]]}
+
+
+def get_tile_counts(geometry, level_from, level_to, srs='3857'):
+    """
+    Counts the tiles of each level which intersect the selection.
+
+    Args:
+        geometry: A GeoJSON Polygon or MultiPolygon in EPSG:4326.
+        level_from: The first level.
+        level_to: The last level.
+        srs: An EPSG code of the tile grid.
+
+    Returns: A list with the number of tiles of each level.
+    """
+    key = 'tile_count_{0}'.format(hashlib.sha1(json.dumps(
+        [geometry, level_from, level_to, str(srs)], sort_keys=True)).hexdigest())
+    tiles = cache.get(key)
+    if tiles is None:
+        tiles = count_tiles(geometry, level_from, level_to, srs)
+        cache.set(key, tiles, TILE_COUNT_TIMEOUT)
+    return tiles
+
+
+def count_tiles(geometry, level_from, level_to, srs='3857'):
+    req_srs = mapproxy_srs.SRS(srs)
+    tile_size = (256, 256)
+    tile_grid = mapproxy_grid.TileGrid(srs, tile_size=tile_size, levels=level_to + 1)
+    rings = get_rings(geometry, req_srs)
+    edges = numpy.concatenate([numpy.hstack([ring[:-1], ring[1:]]) for ring in rings])
+    points = numpy.concatenate(rings)
+    ring_area = sum(abs(numpy.dot(ring[:-1, 0], ring[1:, 1]) - numpy.dot(ring[1:, 0], ring[:-1, 1])) / 2
+                    for ring in rings)
+    # Holes are measured as if they were filled, the boundary term absorbs the difference.
+    perimeter = numpy.hypot(edges[:, 2] - edges[:, 0], edges[:, 3] - edges[:, 1]).sum()
+
+    tiles = []
+    boundary_factor = 2 / math.pi
+    for level in range(level_from, level_to + 1):
+        span = tile_grid.resolution(level) * tile_size[0]
+        origin = numpy.array(tile_grid.bbox[:2])
+        cells = (points - origin) / span
+        columns = numpy.ceil(cells[:, 0].max()) - numpy.floor(cells[:, 0].min())
+        rows = numpy.ceil(cells[:, 1].max()) - numpy.floor(cells[:, 1].min())
+        if columns * rows <= MAX_COUNTED_TILES:
+            count = count_intersecting_cells((edges - numpy.tile(origin, 2)) / span)
+            if perimeter:
+                # Calibrates the estimate of the finer levels to the shape of the selection.
+                boundary_factor = (count - ring_area / span ** 2) / (perimeter / span)
+        else:
+            count = int(round(ring_area / span ** 2 + boundary_factor * perimeter / span))
+            count = min(max(count, 1), int(columns * rows))
+        tiles.append(int(count))
+    return tiles
+
+
+def get_rings(geometry, req_srs):
+    """
+    Returns: The rings of a GeoJSON Polygon or MultiPolygon in EPSG:4326 as arrays of points in req_srs.
+    """
+    if geometry.get('type') == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise ValueError('Only Polygon and MultiPolygon selections can be estimated.')
+    geographic = mapproxy_srs.SRS(4326)
+    rings = []
+    for polygon in polygons:
+        for ring in polygon:
+            ring = [(x, y) for x, y in (point[:2] for point in ring)]
+            if not req_srs.is_latlong:
+                ring = [(x, max(-MAX_MERCATOR_LATITUDE, min(MAX_MERCATOR_LATITUDE, y))) for x, y in ring]
+                ring = list(geographic.transform_to(req_srs, ring))
+            ring = numpy.array(ring, dtype=float)
+            if len(ring) and tuple(ring[0]) != tuple(ring[-1]):
+                ring = numpy.vstack([ring, ring[:1]])
+            rings.append(ring)
+    return rings
+
+
+def count_intersecting_cells(edges):
+    """
+    Counts the unit cells of a grid which intersect a polygon.
+
+    A cell intersects the polygon if an edge passes through it, or else if its center is inside the polygon.  Both are
+    computed for every cell of each row the polygon covers at once: the edges are clipped to each row they cross, and
+    the inside of the polygon at the middle of each row is found from where the edges cross it.
+
+    Args:
+        edges: An array of the x0, y0, x1, y1 of each edge of the rings of the polygon, in cell units.
+
+    Returns: The number of cells.
+    """
+    x0, y0, x1, y1 = edges.T
+    min_row = int(numpy.floor(min(y0.min(), y1.min())))
+    max_row = int(numpy.floor(max(y0.max(), y1.max())))
+    min_column = int(numpy.floor(min(x0.min(), x1.min())))
+    max_column = int(numpy.floor(max(x0.max(), x1.max())))
+    marks = numpy.zeros((max_row - min_row + 1, max_column - min_column + 2), dtype=numpy.int32)
+    dx = x1 - x0
+    dy = y1 - y0
+
+    # The cells each edge passes through, for every row it crosses.
+    first = numpy.floor(numpy.minimum(y0, y1) + TILE_EPSILON).astype(int)
+    last = numpy.ceil(numpy.maximum(y0, y1) - TILE_EPSILON).astype(int) - 1
+    edge, row = repeat_ranges(first, last)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        start = numpy.clip((row - y0[edge]) / dy[edge], 0, 1)
+        end = numpy.clip((row + 1 - y0[edge]) / dy[edge], 0, 1)
+    flat = dy[edge] == 0
+    start[flat], end[flat] = 0, 1
+    xs = x0[edge] + start * dx[edge]
+    xe = x0[edge] + end * dx[edge]
+    mark(marks, row - min_row, numpy.floor(numpy.minimum(xs, xe) + TILE_EPSILON).astype(int) - min_column,
+         numpy.ceil(numpy.maximum(xs, xe) - TILE_EPSILON).astype(int) - 1 - min_column)
+
+    # The cells whose center is inside the polygon, between pairs of crossings of the middle of their row.
+    first = numpy.ceil(numpy.minimum(y0, y1) - 0.5).astype(int)
+    last = numpy.ceil(numpy.maximum(y0, y1) - 0.5).astype(int) - 1
+    edge, row = repeat_ranges(first, last)
+    crossing = x0[edge] + (row + 0.5 - y0[edge]) * dx[edge] / dy[edge]
+    order = numpy.lexsort((crossing, row))
+    crossing, row = crossing[order], row[order]
+    mark(marks, row[0::2] - min_row, numpy.ceil(crossing[0::2] - 0.5).astype(int) - min_column,
+         numpy.floor(crossing[1::2] - 0.5).astype(int) - min_column)
+
+    return int((numpy.cumsum(marks, axis=1)[:, :-1] > 0).sum())
+
+
+def repeat_ranges(first, last):
+    """
+    Returns: The index of each range and each of its values, for the ranges from first to last inclusive.
+    """
+    lengths = numpy.maximum(last - first + 1, 0)
+    index = numpy.repeat(numpy.arange(len(first)), lengths)
+    offsets = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    return index, first[index] + offsets
+
+
+def mark(marks, rows, start, end):
+    """
+    Marks the cells from start to end inclusive of each row, as the differences of a running sum along the rows.
+    """
+    valid = end >= start
+    numpy.add.at(marks, (rows[valid], start[valid]), 1)
+    numpy.add.at(marks, (rows[valid], end[valid] + 1), -1)
@@ -3,27 +3,101 @@ import logging
 
 from django.test import TestCase
 
-from ..data_estimator import get_size_estimate, get_gb_estimate
+from ..data_estimator import get_size_estimate, get_gb_estimate, get_bytes_per_tile, get_tile_counts, \
+    count_intersecting_cells
 from mock import Mock, patch
+import numpy
 
 logger = logging.getLogger(__name__)
 
 
+def get_edges(ring):
+    return numpy.array([list(start) + list(end) for start, end in zip(ring[:-1], ring[1:])], dtype=float)
+
+
 class TestDataEstimation(TestCase):
 
+    def setUp(self):
+        self.cache = {}
+        patcher = patch('eventkit_cloud.ui.data_estimator.cache')
+        mock_cache = patcher.start()
+        mock_cache.get.side_effect = self.cache.get
+        mock_cache.set.side_effect = lambda key, value, timeout: self.cache.update({key: value})
+        self.addCleanup(patcher.stop)
+
     def test_get_gb_estimate(self):
         expected_return_value = 0.0001572864
         actual_return_value = get_gb_estimate(4)
         self.assertAlmostEqual(expected_return_value, actual_return_value, places=9)
+        self.assertAlmostEqual(get_gb_estimate(4, bytes_per_tile=1024 ** 2), 4 / 1024.0)
 
+    @patch('eventkit_cloud.ui.data_estimator.get_bytes_per_tile')
     @patch('eventkit_cloud.ui.data_estimator.get_gb_estimate')
     @patch('eventkit_cloud.ui.data_estimator.DataProvider')
-    def test_get_size_estimate(self, export_provider, get_estimate):
+    def test_get_size_estimate(self, export_provider, get_estimate, get_bytes_per_tile):
         provider_name = "Test_name"
         get_estimate.return_value = 4
+        get_bytes_per_tile.return_value = None
         export_provider.objects.get.return_value = Mock(level_from=0, level_to=1)
         returned_values = get_size_estimate(provider_name, bbox=[-1, -1, 0, 0])
         export_provider.objects.get.assert_called_once_with(name=provider_name)
+        get_estimate.assert_called_once_with(2, bytes_per_tile=None)
         # two tiles, an arbritary value of four from the mock, one tile per level represented in array.
         expected_values = [2, 4, [1, 1]]
         self.assertEquals(returned_values, expected_values)
+
+        # only the tiles the selection covers are counted, its bbox covers four tiles of the last level
+        triangle = {'type': 'Polygon', 'coordinates': [[[0.1, 0.1], [89.9, 0.1], [0.1, 66.4], [0.1, 0.1]]]}
+        export_provider.objects.get.return_value = Mock(level_from=0, level_to=3)
+        self.assertEquals(get_size_estimate(provider_name, geometry=triangle)[2], [1, 1, 1, 3])
+
+    @patch('eventkit_cloud.ui.data_estimator.count_tiles')
+    def test_get_tile_counts(self, count_tiles):
+        count_tiles.return_value = [1, 4]
+        bbox = {'type': 'Polygon', 'coordinates': [[[-1, -1], [0, -1], [0, 0], [-1, 0], [-1, -1]]]}
+        self.assertEqual(get_tile_counts(bbox, 0, 1), [1, 4])
+        self.assertEqual(get_tile_counts(bbox, 0, 1), [1, 4])
+        count_tiles.assert_called_once_with(bbox, 0, 1, '3857')
+
+    def test_count_intersecting_cells(self):
+        # an L shaped selection, with an edge only touching the cells above it
+        ring = [(0.5, 0.5), (3, 0.5), (3, 1), (1.5, 1), (1.5, 3.5), (0.5, 3.5), (0.5, 0.5)]
+        self.assertEqual(count_intersecting_cells(get_edges(ring)), 9)
+        # the middle cell of the diagonal is only crossed at its corners
+        ring = [(0, 0), (3, 0), (0, 3), (0, 0)]
+        self.assertEqual(count_intersecting_cells(get_edges(ring)), 6)
+        # a hole leaves out the cells it covers
+        hole = [(2, 2), (2, 8), (8, 8), (8, 2), (2, 2)]
+        edges = numpy.vstack([get_edges([(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]), get_edges(hole)])
+        self.assertEqual(count_intersecting_cells(edges), 64)
+
+    @patch('eventkit_cloud.ui.data_estimator.MAX_COUNTED_TILES', 4096)
+    def test_count_tiles_estimated(self):
+        triangle = {'type': 'Polygon', 'coordinates': [[[-10, -10], [10, -10], [0, 10], [-10, -10]]]}
+        tiles = get_tile_counts(triangle, 9, 12)
+        self.assertEqual(tiles[:2], [480, 1740])
+        # the levels too large to count are estimated from the area and perimeter of the selection
+        self.assertAlmostEqual(tiles[2] / 6762.0, 1, places=2)
+        self.assertAlmostEqual(tiles[3] / 26520.0, 1, places=2)
+
+    @patch('eventkit_cloud.ui.data_estimator.get_tile_counts')
+    @patch('eventkit_cloud.tasks.models.FileProducingTaskResult')
+    def test_get_bytes_per_tile(self, task_result, tile_counts):
+        provider = Mock(slug='imagery', level_from=0, level_to=1)
+        results = task_result.objects.filter.return_value.select_related.return_value.order_by.return_value
+        results.__getitem__ = Mock(return_value=[])
+        self.assertIsNone(get_bytes_per_tile(provider))
+
+        self.cache.clear()
+        geometry = Mock(geojson='{"type": "Polygon", "coordinates": []}')
+        result = Mock(size=2)
+        result.export_task.export_provider_task.run.job.the_geom = geometry
+        results.__getitem__ = Mock(return_value=[result, result])
+        tile_counts.side_effect = [[1, 3], [2, 2]]
+        self.assertEqual(get_bytes_per_tile(provider), 4 * 1024 * 1024 / 8.0)
+        task_result.objects.filter.assert_called_with(export_task__name='Raster export (.gpkg)',
+                                                      export_task__export_provider_task__slug='imagery', size__gt=0)
+        tile_counts.assert_called_with({'type': 'Polygon', 'coordinates': []}, 0, 1)
+        # learned sizes are cached
+        self.assertEqual(get_bytes_per_tile(provider), 4 * 1024 * 1024 / 8.0)
+        self.assertEqual(tile_counts.call_count, 2)
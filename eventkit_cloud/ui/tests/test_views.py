@@ -102,6 +102,13 @@ class TestUIViews(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(float(response.content), 0.000123)
 
+        geometry = {'type': 'Polygon', 'coordinates': [[[-43.2, -22.9], [-43.1, -22.9], [-43.2, -22.8], [-43.2, -22.9]]]}
+        response = self.client.post('/estimator',
+                          data=json.dumps({'providers': ['ESRI-Imagery'], 'geometry': geometry}),
+                          content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        get_estimate.assert_called_with('ESRI-Imagery', None, geometry=geometry)
+
         response = self.client.post('/estimator', data=json.dumps({}), content_type='application/json')
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.content, 'Providers or BBOX were not supplied in the request')
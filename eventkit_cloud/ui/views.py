@@ -222,17 +222,19 @@ def data_estimator(request):
     """
 
     :param request: Example {'providers': ['ESRI-Imagery'], 'bbox': [-43.238239, -22.933733, -43.174725, -22.892623]}
+        The selection can be given as a GeoJSON 'geometry' instead of the bbox, to count only the tiles it covers.
     :return: HttpResponse, with the size.
     """
     request_data = json.loads(request.body)
     size = 0
     providers = request_data.get('providers')
     bbox = request_data.get('bbox')
-    if not providers and not bbox:
+    geometry = request_data.get('geometry')
+    if not providers or not (bbox or geometry):
         return HttpResponse("Providers or BBOX were not supplied in the request", status=400)
 
     for provider in providers:
-        estimates = get_size_estimate(provider, bbox)
+        estimates = get_size_estimate(provider, bbox, geometry=geometry)
         size += estimates[1]
     return HttpResponse([size], status=200)
 
@@ -2,9 +2,8 @@ from __future__ import absolute_import
 
 import logging
 import os
-import subprocess
 from string import Template
-from ..tasks.task_process import TaskProcess
+from .gdalutils import run_gdal
 
 logger = logging.getLogger(__name__)
 
@@ -64,9 +63,7 @@ class ArcGISFeatureServiceToGPKG(object):
         if self.debug:
             logger.debug('Running: %s' % convert_cmd)
 
-        task_process = TaskProcess(task_uid=self.task_uid)
-        task_process.start_process(convert_cmd, shell=True, executable='/bin/sh',
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        task_process = run_gdal(convert_cmd, task_uid=self.task_uid, executable='/bin/sh')
 
         if task_process.exitcode != 0:
             logger.error('%s', task_process.stderr)
@@ -9,17 +9,20 @@ from mapproxy.config.loader import ProxyConfiguration, ConfigurationError, valid
 from mapproxy.config.spec import validate_options
 
 from mapproxy.config.config import load_config, base_config, load_default_config
-from mapproxy.seed import seeder
-from mapproxy.seed.util import ProgressLog
+from mapproxy.seed.util import ProgressLog, ProgressStore
 from django.conf import settings
 import yaml
 from django.core.files.temp import NamedTemporaryFile
 import logging
+import os
+import time
 from django.db import connections
 import requests
 from pysqlite2 import dbapi2 as sqlite3
 from .geopackage import (get_tile_table_names, get_zoom_levels_table,
                          get_table_tile_matrix_information, set_gpkg_contents_bounds)
+from .seed_concurrency import ConcurrencyController, seed as seed_adaptive
+from .tile_cache import TILE_TABLE, TileCache
 
 logger = logging.getLogger(__name__)
 
@@ -29,17 +32,26 @@ class CustomLogger(ProgressLog):
 
         self.task_uid = task_uid
         super(CustomLogger, self).__init__(*args, **kwargs)
-        # Log mapproxy status but allow a setting to reduce database writes.
-        self.log_step_step = 1
-        self.log_step_counter = self.log_step_step
+        # Log mapproxy status but only write it to the database every PROGRESS_UPDATE_INTERVAL seconds, or when it
+        # has advanced by PROGRESS_UPDATE_DELTA percent.
+        self.update_interval = float(getattr(settings, 'PROGRESS_UPDATE_INTERVAL', 10))
+        self.update_delta = float(getattr(settings, 'PROGRESS_UPDATE_DELTA', 1))
+        self.last_update = None
+        self.last_progress = None
+        # The part of the export being seeded, when it's seeded in parts.
+        self.progress_offset = 0.0
+        self.progress_scale = 1.0
 
     def log_step(self, progress):
         from ..tasks.export_tasks import update_progress
         if self.task_uid:
-            if self.log_step_counter == 0:
-                update_progress(self.task_uid, progress=progress.progress * 100)
-                self.log_step_counter = self.log_step_step
-            self.log_step_counter -= 1
+            percent = (self.progress_offset + self.progress_scale * progress.progress) * 100
+            now = time.time()
+            if self.last_progress is None or abs(percent - self.last_progress) >= self.update_delta or \
+                    (percent != self.last_progress and now - self.last_update >= self.update_interval):
+                update_progress(self.task_uid, progress=percent)
+                self.last_update = now
+                self.last_progress = percent
         super(CustomLogger, self).log_step(progress)
 
 
@@ -49,13 +61,15 @@ class ExternalRasterServiceToGeopackage(object):
     """
 
     def __init__(self, config=None, gpkgfile=None, bbox=None, service_url=None, layer=None, debug=None, name=None,
-                 level_from=None, level_to=None, service_type=None, task_uid=None, selection=None):
+                 level_from=None, level_to=None, service_type=None, task_uid=None, selection=None,
+                 max_concurrency=None):
         """
         Initialize the ExternalServiceToGeopackage utility.
 
         Args:
             gpkgfile: where to write the gpkg output
             debug: turn debugging on / off
+            max_concurrency: the most requests to make to the service at once
         """
         self.gpkgfile = gpkgfile
         self.bbox = bbox
@@ -69,6 +83,8 @@ class ExternalRasterServiceToGeopackage(object):
         self.service_type = service_type
         self.task_uid = task_uid
         self.selection = selection
+        self.max_concurrency = max_concurrency
+        self.tile_cache = None
 
     def build_config(self):
         pass
@@ -95,9 +111,15 @@ class ExternalRasterServiceToGeopackage(object):
         try:
             conf_dict['caches']['cache']['cache']['filename'] = self.gpkgfile
         except KeyError:
-            conf_dict['caches']['cache'] = get_cache_template(["{0}_{1}".format(self.layer, self.service_type)],
-                                                              [grids for grids in conf_dict.get('grids')],
-                                                              self.gpkgfile, table_name=self.layer)
+            sources = ["{0}_{1}".format(self.layer, self.service_type)]
+            grids = [grids for grids in conf_dict.get('grids')]
+            # Seed from the shared cache of the provider, which only requests missing or expired tiles from it.
+            self.tile_cache = TileCache.from_settings(self.name)
+            if self.tile_cache:
+                conf_dict['caches']['shared_cache'] = get_cache_template(sources, grids, self.tile_cache.filename,
+                                                                         table_name=TILE_TABLE)
+                sources = ['shared_cache']
+            conf_dict['caches']['cache'] = get_cache_template(sources, grids, self.gpkgfile, table_name=self.layer)
 
         conf_dict['services'] = ['demo']
 
@@ -151,24 +173,43 @@ class ExternalRasterServiceToGeopackage(object):
         """
 
         from ..tasks.task_process import TaskProcess
-        from .geopackage import remove_empty_zoom_levels
+        from .geopackage import remove_blank_tiles, remove_empty_zoom_levels
+
+        # MapProxy checkpoints the seeding progress of each level next to the geopackage, so that a failed or
+        # retried export continues where it stopped instead of walking the levels it already seeded again.
+        checkpoint = get_checkpoint_file(self.gpkgfile)
 
         conf_dict, seed_configuration, mapproxy_configuration = self.get_check_config()
 
         logger.info("Beginning seeding to {0}".format(self.gpkgfile))
         try:
             check_service(conf_dict)
-            progress_logger = CustomLogger(verbose=True, task_uid=self.task_uid)
-            task_process = TaskProcess(task_uid=self.task_uid)
-            task_process.start_process(billiard=True, target=seeder.seed,
-                                       kwargs={"tasks": seed_configuration.seeds(['seed']),
-                                               "concurrency": int(getattr(settings, 'MAPPROXY_CONCURRENCY', 1)),
-                                               "progress_logger": progress_logger})
+            if self.tile_cache:
+                seed_start = self.tile_cache.prepare()
+            attempts = int(getattr(settings, 'MAPPROXY_SEED_RETRIES', 2)) + 1
+            for attempt in range(attempts):
+                progress_store = ProgressStore(checkpoint, continue_seed=True)
+                progress_logger = CustomLogger(verbose=True, task_uid=self.task_uid, progress_store=progress_store)
+                controller = ConcurrencyController(self.name, self.max_concurrency)
+                task_process = TaskProcess(task_uid=self.task_uid)
+                task_process.start_process(billiard=True, target=seed_adaptive,
+                                           kwargs={"tasks": seed_configuration.seeds(['seed']),
+                                                   "controller": controller,
+                                                   "progress_logger": progress_logger})
+                if task_process.exitcode == 0:
+                    break
+                if attempt + 1 < attempts:
+                    logger.warn("Seeding {0} failed, resuming from the last checkpoint.".format(self.gpkgfile))
             check_zoom_levels(self.gpkgfile, mapproxy_configuration)
-            remove_empty_zoom_levels(self.gpkgfile)
             set_gpkg_contents_bounds(self.gpkgfile, self.layer, self.bbox)
             if task_process.exitcode != 0:
                 raise Exception("The Raster Service failed to complete, please contact an administrator.")
+            if os.path.isfile(checkpoint):
+                os.remove(checkpoint)
+            if self.tile_cache:
+                self.tile_cache.record(self.gpkgfile, seed_start)
+            remove_blank_tiles(self.gpkgfile)
+            remove_empty_zoom_levels(self.gpkgfile)
         except Exception:
             logger.error("Export failed for url {}.".format(self.service_url))
             raise
@@ -232,6 +273,14 @@ def get_seed_template(bbox=None, level_from=None, level_to=None, coverage_file=N
     return seed_template
 
 
+def get_checkpoint_file(gpkg):
+    """
+    :param gpkg: The geopackage being seeded.
+    :return: The file MapProxy checkpoints the seeding progress of the geopackage in.
+    """
+    return '{0}.seed_progress'.format(gpkg)
+
+
 def create_conf_from_url(service_url):
     temp_file = NamedTemporaryFile()
     params = ['--capabilities', service_url, '--output', temp_file.name, '--force']
@@ -1,13 +1,247 @@
 # -*- coding: utf-8 -*-
+from billiard import Pipe
 from osgeo import gdal, ogr
 import logging
+import multiprocessing
 import os
+import shlex
 import subprocess
+import time
 from string import Template
+from django.conf import settings
 from ..tasks.task_process import TaskProcess
 
 logger = logging.getLogger(__name__)
 
+# Bounds of the warp memory and block cache of each task in MB, GDAL gains little from more.
+MIN_RASTER_MEMORY = 64
+MAX_RASTER_MEMORY = 2048
+
+# The child process sends at most this much of an error, more could block it until the parent reads it after it exits.
+MAX_ERROR_LENGTH = 4096
+
+
+def get_raster_profile():
+    """
+    Returns the threads, warp memory and block cache in MB each raster task of a worker uses.
+    The defaults share the cores and half of the memory of the host between the tasks the worker runs at once.
+    """
+    tasks = max(1, int(getattr(settings, 'RASTER_WORKER_TASKS', 1)))
+    threads = getattr(settings, 'RASTER_THREADS', None) or max(1, multiprocessing.cpu_count() // tasks)
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        memory = 0
+    # Half of the memory goes to the warp buffers and block caches of the tasks, a quarter to each.
+    default_memory = min(MAX_RASTER_MEMORY, max(MIN_RASTER_MEMORY, memory // (4 * tasks)))
+    return {'threads': threads,
+            'warp_memory': int(getattr(settings, 'RASTER_WARP_MEMORY', None) or default_memory),
+            'cache_max': int(getattr(settings, 'RASTER_CACHE_MAX', None) or default_memory)}
+
+
+def get_raster_options(warp=True, **profile):
+    """
+    Returns the options for gdalwarp, or gdal_translate if not warp, to run with the raster profile.
+    :param warp: True for gdalwarp options
+    :param profile: threads, warp_memory or cache_max to use instead of the configured ones
+    :return: The options as a string
+    """
+    options = get_raster_profile()
+    options.update(profile)
+    cmd = "--config GDAL_NUM_THREADS {threads} --config GDAL_CACHEMAX {cache_max}"
+    if warp:
+        cmd = "-multi -wo NUM_THREADS={threads} -wm {warp_memory} " + cmd
+    return cmd.format(**options)
+
+
+# The GDAL python functions which do the work of the command line utilities.
+GDAL_UTILITIES = {'ogr2ogr': 'VectorTranslate', 'gdalwarp': 'Warp', 'gdal_translate': 'Translate'}
+
+# The number of values each option of the utilities takes, commands with other options are run in a shell.
+GDAL_OPTION_VALUES = {
+    'ogr2ogr': {'-f': 1, '-update': 0, '-append': 0, '-overwrite': 0, '-skipfailures': 0, '-progress': 0,
+                '-spat': 4, '-spat_srs': 1, '-clipsrc': 1, '-clipdst': 1, '-t_srs': 1, '-s_srs': 1, '-a_srs': 1,
+                '-lco': 1, '-dsco': 1, '-oo': 1, '-nln': 1, '-nlt': 1, '-sql': 1, '-where': 1, '-select': 1,
+                '-gt': 1},
+    'gdalwarp': {'-of': 1, '-ot': 1, '-co': 1, '-wo': 1, '-wm': 1, '-multi': 0, '-overwrite': 0, '-cutline': 1,
+                 '-crop_to_cutline': 0, '-dstalpha': 0, '-srcnodata': 1, '-dstnodata': 1, '-t_srs': 1, '-s_srs': 1,
+                 '-te': 4, '-tr': 2, '-ts': 2, '-r': 1},
+    'gdal_translate': {'-of': 1, '-ot': 1, '-co': 1, '-projwin': 4, '-outsize': 2, '-b': 1, '-a_srs': 1,
+                       '-a_nodata': 1},
+}
+
+SHELL_OPERATORS = ['|', '||', '&', '&&', ';', '<', '>', '>>']
+
+
+def run_gdal(cmd, task_uid=None, executable='/bin/bash', progress_offset=0.0, progress_scale=1.0):
+    """
+    Runs an ogr2ogr, gdalwarp or gdal_translate command.
+    Unless GDAL_IN_PROCESS is off the command runs through the GDAL python bindings in a child process, which reports
+    its progress to the task and stops when the task is canceled.  Other commands run in a shell.
+    :param cmd: The command line
+    :param task_uid: A task uid to update
+    :param executable: The shell to run commands the bindings can't run with
+    :param progress_offset: The fraction of the task done before the command starts
+    :param progress_scale: The fraction of the task the command makes up
+    :return: The TaskProcess which ran the command
+    """
+    command = parse_gdal_command(cmd) if getattr(settings, 'GDAL_IN_PROCESS', True) else None
+    task_process = TaskProcess(task_uid=task_uid)
+    if command:
+        receiver, sender = Pipe(duplex=False)
+        try:
+            task_process.start_process(billiard=True, target=execute_gdal_command,
+                                       kwargs={'command': command, 'task_uid': task_uid, 'error_pipe': sender,
+                                               'progress_offset': progress_offset, 'progress_scale': progress_scale})
+            # Like the shell commands, the error of a failed command is the stderr of the process.
+            if receiver.poll():
+                task_process.stderr = receiver.recv()
+        finally:
+            sender.close()
+            receiver.close()
+    else:
+        task_process.start_process(cmd, shell=True, executable=executable,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return task_process
+
+
+def parse_gdal_command(cmd):
+    """
+    Splits a command line of a GDAL utility into the arguments of its GDAL python function.
+    :param cmd: The command line
+    :return: A dict with the utility, options, config options, sources and destination, or None if the command can't
+    be run through the bindings.
+    """
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not args or args[0] not in GDAL_UTILITIES or any(arg in SHELL_OPERATORS for arg in args):
+        return None
+    utility = args[0]
+    option_values = GDAL_OPTION_VALUES[utility]
+    options = []
+    config = {}
+    positional = []
+    index = 1
+    while index < len(args):
+        arg = args[index]
+        if arg == '--config':
+            if index + 2 >= len(args):
+                return None
+            config[args[index + 1]] = args[index + 2]
+            index += 3
+        elif arg.startswith('-') and not is_number(arg):
+            if arg not in option_values:
+                return None
+            count = option_values[arg]
+            # -clipsrc takes a bbox or a datasource
+            bbox = args[index + 1:index + 5]
+            if arg == '-clipsrc' and len(bbox) == 4 and all(is_number(value) for value in bbox):
+                count = 4
+            if index + count >= len(args):
+                return None
+            options += args[index:index + count + 1]
+            index += count + 1
+        else:
+            positional.append(arg)
+            index += 1
+
+    if utility == 'ogr2ogr' and len(positional) >= 2:
+        # Any other arguments are the layers to convert.
+        return {'utility': utility, 'options': options + positional[2:], 'config': config,
+                'sources': positional[1:2], 'destination': positional[0]}
+    if utility == 'gdalwarp' and len(positional) >= 2:
+        return {'utility': utility, 'options': options, 'config': config,
+                'sources': positional[:-1], 'destination': positional[-1]}
+    if utility == 'gdal_translate' and len(positional) == 2:
+        return {'utility': utility, 'options': options, 'config': config,
+                'sources': positional[:1], 'destination': positional[1]}
+    return None
+
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def execute_gdal_command(command, task_uid=None, progress_offset=0.0, progress_scale=1.0, error_pipe=None):
+    """
+    Runs a command parsed by parse_gdal_command, in the child process started by run_gdal.
+    :param error_pipe: A connection to send the error to the parent process on if the command fails
+    """
+    try:
+        gdal.UseExceptions()
+        for key, value in command['config'].items():
+            gdal.SetConfigOption(key, value)
+        utility = command['utility']
+        options = command['options']
+        destination = command['destination']
+        progress = GdalProgress(task_uid, progress_offset=progress_offset, progress_scale=progress_scale)
+        logger.debug("Running {0} with {1}".format(GDAL_UTILITIES[utility], options))
+        if utility == 'ogr2ogr':
+            source = gdal.OpenEx(command['sources'][0], gdal.OF_VECTOR)
+            # Like ogr2ogr, update existing datasets when adding to them.
+            if '-update' in options or '-append' in options or \
+                    ('-overwrite' in options and os.path.exists(destination)):
+                destination = gdal.OpenEx(destination, gdal.OF_VECTOR | gdal.OF_UPDATE)
+            result = gdal.VectorTranslate(destination, source, options=options, callback=progress)
+        elif utility == 'gdalwarp':
+            sources = [gdal.Open(source) for source in command['sources']]
+            result = gdal.Warp(destination, sources, options=options, callback=progress)
+        else:
+            source = gdal.Open(command['sources'][0])
+            result = gdal.Translate(destination, source, options=options, callback=progress)
+        if result is None:
+            raise Exception("{0} failed: {1}".format(utility, gdal.GetLastErrorMsg()))
+        # Closing the dataset flushes it to disk.
+        result = None
+    except Exception as e:
+        if error_pipe:
+            error_pipe.send(str(e)[:MAX_ERROR_LENGTH])
+        raise
+
+
+class GdalProgress(object):
+    """
+    A GDAL progress callback which writes the progress to the task, like the CustomLogger of raster seeding, and stops
+    the command when the task is canceled.  A command which is only part of a task reports within its share of the
+    task, from progress_offset to progress_offset + progress_scale.
+    """
+
+    def __init__(self, task_uid=None, progress_offset=0.0, progress_scale=1.0):
+        self.task_uid = task_uid
+        self.progress_offset = progress_offset
+        self.progress_scale = progress_scale
+        self.update_interval = float(getattr(settings, 'PROGRESS_UPDATE_INTERVAL', 10))
+        self.update_delta = float(getattr(settings, 'PROGRESS_UPDATE_DELTA', 1))
+        self.last_update = None
+        self.last_progress = None
+
+    def __call__(self, complete, message=None, data=None):
+        if not self.task_uid:
+            return 1
+        from ..tasks.export_tasks import update_progress
+        percent = (self.progress_offset + self.progress_scale * complete) * 100
+        now = time.time()
+        if self.last_progress is None or abs(percent - self.last_progress) >= self.update_delta or \
+                (percent != self.last_progress and now - self.last_update >= self.update_interval):
+            update_progress(self.task_uid, progress=percent)
+            self.last_update = now
+            self.last_progress = percent
+            # Returning 0 makes GDAL stop the command.
+            if self.is_canceled():
+                return 0
+        return 1
+
+    def is_canceled(self):
+        from ..tasks.models import ExportTaskRecord
+        from ..tasks.export_tasks import TaskStates
+        return ExportTaskRecord.objects.filter(uid=self.task_uid, status=TaskStates.CANCELED.value).exists()
+
 
 def open_ds(ds_path):
     """
@@ -135,7 +369,8 @@ def clip_dataset(boundary=None, in_dataset=None, out_dataset=None, fmt=None, tab
     if table:
         cmd_template = Template("ogr2ogr -update -f $fmt -clipsrc $boundary $out_ds $in_ds $table")
     elif raster:
-        cmd_template = Template("gdalwarp -cutline $boundary -crop_to_cutline -dstalpha -of $fmt $type $in_ds $out_ds")
+        cmd_template = Template("gdalwarp $profile -cutline $boundary -crop_to_cutline -dstalpha -of $fmt $type "
+                                "$in_ds $out_ds")
         # Geopackage raster only supports byte band type, so check for that
         if fmt.lower() == 'gpkg':
             band_type = "-ot byte"
@@ -154,6 +389,7 @@ def clip_dataset(boundary=None, in_dataset=None, out_dataset=None, fmt=None, tab
                                             'table': table})
     else:
         cmd = cmd_template.safe_substitute({'boundary': boundary,
+                                            'profile': get_raster_options() if raster else '',
                                             'fmt': fmt,
                                             'type': band_type,
                                             'in_ds': in_dataset,
@@ -161,9 +397,7 @@ def clip_dataset(boundary=None, in_dataset=None, out_dataset=None, fmt=None, tab
 
     logger.debug(cmd)
 
-    task_process = TaskProcess(task_uid=task_uid)
-    task_process.start_process(cmd, shell=True, executable="/bin/bash",
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    task_process = run_gdal(cmd, task_uid=task_uid)
 
     if task_process.exitcode != 0:
         logger.error('{0}'.format(task_process.stderr))
@@ -187,7 +421,7 @@ def convert(dataset=None, fmt=None, task_uid=None):
 
     band_type = ""
     if raster:
-        cmd_template = Template("gdalwarp -of $fmt $type $in_ds $out_ds")
+        cmd_template = Template("gdalwarp $profile -of $fmt $type $in_ds $out_ds")
         # Geopackage raster only supports byte band type, so check for that
         if fmt.lower() == 'gpkg':
             band_type = "-ot byte"
@@ -195,18 +429,133 @@ def convert(dataset=None, fmt=None, task_uid=None):
         cmd_template = Template("ogr2ogr -f $fmt $out_ds $in_ds")
 
     cmd = cmd_template.safe_substitute({'fmt': fmt,
+                                        'profile': get_raster_options() if raster else '',
                                         'type': band_type,
                                         'in_ds': in_ds,
                                         'out_ds': dataset})
 
     logger.debug(cmd)
 
-    task_process = TaskProcess(task_uid=task_uid)
-    task_process.start_process(cmd, shell=True, executable="/bin/bash",
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    task_process = run_gdal(cmd, task_uid=task_uid)
 
     if task_process.exitcode != 0:
         logger.error('{0}'.format(task_process.stderr))
         raise Exception("Conversion process failed with return code {0}".format(task_process.exitcode))
 
     return dataset
+
+
+class DatasetPipeline(object):
+    """
+    Clips, reprojects, casts and converts a dataset with one gdalwarp or ogr2ogr, so that the dataset is read and
+    written once however many stages are added.
+
+        DatasetPipeline(gpkg, task_uid=task_uid).clip(selection).convert('gtiff').run()
+    """
+
+    def __init__(self, dataset=None, driver=None, raster=None, task_uid=None):
+        """
+        :param dataset: The dataset to transform
+        :param driver: The short name of the driver of the dataset, if a previous task already knows it
+        :param raster: True if the dataset is a raster, if a previous task already knows it
+        :param task_uid: A task uid to update
+        """
+        if not dataset:
+            raise Exception("Could not open input dataset: {0}".format(dataset))
+        if driver is None or raster is None:
+            (driver, raster) = driver_for(dataset)
+        self.dataset = dataset
+        self.driver = driver
+        self.raster = raster
+        self.task_uid = task_uid
+        self.boundary = None
+        self.srs = None
+        self.band_type = None
+        self.fmt = None
+
+    def clip(self, boundary):
+        """
+        :param boundary: A geojson file to serve as a cutline, or a bbox for vector datasets
+        """
+        self.boundary = boundary
+        return self
+
+    def reproject(self, srs):
+        """
+        :param srs: The spatial reference system of the output, e.g. EPSG:3857
+        """
+        self.srs = srs
+        return self
+
+    def cast(self, band_type):
+        """
+        :param band_type: The band type of the output raster, e.g. byte
+        """
+        self.band_type = band_type
+        return self
+
+    def convert(self, fmt):
+        """
+        :param fmt: Short name of the output driver
+        """
+        self.fmt = fmt
+        return self
+
+    def get_command(self, in_dataset, out_dataset):
+        fmt = self.fmt or self.driver or 'gpkg'
+        if self.raster:
+            cmd = ["gdalwarp", get_raster_options()]
+            if self.boundary:
+                cmd += ["-cutline", self.boundary, "-crop_to_cutline", "-dstalpha"]
+            if self.srs:
+                cmd += ["-t_srs", self.srs]
+            cmd += ["-of", fmt]
+            # Geopackage raster only supports byte band type
+            band_type = self.band_type or ('byte' if fmt.lower() == 'gpkg' else None)
+            if band_type:
+                cmd += ["-ot", band_type]
+            cmd += [in_dataset, out_dataset]
+        else:
+            cmd = ["ogr2ogr", "-f", fmt]
+            if self.boundary:
+                boundary = self.boundary
+                if isinstance(boundary, list):
+                    boundary = " ".join(str(i) for i in boundary)
+                cmd += ["-clipsrc", boundary]
+            if self.srs:
+                cmd += ["-t_srs", self.srs]
+            cmd += [out_dataset, in_dataset]
+        return " ".join(cmd)
+
+    def run(self, out_dataset=None):
+        """
+        :param out_dataset: The dataset to write to (if not specified will replace the input dataset)
+        :return: A dict with the result dataset, its driver and whether it's a raster, for the task result
+        """
+        fmt = self.fmt or self.driver
+        out_dataset = out_dataset or self.dataset
+        result = {'result': out_dataset, 'driver': fmt, 'raster': self.raster}
+        unchanged = not (self.boundary or self.srs or self.band_type) and \
+            (not fmt or not self.driver or fmt.lower() == self.driver.lower())
+        if unchanged and out_dataset == self.dataset:
+            return result
+
+        in_dataset = self.dataset
+        if out_dataset == in_dataset:
+            in_dataset = os.path.join(os.path.dirname(out_dataset), "old_{0}".format(os.path.basename(out_dataset)))
+            logger.info("Renaming '{}' to '{}'".format(out_dataset, in_dataset))
+            os.rename(out_dataset, in_dataset)
+
+        cmd = self.get_command(in_dataset, out_dataset)
+        logger.debug(cmd)
+        task_process = run_gdal(cmd, task_uid=self.task_uid)
+
+        if task_process.exitcode != 0:
+            logger.error('{0}'.format(task_process.stderr))
+            if in_dataset != self.dataset:
+                # Leave the input in place for a retry.
+                os.rename(in_dataset, self.dataset)
+            raise Exception("Dataset pipeline failed with return code {0}".format(task_process.exitcode))
+        if in_dataset != self.dataset:
+            os.remove(in_dataset)
+        return result
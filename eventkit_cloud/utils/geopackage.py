@@ -2,11 +2,12 @@
 from __future__ import with_statement
 
 import argparse
+import hashlib
 import logging
 import os
-import subprocess
+from io import BytesIO
 from string import Template
-from ..tasks.task_process import TaskProcess
+from .gdalutils import run_gdal
 from pysqlite2 import dbapi2 as sqlite3
 import json
 
@@ -47,9 +48,7 @@ class SQliteToGeopackage(object):
                                                 'sqlite': self.sqlite})
         if self.debug:
             print 'Running: %s' % convert_cmd
-        task_process = TaskProcess(task_uid=self.task_uid)
-        task_process.start_process(convert_cmd, shell=True, executable='/bin/bash',
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        task_process = run_gdal(convert_cmd, task_uid=self.task_uid)
         if task_process.exitcode != 0:
             logger.error('%s', task_process.stderr)
             raise Exception, "ogr2ogr process failed with returncode: {0}".format(task_process.exitcode)
@@ -89,9 +88,7 @@ def add_geojson_to_geopackage(geojson=None, gpkg=None, layer_name=None, task_uid
                                       'gpkg': gpkg,
                                       'layer_name': layer_name})
 
-    task_process = TaskProcess(task_uid=task_uid)
-    task_process.start_process(append_cmd, shell=True, executable='/bin/bash',
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    task_process = run_gdal(append_cmd, task_uid=task_uid)
     if task_process.exitcode != 0:
         logger.error('{0}'.format(task_process.stderr))
         raise Exception("ogr2ogr process failed with returncode: {0}".format(task_process.exitcode))
@@ -125,9 +122,7 @@ def clip_geopackage(geojson_file=None, gpkg=None, task_uid=None):
                                       'out_gpkg': gpkg})
 
     logger.info(append_cmd)
-    task_process = TaskProcess(task_uid=task_uid)
-    task_process.start_process(append_cmd, shell=True, executable='/bin/bash',
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    task_process = run_gdal(append_cmd, task_uid=task_uid)
     if task_process.exitcode != 0:
         logger.error('{0}'.format(task_process.stderr))
         raise Exception("{} process failed with returncode: {0}".format(append_cmd.split()[0], task_process.exitcode))
@@ -275,6 +270,82 @@ def remove_empty_zoom_levels(gpkg):
                 remove_zoom_level(gpkg, table, zoom_level)
 
 
+# Blank tiles compress to far less than this, larger tiles aren't decoded to check whether they're blank.
+BLANK_TILE_MAX_SIZE = 16384
+
+
+def remove_blank_tiles(gpkg):
+    """
+    Removes the fully transparent tiles from the tile tables, which readers draw the same as missing tiles, and stores
+    the tiles of a single colour as the smallest PNG of that colour.  Identical tiles are only decoded once.
+    GeoPackage tiles can't share their data, so the other duplicate tiles are left as they are.
+
+    :param gpkg: Path to geopackage.
+    :return: A dict of the number of tiles removed and recompressed, and the bytes saved.
+    """
+    stats = {'removed': 0, 'recompressed': 0, 'saved': 0}
+    with sqlite3.connect(gpkg) as conn:
+        for table in get_tile_table_names(gpkg):
+            if not is_alnum(table):
+                continue
+            blank_tiles = {}
+            removed = []
+            recompressed = []
+            for tile_id, tile_data in conn.execute("SELECT id, tile_data FROM '{0}' WHERE length(tile_data) <= ?;".format(
+                    table), (BLANK_TILE_MAX_SIZE,)):
+                tile_data = bytes(tile_data)
+                key = hashlib.sha1(tile_data).digest()
+                if key not in blank_tiles:
+                    blank_tiles[key] = get_blank_tile(tile_data)
+                blank_tile = blank_tiles[key]
+                if blank_tile is None:
+                    continue
+                if blank_tile:
+                    recompressed.append((sqlite3.Binary(blank_tile), tile_id))
+                    stats['saved'] += len(tile_data) - len(blank_tile)
+                else:
+                    removed.append((tile_id,))
+                    stats['saved'] += len(tile_data)
+            conn.executemany("DELETE FROM '{0}' WHERE id = ?;".format(table), removed)
+            conn.executemany("UPDATE '{0}' SET tile_data = ? WHERE id = ?;".format(table), recompressed)
+            stats['removed'] += len(removed)
+            stats['recompressed'] += len(recompressed)
+    if stats['removed'] or stats['recompressed']:
+        # Return the freed pages to the file system.
+        with sqlite3.connect(gpkg) as conn:
+            conn.execute("VACUUM;")
+    logger.info("Removed {removed} blank tiles and recompressed {recompressed} single colour tiles, "
+                "saving {saved} bytes.".format(**stats))
+    return stats
+
+
+def get_blank_tile(tile_data):
+    """
+    :param tile_data: An encoded tile.
+    :return: None if the tile isn't blank, an empty string if it is fully transparent, or else a smaller PNG of its
+    single opaque colour if there is one.
+    """
+    from PIL import Image
+
+    try:
+        image = Image.open(BytesIO(tile_data)).convert('RGBA')
+    except IOError:
+        return None
+    extrema = image.getextrema()
+    if extrema[3][1] == 0:
+        return ''
+    if any(low != high for low, high in extrema) or extrema[3][0] != 255:
+        return None
+    blank_image = Image.new('P', image.size, 0)
+    blank_image.putpalette([low for low, high in extrema[:3]])
+    output = BytesIO()
+    blank_image.save(output, 'PNG', optimize=True)
+    blank_tile = output.getvalue()
+    if len(blank_tile) >= len(tile_data):
+        return None
+    return blank_tile
+
+
 def remove_zoom_level(gpkg, table, zoom_level):
     """
     Removes a specific zoom level, for a table in the gpkg_tile_matrix table.
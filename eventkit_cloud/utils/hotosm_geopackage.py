@@ -6,27 +6,55 @@ import subprocess
 from string import Template
 from artifact import Artifact
 
+from billiard import Pool
+from django.conf import settings
 from osgeo import gdal, ogr, osr
 
 from pysqlite2 import dbapi2 as sqlite3
 
 from eventkit_cloud.feature_selection.feature_selection import slugify
+from eventkit_cloud.utils.zindex import ZINDEX_KEYS, zindex_sql
 
 LOG = logging.getLogger(__name__)
 
-SPATIAL_SQL = '''
-UPDATE 'points' SET geom=GeomFromGPB(geom);
-UPDATE 'lines' SET geom=GeomFromGPB(geom);
-UPDATE 'multipolygons' SET geom=GeomFromGPB(geom);
-
-UPDATE points SET geom = (SELECT ST_Intersection(boundary.geom,p.geom) FROM boundary,points p WHERE points.fid = p.fid);
-UPDATE lines SET geom = (SELECT ST_Intersection(boundary.geom,l.geom) FROM boundary,lines l WHERE lines.fid = l.fid);
-UPDATE multipolygons SET geom = (SELECT ST_Intersection(boundary.geom,m.geom) FROM boundary,multipolygons m WHERE multipolygons.fid = m.fid);
+CLIP_SQL = '''
+-- Features outside of the bbox of the boundary are deleted in bulk using the rtrees built by ogr2ogr.
+DELETE FROM points WHERE fid NOT IN (
+    SELECT r.id FROM rtree_points_geom r, (SELECT MbrMinX(geom) AS minx, MbrMinY(geom) AS miny,
+        MbrMaxX(geom) AS maxx, MbrMaxY(geom) AS maxy FROM boundary) b
+    WHERE r.minx <= b.maxx AND r.maxx >= b.minx AND r.miny <= b.maxy AND r.maxy >= b.miny);
+DELETE FROM lines WHERE fid NOT IN (
+    SELECT r.id FROM rtree_lines_geom r, (SELECT MbrMinX(geom) AS minx, MbrMinY(geom) AS miny,
+        MbrMaxX(geom) AS maxx, MbrMaxY(geom) AS maxy FROM boundary) b
+    WHERE r.minx <= b.maxx AND r.maxx >= b.minx AND r.miny <= b.maxy AND r.maxy >= b.miny);
+DELETE FROM multipolygons WHERE fid NOT IN (
+    SELECT r.id FROM rtree_multipolygons_geom r, (SELECT MbrMinX(geom) AS minx, MbrMinY(geom) AS miny,
+        MbrMaxX(geom) AS maxx, MbrMaxY(geom) AS maxy FROM boundary) b
+    WHERE r.minx <= b.maxx AND r.maxx >= b.minx AND r.miny <= b.maxy AND r.maxy >= b.miny);
+
+-- A point is either inside or outside of the boundary, it never needs to be clipped.
+DELETE FROM points WHERE fid IN (
+    SELECT p.fid FROM points p, boundary b WHERE ST_Intersects(b.geom, p.geom) IS NOT 1);
+
+-- Features with a bbox inside the boundary are kept unchanged, only the ones crossing it are intersected.
+-- Degenerate bboxes (e.g. of vertical lines) make ST_Covers fail, so those features are intersected too.
+-- The triggers are dropped, so the rtrees still hold the deleted features, the bbox test skips them.
+UPDATE lines SET geom = ST_Intersection((SELECT geom FROM boundary), geom) WHERE fid IN (
+    SELECT r.id FROM rtree_lines_geom r, (SELECT geom, MbrMinX(geom) AS minx, MbrMinY(geom) AS miny,
+        MbrMaxX(geom) AS maxx, MbrMaxY(geom) AS maxy FROM boundary) b
+    WHERE r.minx <= b.maxx AND r.maxx >= b.minx AND r.miny <= b.maxy AND r.maxy >= b.miny
+    AND ST_Covers(b.geom, BuildMbr(r.minx, r.miny, r.maxx, r.maxy, 4326)) IS NOT 1);
+UPDATE multipolygons SET geom = ST_Intersection((SELECT geom FROM boundary), geom) WHERE fid IN (
+    SELECT r.id FROM rtree_multipolygons_geom r, (SELECT geom, MbrMinX(geom) AS minx, MbrMinY(geom) AS miny,
+        MbrMaxX(geom) AS maxx, MbrMaxY(geom) AS maxy FROM boundary) b
+    WHERE r.minx <= b.maxx AND r.maxx >= b.minx AND r.miny <= b.maxy AND r.maxy >= b.miny
+    AND ST_Covers(b.geom, BuildMbr(r.minx, r.miny, r.maxx, r.maxy, 4326)) IS NOT 1);
 
-DELETE FROM points where geom IS NULL;
 DELETE FROM lines where geom IS NULL;
 DELETE FROM multipolygons where geom IS NULL;
+'''
 
+SPATIAL_SQL = '''
 DROP TRIGGER rtree_multipolygons_geom_delete;
 DROP TRIGGER rtree_multipolygons_geom_insert;
 DROP TRIGGER rtree_multipolygons_geom_update1;
@@ -46,6 +74,10 @@ DROP TRIGGER rtree_lines_geom_update2;
 DROP TRIGGER rtree_lines_geom_update3;
 DROP TRIGGER rtree_lines_geom_update4;
 
+UPDATE 'points' SET geom=GeomFromGPB(geom);
+UPDATE 'lines' SET geom=GeomFromGPB(geom);
+UPDATE 'multipolygons' SET geom=GeomFromGPB(geom);
+''' + CLIP_SQL + '''
 -- TODO: these are invalid multipolygons that result in GeometryCollections of linear features.
 -- see https://github.com/hotosm/osm-export-tool2/issues/155 for discussion.
 -- maybe we should log these somewhere.
@@ -54,9 +86,9 @@ DELETE FROM multipolygons where GeometryType(geom) NOT IN ('POLYGON','MULTIPOLYG
 SELECT gpkgAddSpatialIndex('boundary', 'geom');
 
 UPDATE 'boundary' SET geom=AsGPB(geom);
-UPDATE 'points' SET geom=AsGPB(geom);
-UPDATE 'lines' SET geom=AsGPB(geom);
-UPDATE 'multipolygons' SET geom=AsGPB(geom);
+
+-- points, lines and multipolygons keep their spatialite geometries, the theme tables are extracted from them
+-- and converted to GPB once each.  The source tables are dropped afterwards.
 
 DROP TABLE multilinestrings;
 DROP TABLE other_relations;
@@ -233,6 +265,32 @@ class OSMConfig(object):
         return self.output_ini
 
 
+def create_theme_gpkg(args):
+    """
+    Create the GeoPackage of a single theme by copying its tables out of the thematic GeoPackage.
+    At module level so that it can be run by a worker process.
+
+    Args:
+        args: a tuple of the thematic GeoPackage, the theme GeoPackage to create and the sqls from
+            FeatureSelection.create_sql for each of the geometry types of the theme.
+    Return:
+        the theme GeoPackage.
+    """
+    output_gpkg, theme_gpkg, sqls = args
+    conn = sqlite3.connect(theme_gpkg)
+    conn.enable_load_extension(True)
+    cur = conn.cursor()
+    cur.execute("attach database ? as 'geopackage'", (output_gpkg,))
+    cur.execute("create table gpkg_spatial_ref_sys as select * from geopackage.gpkg_spatial_ref_sys")
+    cur.execute("create table gpkg_contents as select * from geopackage.gpkg_contents where 0")
+    cur.execute("create table gpkg_geometry_columns as select * from geopackage.gpkg_geometry_columns where 0")
+    for stmt in sqls:
+        cur.executescript(stmt)
+    conn.commit()
+    conn.close()
+    return theme_gpkg
+
+
 class Geopackage(object):
     """
     Parse a OSM file (.osm or .pbf) dumped from overpass query.
@@ -245,7 +303,8 @@ class Geopackage(object):
     def results(self):
         return [self.output_gpkg]
 
-    def __init__(self, input_pbf, output_gpkg, stage_dir, feature_selection, aoi_geom, tempdir=None, per_theme=False):
+    def __init__(self, input_pbf, output_gpkg, stage_dir, feature_selection, aoi_geom, tempdir=None, per_theme=False,
+                 theme_workers=None):
         """
         Initialize the OSMParser.
 
@@ -260,6 +319,7 @@ class Geopackage(object):
         self.feature_selection = feature_selection
         self.aoi_geom = aoi_geom
         self.per_theme = per_theme
+        self.theme_workers = theme_workers or int(getattr(settings, 'GEOPACKAGE_THEME_WORKERS', 1))
 
         """
         OGR Command to run.
@@ -308,8 +368,8 @@ class Geopackage(object):
         cur.executescript(SPATIAL_SQL)
         self.update_zindexes(cur, self.feature_selection)
 
-        # add themes
-        create_sqls, index_sqls = self.feature_selection.sqls
+        # add themes, scanning each of the source tables once
+        create_sqls, index_sqls = self.feature_selection.extraction_sqls
         for query in create_sqls:
             LOG.debug(query)
             cur.executescript(query)
@@ -328,20 +388,36 @@ class Geopackage(object):
         conn.close()
 
         if self.per_theme:
-            # this creates per-theme GPKGs
-            for theme in self.feature_selection.themes:
-                conn = sqlite3.connect(self.stage_dir + slugify(theme) + ".gpkg")
-                conn.enable_load_extension(True)
-                cur = conn.cursor()
-                cur.execute("attach database ? as 'geopackage'", (self.output_gpkg,))
-                cur.execute("create table gpkg_spatial_ref_sys as select * from geopackage.gpkg_spatial_ref_sys")
-                cur.execute("create table gpkg_contents as select * from geopackage.gpkg_contents where 0")
-                cur.execute("create table gpkg_geometry_columns as select * from geopackage.gpkg_geometry_columns where 0")
-                for geom_type in self.feature_selection.geom_types(theme):
-                    for stmt in self.feature_selection.create_sql(theme, geom_type):
-                        cur.executescript(stmt)
-                conn.commit()
-                conn.close()
+            self.create_theme_gpkgs()
+
+    def create_theme_gpkgs(self):
+        """
+        Create a GeoPackage per theme from the thematic GeoPackage.  The themes are independent, so they are created
+        concurrently by a pool of theme_workers processes.
+        """
+        jobs = []
+        for theme in self.feature_selection.themes:
+            sqls = []
+            for geom_type in self.feature_selection.geom_types(theme):
+                sqls += self.feature_selection.create_sql(theme, geom_type)
+            jobs.append((self.output_gpkg, self.theme_gpkg(theme), sqls))
+        workers = min(self.theme_workers, len(jobs))
+        if workers <= 1:
+            return map(create_theme_gpkg, jobs)
+        LOG.debug('Creating {0} theme GeoPackages with {1} workers.'.format(len(jobs), workers))
+        pool = Pool(processes=workers)
+        try:
+            theme_gpkgs = pool.map(create_theme_gpkg, jobs, chunksize=1)
+            pool.close()
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return theme_gpkgs
+
+    def theme_gpkg(self, theme):
+        return os.path.join(self.stage_dir, slugify(theme)) + ".gpkg"
 
     @property
     def is_complete(self):
@@ -352,7 +428,7 @@ class Geopackage(object):
         if self.per_theme:
             results_list = []
             for theme in self.feature_selection.themes:
-                results_list.append(Artifact([os.path.join(self.stage_dir, slugify(theme)) + ".gpkg"], Geopackage.name, theme=theme))
+                results_list.append(Artifact([self.theme_gpkg(theme)], Geopackage.name, theme=theme))
             return results_list
         else:
             return [Artifact([self.output_gpkg], Geopackage.name)]
@@ -369,22 +445,6 @@ class Geopackage(object):
                 'polygon':'multipolygons'
             }
             table_name = MAPPING[geom_type]
-            if any([x in key_union for x in ['highway', 'railway', 'layer', 'bridge', 'tunnel']]):
+            if any([x in key_union for x in ZINDEX_KEYS]):
                 cur.execute("ALTER TABLE {table} ADD COLUMN z_index SMALLINT DEFAULT 0;".format(table=table_name))
-                if "highway" in key_union:
-                    cur.executescript("""
-                        UPDATE {table} SET z_index = 3 WHERE highway IN ('path', 'track', 'footway', 'minor', 'road', 'service', 'unclassified', 'residential');
-                        UPDATE {table} SET z_index = 4 WHERE highway IN ('tertiary_link', 'tertiary');
-                        UPDATE {table} SET z_index = 6 WHERE highway IN ('secondary_link', 'secondary');
-                        UPDATE {table} SET z_index = 7 WHERE highway IN ('primary_link', 'primary');
-                        UPDATE {table} SET z_index = 8 WHERE highway IN  ('trunk_link', 'trunk');
-                        UPDATE {table} SET z_index = 9 WHERE highway IN  ('motorway_link', 'motorway');
-                    """.format(table=table_name))
-                if "railway" in key_union:
-                    cur.execute("UPDATE {table} SET z_index = z_index + 5 WHERE railway IS NOT NULL".format(table=table_name))
-                if "layer" in key_union:
-                    cur.execute("UPDATE {table} SET z_index = z_index + 10 * cast(layer AS SMALLINT) WHERE layer IS NOT NULL".format(table=table_name))
-                if "bridge" in key_union:
-                    cur.execute("UPDATE {table} SET z_index = z_index + 10 WHERE bridge IN ('yes', 'true', 1)".format(table=table_name))
-                if "tunnel" in key_union:
-                    cur.execute("UPDATE {table} SET z_index = z_index - 10 WHERE tunnel IN ('yes', 'true', 1)".format(table=table_name))
+                cur.execute(zindex_sql(table_name, key_union))
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from django.conf import settings
+from osgeo import ogr, osr
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+LAND_POLYGONS_TABLE = 'land_polygons'
+
+# The downloaded land polygons are copied into the load table, subdivided into the staging table and the staging table
+# then replaces LAND_POLYGONS_TABLE, so exports keep using the complete previous table until the new one is ready.
+LAND_POLYGONS_LOAD_TABLE = 'land_polygons_load'
+LAND_POLYGONS_STAGING_TABLE = 'land_polygons_staging'
+LAND_POLYGONS_OLD_TABLE = 'land_polygons_old'
+
+# The coastline polygons have up to millions of vertices, the pieces are small enough that clipping them is cheap and
+# their bounding boxes are tight, so the GiST index finds few pieces outside of the area of interest.
+SUBDIVIDE_MAX_VERTICES = 256
+
+# The load table is only read once, it isn't worth writing to the WAL.
+CREATE_LOAD_SQL = """
+DROP TABLE IF EXISTS {load};
+CREATE UNLOGGED TABLE {load} (geom geometry);
+"""
+
+# The indexes are built after the pieces are written, which is much faster than updating them for each row.
+# They are left unnamed so postgres names them after the staging table without clashing with the current ones.
+SUBDIVIDE_SQL = """
+DROP TABLE IF EXISTS {staging};
+CREATE TABLE {staging} AS SELECT row_number() OVER () AS id, geom FROM (
+    SELECT ST_Subdivide(ST_Transform(ST_SetSRID(geom, {srid}), 4326), {max_vertices}) AS geom FROM {load}
+) pieces;
+ALTER TABLE {staging} ADD PRIMARY KEY (id);
+CREATE INDEX ON {staging} USING GIST (geom);
+ANALYZE {staging};
+"""
+
+# Renaming only needs a brief lock, queries waiting on the old table run against the new one once it's committed.
+SWAP_SQL = """
+DROP TABLE IF EXISTS {old};
+ALTER TABLE IF EXISTS {table} RENAME TO {old};
+ALTER TABLE {staging} RENAME TO {table};
+"""
+
+# Pieces covered by the area of interest are returned as they are, only the pieces crossing its edge are clipped.
+CLIP_SQL = """
+SELECT ST_AsBinary(ST_Multi(clipped)) FROM (
+    SELECT CASE WHEN ST_CoveredBy(land.geom, aoi.geom) THEN land.geom
+        ELSE ST_CollectionExtract(ST_Intersection(land.geom, aoi.geom), 3) END AS clipped
+    FROM {table} land, (SELECT ST_GeomFromText(%(aoi)s, 4326) AS geom) aoi
+    WHERE land.geom && aoi.geom AND ST_Intersects(land.geom, aoi.geom)
+) pieces WHERE NOT ST_IsEmpty(clipped);
+"""
+
+
+def connect(database=None):
+    """
+    Connect to the database holding the land polygons.
+
+    Args:
+        database: a django database setting, defaults to the feature_data database.
+    """
+    database = database or settings.DATABASES['feature_data']
+    params = {'dbname': database.get('NAME'), 'host': database.get('HOST'), 'port': database.get('PORT'),
+              'user': database.get('USER'), 'password': database.get('PASSWORD')}
+    return psycopg2.connect(**dict((key, value) for key, value in params.items() if value))
+
+
+class WKBStream(object):
+    """
+    A file like object reading the geometries of an OGR layer as COPY text rows of hex WKB, so that they can be streamed
+    into postgres with copy_expert without writing them to disk.
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.rows = 0
+        self.buffer = ''
+        self.offset = 0
+        self.done = False
+
+    def read(self, size=-1):
+        # Coastline polygons can be megabytes, so the buffer is read from an offset instead of being sliced each time.
+        while not self.done and (size < 0 or len(self.buffer) - self.offset < size):
+            feature = self.layer.GetNextFeature()
+            if feature is None:
+                self.done = True
+                break
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                continue
+            self.buffer = self.buffer[self.offset:] + geometry.ExportToWkb().encode('hex') + '\n'
+            self.offset = 0
+            self.rows += 1
+        end = len(self.buffer) if size < 0 else self.offset + size
+        data = self.buffer[self.offset:end]
+        self.offset = min(end, len(self.buffer))
+        return data
+
+    readline = read
+
+
+def load_land_polygons(file_name, database=None, srid=3857):
+    """
+    Load the land polygons from a vector file, replacing the current ones.
+
+    The polygons are streamed into an unlogged load table with COPY, subdivided into pieces of at most
+    SUBDIVIDE_MAX_VERTICES vertices in a staging table, indexed, and the staging table is then swapped with
+    LAND_POLYGONS_TABLE in a single transaction.  Exports running during the reload use the previous table.
+
+    Args:
+        file_name: the vector file of land polygons.
+        database: a django database setting, defaults to the feature_data database.
+        srid: the EPSG code of the file.
+    Return:
+        a dict of the number of polygons loaded, pieces stored, seconds taken and rows loaded per second.
+    """
+    ds = ogr.Open(file_name)
+    if ds is None:
+        raise IOError('Cannot open land polygons {0}.'.format(file_name))
+    tables = {'table': LAND_POLYGONS_TABLE, 'load': LAND_POLYGONS_LOAD_TABLE, 'staging': LAND_POLYGONS_STAGING_TABLE,
+              'old': LAND_POLYGONS_OLD_TABLE, 'srid': srid, 'max_vertices': SUBDIVIDE_MAX_VERTICES}
+    start = time.time()
+    conn = connect(database)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_LOAD_SQL.format(**tables))
+            stream = WKBStream(ds.GetLayer(0))
+            cur.copy_expert("COPY {load} (geom) FROM STDIN".format(**tables), stream)
+            conn.commit()
+            load_time = time.time() - start
+            logger.info("Copied {0} land polygons in {1:.1f}s ({2:.0f} rows/s).".format(
+                stream.rows, load_time, stream.rows / load_time if load_time else 0))
+
+            cur.execute(SUBDIVIDE_SQL.format(**tables))
+            cur.execute("SELECT COUNT(*) FROM {staging}".format(**tables))
+            pieces = cur.fetchone()[0]
+            conn.commit()
+            logger.info("Subdivided the land polygons into {0} pieces in {1:.1f}s.".format(
+                pieces, time.time() - start - load_time))
+
+            cur.execute(SWAP_SQL.format(**tables))
+            conn.commit()
+            cur.execute("DROP TABLE IF EXISTS {old}; DROP TABLE IF EXISTS {load};".format(**tables))
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        ds = None
+    seconds = time.time() - start
+    stats = {'rows': stream.rows, 'pieces': pieces, 'seconds': seconds,
+             'rows_per_second': stream.rows / seconds if seconds else 0}
+    logger.info("Loaded {rows} land polygons as {pieces} pieces in {seconds:.1f}s ({rows_per_second:.0f} rows/s).".format(
+        **stats))
+    return stats
+
+
+def add_land_polygons(gpkg, boundary, database=None):
+    """
+    Add the land polygons within boundary to a land_polygons layer of the GeoPackage.  The pieces intersecting the
+    boundary are fetched with a single indexed query and written with OGR, clipped to the boundary.
+
+    Args:
+        gpkg: the GeoPackage to add the layer to.
+        boundary: a GEOSGeometry in EPSG:4326.
+        database: a django database setting, defaults to the feature_data database.
+    Return:
+        the number of land polygons added.
+    """
+    start = time.time()
+    conn = connect(database)
+    try:
+        # A named cursor streams the pieces from the server instead of loading them all into memory.
+        with conn.cursor(name='land_polygons') as cur:
+            cur.execute(CLIP_SQL.format(table=LAND_POLYGONS_TABLE), {'aoi': boundary.wkt})
+            ds = ogr.Open(gpkg, update=True)
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(4326)
+            layer = ds.CreateLayer(LAND_POLYGONS_TABLE, srs, ogr.wkbMultiPolygon, ['SPATIAL_INDEX=YES'])
+            defn = layer.GetLayerDefn()
+            count = 0
+            layer.StartTransaction()
+            for wkb, in cur:
+                feature = ogr.Feature(defn)
+                feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(bytes(wkb)))
+                layer.CreateFeature(feature)
+                count += 1
+            layer.CommitTransaction()
+            ds = None
+    finally:
+        conn.close()
+    logger.info("Added {0} land polygons to {1} in {2:.1f}s.".format(count, gpkg, time.time() - start))
+    return count
@@ -7,6 +7,7 @@ import subprocess
 from string import Template
 from ..tasks.task_process import TaskProcess
 from sqlite import execute_spatialite_script
+from zindex import NOT_EMPTY, zindex_sql
 
 from osgeo import gdal, ogr, osr
 
@@ -98,49 +99,15 @@ class OSMParser(object):
         """
         assert exists(self.gpkg), "No geopackage file. Run 'create_geopackage()' method first."
         ds = ogr.Open(self.gpkg, update=True)
-        zindexes = {
-            3: ('path', 'track', 'footway', 'minor', 'road', 'service', 'unclassified', 'residential'),
-            4: ('tertiary_link', 'tertiary'),
-            6: ('secondary_link', 'secondary'),
-            7: ('primary_link', 'primary'),
-            8: ('trunk_link', 'trunk'),
-            9: ('motorway_link', 'motorway')
-        }
         layer_count = ds.GetLayerCount()
         assert layer_count == 3, """Incorrect number of layers found. Run 'create_default_schema()' method first."""
         for layer_idx in range(layer_count):
-            layer = ds.GetLayerByIndex(layer_idx).GetName()
-            try:
-                # update highway z_indexes
-                for key in zindexes.keys():
-                    sql = 'UPDATE {0} SET z_index = {1} WHERE highway IN {2};'.format(layer, key, zindexes[key])
-                    ds.ExecuteSQL(sql)
-            except RuntimeError:
-                pass
-            try:
-                # update railway z_indexes
-                sql = "UPDATE {0} SET z_index = z_index + 5 WHERE railway <> ''".format(layer)
+            layer = ds.GetLayerByIndex(layer_idx)
+            defn = layer.GetLayerDefn()
+            columns = [defn.GetFieldDefn(field_idx).GetName() for field_idx in range(defn.GetFieldCount())]
+            sql = zindex_sql(layer.GetName(), columns, present=NOT_EMPTY)
+            if sql and 'z_index' in columns:
                 ds.ExecuteSQL(sql)
-            except RuntimeError:
-                pass
-            try:
-                # update layer
-                sql = "UPDATE {0} SET z_index = z_index + 10 * cast(layer as int) WHERE layer <> ''".format(layer)
-                ds.ExecuteSQL(sql)
-            except RuntimeError:
-                pass
-            try:
-                # update bridge z_index
-                sql = "UPDATE {0} SET z_index = z_index + 10 WHERE bridge IN ('yes', 'true', 1)".format(layer)
-                ds.ExecuteSQL(sql)
-            except RuntimeError:
-                pass
-            try:
-                # update tunnel z_index
-                sql = "UPDATE {0} SET z_index = z_index - 10 WHERE tunnel IN ('yes', 'true', 1)".format(layer)
-                ds.ExecuteSQL(sql)
-            except RuntimeError:
-                pass
 
         # close connection
         ds.Destroy()
@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
 import argparse
+import heapq
+import json
 import logging
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from string import Template
+from xml.etree import cElementTree as ElementTree
 import os
 from requests import exceptions
 
 import auth_requests
+from .overpass_cache import OverpassCache
 
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+# Overpass returns elements sorted by type and then by id, merges rely on this ordering.
+OSM_ELEMENT_ORDER = {'node': 0, 'way': 1, 'relation': 2}
+
 
 class Overpass(object):
     """
@@ -21,7 +31,7 @@ class Overpass(object):
     """
 
     def __init__(self, url=None, slug=None, bbox=None, stage_dir=None, job_name=None, debug=False, task_uid=None,
-                 raw_data_filename=None):
+                 raw_data_filename=None, use_cache=True, feature_selection=None):
         """
         Initialize the Overpass utility.
 
@@ -32,6 +42,8 @@ class Overpass(object):
             stage_dir: where to stage the extract job
             job_name: the name of the export job
             debug: turn on/off debug logging
+            use_cache: whether to read and store the extract in the overpass cache, if one is configured
+            feature_selection: an optional FeatureSelection, used to only query the elements its themes need
         """
 
         self.url = url or settings.OVERPASS_API_URL or 'http://localhost/interpreter'
@@ -45,36 +57,95 @@ class Overpass(object):
         self.verify_ssl = not getattr(settings, "DISABLE_SSL_VERIFICATION", False)
         if bbox:
             # Overpass expects a bounding box string of the form "<lat0>,<long0>,<lat1>,<long1>"
-            self.bbox = '{},{},{},{}'.format(bbox[1], bbox[0], bbox[3], bbox[2])
+            self.bounds = [float(coord) for coord in bbox]
+            self.bbox = format_bbox(self.bounds)
         else:
             raise Exception('A bounding box is required: miny,minx,maxy,maxx')
 
         # extract all nodes / ways and relations within the bounding box
         # see: http://wiki.openstreetmap.org/wiki/Overpass_API/Overpass_QL
         self.default_template = Template('[maxsize:$maxsize][timeout:$timeout];(node($bbox);<;);out body;')
+        if feature_selection is not None:
+            self.default_template = get_filtered_template(feature_selection)
+
+        # count the nodes in the bounding box, used to decide whether a query should be tiled
+        self.count_template = Template('[out:json][timeout:$timeout];node($bbox);out count;')
 
         # dump out all osm data for the specified bounding box
-        max_size = settings.OVERPASS_MAX_SIZE
-        timeout = settings.OVERPASS_TIMEOUT
-        self.query = self.default_template.safe_substitute(
-            {'maxsize': max_size, 'timeout': timeout, 'bbox': self.bbox}
-        )
+        self.query = self.build_query(self.bbox)
         # set up required paths
         if raw_data_filename is None:
             raw_data_filename = 'query.osm'
 
         self.raw_osm = os.path.join(self.stage_dir, raw_data_filename)
+        self.cache = OverpassCache.from_settings() if use_cache else None
+        # Set when raw_osm is a cached extract of a larger area which still has to be clipped to the bounding box.
+        self.clip_bbox = None
 
     def get_query(self,):
         """Get the overpass query used for this extract."""
         return self.query
 
+    def build_query(self, bbox):
+        """
+        Build the overpass query for an overpass formatted bounding box string.
+        """
+        return self.default_template.safe_substitute(
+            {'maxsize': settings.OVERPASS_MAX_SIZE, 'timeout': settings.OVERPASS_TIMEOUT, 'bbox': bbox}
+        )
+
+    def estimate_node_count(self):
+        """
+        Ask overpass how many nodes are in the bounding box.
+
+        Return:
+            the number of nodes, or None if the count could not be retrieved.
+        """
+        q = self.count_template.safe_substitute({'timeout': settings.OVERPASS_TILE_COUNT_TIMEOUT, 'bbox': self.bbox})
+        try:
+            req = auth_requests.post(self.url, slug=self.slug, data=q, verify=self.verify_ssl,
+                                     timeout=settings.OVERPASS_TILE_COUNT_TIMEOUT)
+            req.raise_for_status()
+            counts = json.loads(req.content)['elements'][0]['tags']
+            return int(counts['nodes'])
+        except (exceptions.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+            logger.warn('Could not estimate the overpass node count for {0}: {1}'.format(self.bbox, e))
+            return None
+
+    def get_tiles(self):
+        """
+        Split the bounding box into a grid of tiles sized so that each tile holds about
+        OVERPASS_TILE_MAX_NODES nodes.
+
+        Return:
+            a list of [minx, miny, maxx, maxy] tiles, a single tile if the query should not be split.
+        """
+        minx, miny, maxx, maxy = self.bounds
+        if (maxx - minx) * (maxy - miny) < float(settings.OVERPASS_TILE_MIN_AREA):
+            return [self.bounds]
+
+        node_count = self.estimate_node_count()
+        if not node_count or node_count <= int(settings.OVERPASS_TILE_MAX_NODES):
+            return [self.bounds]
+
+        tile_count = int(math.ceil(float(node_count) / int(settings.OVERPASS_TILE_MAX_NODES)))
+        # Keep the tiles roughly square so that the number of ways crossing tile edges stays low.
+        aspect = (maxx - minx) / (maxy - miny)
+        columns = max(1, int(round(math.sqrt(tile_count * aspect))))
+        rows = max(1, int(math.ceil(float(tile_count) / columns)))
+        logger.info('Splitting overpass query for {0} ({1} nodes) into {2}x{3} tiles'.format(
+            self.bbox, node_count, columns, rows))
+        return split_bbox(self.bounds, columns, rows)
+
     def run_query(self, user_details=None, subtask_percentage=100):
         """
         Run the overpass query.
         subtask_percentage is the percentage of the task referenced by self.task_uid this method takes up.
             Used to update progress.
 
+        Large bounding boxes are split into tiles which are fetched concurrently and merged into a single file.
+        Fresh extracts for the same bounding box, or one containing it, are read from the overpass cache instead.
+
         Return:
             the path to the overpass extract
         """
@@ -83,16 +154,101 @@ class Overpass(object):
         if user_details is None:
             user_details = {'username': 'unknown-run_query'}
 
+        if self.cache and self.read_cache():
+            from ..tasks.export_tasks import update_progress
+            update_progress(self.task_uid, progress=100, subtask_percentage=subtask_percentage)
+            return self.raw_osm
+
+        self.download(self.get_tiles(), user_details=user_details, subtask_percentage=subtask_percentage)
+        return self.raw_osm
+
+    def run_query_to_pbf(self, pbffile, user_details=None, subtask_percentage=100):
+        """
+        Run the overpass query and convert the result to pbf.
+        A single query is streamed straight into osmconvert so the OSM XML is never staged on disk, cached and tiled
+        extracts are on disk already and are converted from there.
+
+        Return:
+            the path to the pbf
+        """
+        from ..tasks.export_tasks import update_progress
+        from .pbf import OSMToPBF, OSMStreamToPBF
+
+        if user_details is None:
+            user_details = {'username': 'unknown-run_query_to_pbf'}
+
+        if self.cache and self.read_cache():
+            update_progress(self.task_uid, progress=100, subtask_percentage=subtask_percentage)
+        else:
+            tiles = self.get_tiles()
+            if len(tiles) == 1:
+                query = self.get_query()
+                logger.debug(query)
+                try:
+                    req = auth_requests.post(self.url, slug=self.slug, data=query, stream=True,
+                                             verify=self.verify_ssl)
+                    req.raise_for_status()
+                    update_progress(self.task_uid, progress=50, subtask_percentage=subtask_percentage)
+                    CHUNK = 1024 * 1024 * 2  # 2MB chunks
+                    return OSMStreamToPBF(pbffile=pbffile, task_uid=self.task_uid).convert(
+                        req.iter_content(CHUNK), user_details=user_details)
+                except exceptions.RequestException as e:
+                    logger.error('Overpass query threw: {0}'.format(e))
+                    raise exceptions.RequestException(e)
+            self.download(tiles, user_details=user_details, subtask_percentage=subtask_percentage)
+
+        return OSMToPBF(osm=self.raw_osm, pbffile=pbffile, task_uid=self.task_uid, bbox=self.clip_bbox).convert()
+
+    def download(self, tiles, user_details=None, subtask_percentage=100):
+        """
+        Download the tiles to raw_osm and store the extract in the cache.
+        """
+        logger.debug('Query started at: {0}'.format(datetime.now()))
+        if len(tiles) == 1:
+            self.fetch(self.get_query(), self.raw_osm, user_details=user_details,
+                       subtask_percentage=subtask_percentage)
+        else:
+            self.run_tiled_query(tiles, user_details=user_details, subtask_percentage=subtask_percentage)
+
+        logger.debug('Query finished at {0}'.format(datetime.now()))
+        logger.debug('Wrote overpass query results to: {0}'.format(self.raw_osm))
+        if self.cache:
+            self.cache.put(self.bounds, self.default_template.template, self.raw_osm)
+        return self.raw_osm
+
+    def read_cache(self):
+        """
+        Read the extract for the bounding box from the cache, using a cached extract for a larger area if there isn't
+        one for this bounding box.  In that case clip_bbox is set, and raw_osm needs to be clipped to it.
+
+        Return:
+            True if the extract was read from the cache.
+        """
+        template = self.default_template.template
+        if self.cache.get(self.bounds, template, self.raw_osm):
+            return True
+        if self.cache.get_containing(self.bounds, template, self.raw_osm):
+            self.clip_bbox = self.bounds
+            return True
+        return False
+
+    def fetch(self, query, out_file, user_details=None, subtask_percentage=100, update=True, stopped=None):
+        """
+        Post a query to overpass and stream the response to out_file.
+        Stops, removing out_file, once the stopped event is set.
+
+        Return:
+            out_file, or None if stopped.
+        """
         from ..tasks.export_tasks import update_progress
 
-        q = self.get_query()
-        logger.debug(q)
-        logger.debug('Query started at: %s'.format(datetime.now()))
+        logger.debug(query)
         try:
-            req = auth_requests.post(self.url, slug=self.slug, data=q, stream=True, verify=self.verify_ssl)
+            req = auth_requests.post(self.url, slug=self.slug, data=query, stream=True, verify=self.verify_ssl)
 
-            # Since the request takes a while, jump progress to an arbitrary 50 percent...
-            update_progress(self.task_uid, progress=50, subtask_percentage=subtask_percentage)
+            if update:
+                # Since the request takes a while, jump progress to an arbitrary 50 percent...
+                update_progress(self.task_uid, progress=50, subtask_percentage=subtask_percentage)
             try:
                 size = int(req.headers.get('content-length'))
             except (ValueError, TypeError):
@@ -103,8 +259,11 @@ class Overpass(object):
             inflated_size = size * 2
             CHUNK = 1024 * 1024 * 2  # 2MB chunks
             from audit_logging.file_logging import logging_open
-            with logging_open(self.raw_osm, 'wb', user_details=user_details) as fd:
+            with logging_open(out_file, 'wb', user_details=user_details) as fd:
                 for chunk in req.iter_content(CHUNK):
+                    if stopped and stopped.is_set():
+                        req.close()
+                        break
                     fd.write(chunk)
                     size += CHUNK
                     # removing this call to update_progress for now because every time update_progress is called,
@@ -120,12 +279,169 @@ class Overpass(object):
         except exceptions.RequestException as e:
             logger.error('Overpass query threw: {0}'.format(e))
             raise exceptions.RequestException(e)
+        if stopped and stopped.is_set():
+            remove_files([out_file])
+            return None
+        return out_file
+
+    def fetch_tile(self, tile, out_file, user_details=None, depth=0, stopped=None):
+        """
+        Fetch a single tile, retrying it and finally splitting it into quarters if overpass keeps failing.
+        Stops, removing the files of the tile, once the stopped event is set or a quarter of it fails.
+
+        Return:
+            a list of files holding the data for the tile, empty if stopped.
+        """
+        query = self.build_query(format_bbox(tile))
+        retries = int(settings.OVERPASS_TILE_RETRIES)
+        for attempt in range(retries + 1):
+            if stopped and stopped.is_set():
+                return []
+            try:
+                out = self.fetch(query, out_file, user_details=user_details, update=False, stopped=stopped)
+                return [out] if out else []
+            except Exception as e:
+                logger.warn('Overpass tile {0} failed on attempt {1}: {2}'.format(tile, attempt + 1, e))
+        remove_files([out_file])
+        if depth >= int(settings.OVERPASS_TILE_MAX_SPLITS):
+            raise Exception('Overpass tile {0} could not be retrieved.'.format(format_bbox(tile)))
+        # A tile which keeps failing is usually too dense for the server, try again with smaller tiles.
+        name, ext = os.path.splitext(out_file)
+        files = []
+        try:
+            for index, sub_tile in enumerate(split_bbox(tile, 2, 2)):
+                files += self.fetch_tile(sub_tile, '{0}_{1}{2}'.format(name, index, ext),
+                                         user_details=user_details, depth=depth + 1, stopped=stopped)
+        except Exception:
+            remove_files(files)
+            raise
+        if stopped and stopped.is_set():
+            remove_files(files)
+            return []
+        return files
+
+    def run_tiled_query(self, tiles, user_details=None, subtask_percentage=100):
+        """
+        Fetch the tiles concurrently and merge them into self.raw_osm.
+        A tile which fails stops the remaining downloads, and the files of all of the tiles are removed.
+        """
+        from ..tasks.export_tasks import update_progress
 
-        logger.debug('Query finished at %s'.format(datetime.now()))
-        logger.debug('Wrote overpass query results to: %s'.format(self.raw_osm))
+        name, ext = os.path.splitext(self.raw_osm)
+        tile_paths = ['{0}_tile_{1}{2}'.format(name, index, ext) for index in range(len(tiles))]
+        tile_files = []
+        executor = ThreadPoolExecutor(max_workers=int(settings.OVERPASS_TILE_WORKERS))
+        stopped = threading.Event()
+        futures = []
+        try:
+            for tile, tile_path in zip(tiles, tile_paths):
+                futures.append(executor.submit(self.fetch_tile, tile, tile_path, user_details=user_details,
+                                               stopped=stopped))
+            for completed, future in enumerate(as_completed(futures), 1):
+                tile_files += future.result()
+                # The download is weighted as half of the task, the rest is conversion.
+                update_progress(self.task_uid, progress=(50.0 * completed) / len(futures),
+                                subtask_percentage=subtask_percentage)
+            merge_osm_files(tile_files, self.raw_osm)
+        finally:
+            # Tiles still downloading after a failure stop and remove their own files, so don't wait for them.
+            stopped.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+            remove_files(tile_paths + tile_files)
         return self.raw_osm
 
 
+def remove_files(files):
+    """
+    Remove the files which exist.
+    """
+    for path in files:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def get_filtered_template(feature_selection):
+    """
+    Build a query template which only selects the elements matching the feature selection's tag filters, along with
+    the nodes and members needed to build their geometries.
+    """
+    filters = feature_selection.overpass_filters()
+    statements = []
+    for element_type in ('node', 'way', 'relation'):
+        for tag_filter in filters.get(element_type, []):
+            # Tag values may contain '$', which would otherwise be read as a template placeholder.
+            statements.append('{0}{1}($bbox);'.format(element_type, tag_filter.replace('$', '$$')))
+    return Template('[maxsize:$maxsize][timeout:$timeout];(' + ''.join(statements) + ');(._;>;);out body;')
+
+
+def format_bbox(bbox):
+    """
+    Convert a [minx, miny, maxx, maxy] bbox to the "<lat0>,<long0>,<lat1>,<long1>" form overpass expects.
+    """
+    return '{},{},{},{}'.format(bbox[1], bbox[0], bbox[3], bbox[2])
+
+
+def split_bbox(bbox, columns, rows):
+    """
+    Split a [minx, miny, maxx, maxy] bbox into a grid of columns x rows tiles.
+    """
+    minx, miny, maxx, maxy = bbox
+    width = (maxx - minx) / columns
+    height = (maxy - miny) / rows
+    tiles = []
+    for row in range(rows):
+        for column in range(columns):
+            tiles.append([
+                minx + column * width,
+                miny + row * height,
+                maxx if column == columns - 1 else minx + (column + 1) * width,
+                maxy if row == rows - 1 else miny + (row + 1) * height,
+            ])
+    return tiles
+
+
+def iter_osm_elements(osm_file):
+    """
+    Yield (order, id, xml) for each node, way and relation in an OSM XML file.
+    """
+    root = None
+    depth = 0
+    for event, elem in ElementTree.iterparse(osm_file, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elem.tag in OSM_ELEMENT_ORDER:
+            elem.tail = None
+            yield (OSM_ELEMENT_ORDER[elem.tag], int(elem.get('id')), ElementTree.tostring(elem))
+        # Drop parsed elements so large files are merged in constant memory.
+        root.clear()
+
+
+def merge_osm_files(osm_files, out_file):
+    """
+    Merge OSM XML files sorted by element type and id into out_file, dropping elements repeated across files
+    (e.g. nodes on tile edges and ways crossing tiles).
+    """
+    last_key = None
+    with open(out_file, 'wb') as fd:
+        fd.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="eventkit">\n')
+        for order, element_id, element in heapq.merge(*[iter_osm_elements(f) for f in osm_files]):
+            if (order, element_id) == last_key:
+                continue
+            last_key = (order, element_id)
+            fd.write(element)
+            fd.write('\n')
+        fd.write('</osm>\n')
+    return out_file
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Runs an overpass query using the provided bounding box')
     parser.add_argument('-o', '--osm-file', required=False, dest="osm",
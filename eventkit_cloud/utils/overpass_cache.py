@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import closing
+from tempfile import NamedTemporaryFile
+
+from django.conf import settings
+from pysqlite2 import dbapi2 as sqlite3
+
+logger = logging.getLogger(__name__)
+
+INDEX_SQL = '''
+CREATE TABLE IF NOT EXISTS extracts (
+    key TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    template TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    minx REAL NOT NULL,
+    miny REAL NOT NULL,
+    maxx REAL NOT NULL,
+    maxy REAL NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS extracts_last_access ON extracts (last_access);
+CREATE VIRTUAL TABLE IF NOT EXISTS extract_footprints USING rtree (id, minx, maxx, miny, maxy);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats VALUES ('hits', 0);
+INSERT OR IGNORE INTO stats VALUES ('misses', 0);
+INSERT OR IGNORE INTO stats VALUES ('containing_hits', 0);
+INSERT OR IGNORE INTO stats VALUES ('evictions', 0);
+'''
+
+
+def normalize_bbox(bbox, precision=None):
+    """
+    Round a [minx, miny, maxx, maxy] bbox so that requests for the same area share a cache key.
+    """
+    if precision is None:
+        precision = settings.OVERPASS_CACHE_BBOX_PRECISION
+    return [round(float(coord), int(precision)) for coord in bbox]
+
+
+def get_cache_key(bbox, template):
+    """
+    Content address for an extract: a hash of the normalized bbox and the query template which produced it.
+    """
+    content = json.dumps({'bbox': normalize_bbox(bbox), 'template': template}, sort_keys=True)
+    return hashlib.sha256(content).hexdigest()
+
+
+class OverpassCache(object):
+    """
+    A disk backed cache of raw Overpass extracts.
+
+    Extracts are stored in cache_dir by content address and tracked in a sqlite index, which is shared between
+    workers.  The footprint of each extract is kept in an rtree so that extracts covering a larger area can be used
+    for any bbox they contain.  Entries older than ttl seconds are never returned, and the least recently used entries
+    are evicted whenever the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=None, ttl=None):
+        """
+        Initialize the cache.
+
+        Args:
+            cache_dir: the directory to store extracts and the index in
+            max_size: the byte budget for stored extracts
+            ttl: the freshness window, in seconds
+        """
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size if max_size is not None else settings.OVERPASS_CACHE_MAX_SIZE)
+        self.ttl = int(ttl if ttl is not None else settings.OVERPASS_CACHE_TTL)
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Another worker may have created it.
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        self.index = os.path.join(self.cache_dir, 'index.sqlite')
+        with closing(self.connect()) as conn:
+            conn.executescript(INDEX_SQL)
+            conn.commit()
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Return:
+            the configured cache, or None if OVERPASS_CACHE_DIR isn't set.
+        """
+        cache_dir = getattr(settings, 'OVERPASS_CACHE_DIR', None)
+        if not cache_dir:
+            return None
+        try:
+            return cls(cache_dir)
+        except (OSError, sqlite3.Error) as e:
+            logger.error('The overpass cache at {0} could not be opened: {1}'.format(cache_dir, e))
+            return None
+
+    def connect(self):
+        # A generous timeout, since several workers may be writing to the index at once.  Using the connection as a
+        # context manager only commits or rolls back, so callers close it with contextlib.closing and commit themselves.
+        return sqlite3.connect(self.index, timeout=30)
+
+    def get(self, bbox, template, out_file):
+        """
+        Copy a fresh cached extract for bbox and template to out_file.
+
+        Return:
+            out_file if the extract was cached, otherwise None.
+        """
+        key = get_cache_key(bbox, template)
+        now = time.time()
+        with closing(self.connect()) as conn:
+            row = conn.execute('SELECT filename, created FROM extracts WHERE key = ?;', (key,)).fetchone()
+            if row and row[1] >= now - self.ttl and os.path.isfile(self.get_path(row[0])):
+                conn.execute('UPDATE extracts SET last_access = ? WHERE key = ?;', (now, key))
+                self.increment(conn, 'hits')
+            else:
+                if row:
+                    self.remove(conn, key, row[0])
+                self.increment(conn, 'misses')
+                row = None
+            conn.commit()
+        if not row:
+            logger.info('Overpass cache miss for {0}'.format(bbox))
+            return None
+        logger.info('Overpass cache hit for {0}'.format(bbox))
+        link_or_copy(self.get_path(row[0]), out_file)
+        return out_file
+
+    def get_containing(self, bbox, template, out_file):
+        """
+        Link the smallest fresh cached extract for template whose footprint contains bbox to out_file.
+        The extract will need to be clipped to bbox.
+
+        Return:
+            out_file if a containing extract was cached, otherwise None.
+        """
+        minx, miny, maxx, maxy = [float(coord) for coord in bbox]
+        now = time.time()
+        with closing(self.connect()) as conn:
+            rows = conn.execute(
+                'SELECT e.key, e.filename FROM extracts e JOIN extract_footprints f ON e.rowid = f.id '
+                'WHERE f.minx <= ? AND f.maxx >= ? AND f.miny <= ? AND f.maxy >= ? '
+                'AND e.template = ? AND e.created >= ? '
+                'ORDER BY (f.maxx - f.minx) * (f.maxy - f.miny) ASC;',
+                (minx, maxx, miny, maxy, template, now - self.ttl)).fetchall()
+            for key, filename in rows:
+                try:
+                    link_or_copy(self.get_path(filename), out_file)
+                except (IOError, OSError):
+                    # Evicted by another worker since the lookup.
+                    continue
+                conn.execute('UPDATE extracts SET last_access = ? WHERE key = ?;', (now, key))
+                self.increment(conn, 'containing_hits')
+                conn.commit()
+                logger.info('Overpass cache has an extract containing {0}'.format(bbox))
+                return out_file
+        return None
+
+    def put(self, bbox, template, in_file):
+        """
+        Store a copy of in_file as the extract for bbox and template, evicting older extracts if needed.
+
+        Return:
+            the cache key of the stored extract, or None if the extract is larger than the cache.
+        """
+        size = os.path.getsize(in_file)
+        if size > self.max_size:
+            logger.info('Not caching {0}, it is larger than the overpass cache.'.format(in_file))
+            return None
+        key = get_cache_key(bbox, template)
+        filename = '{0}{1}'.format(key, os.path.splitext(in_file)[1])
+        # Copy under a temporary name first so readers never see a partial extract, the staged file may still be
+        # rewritten by the task which produced it.
+        with NamedTemporaryFile(dir=self.cache_dir, delete=False) as temp_file:
+            with open(in_file, 'rb') as source:
+                shutil.copyfileobj(source, temp_file)
+        os.rename(temp_file.name, self.get_path(filename))
+        now = time.time()
+        minx, miny, maxx, maxy = normalize_bbox(bbox)
+        with closing(self.connect()) as conn:
+            conn.execute('DELETE FROM extract_footprints WHERE id IN (SELECT rowid FROM extracts WHERE key = ?);',
+                         (key,))
+            row_id = conn.execute('INSERT OR REPLACE INTO extracts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                                  (key, filename, template, size, minx, miny, maxx, maxy, now, now)).lastrowid
+            conn.execute('INSERT INTO extract_footprints VALUES (?, ?, ?, ?, ?);', (row_id, minx, maxx, miny, maxy))
+            self.evict(conn)
+            conn.commit()
+        return key
+
+    def evict(self, conn):
+        """
+        Remove the least recently used extracts until the cache fits in max_size.
+        """
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM extracts;').fetchone()[0]
+        if total <= self.max_size:
+            return
+        for key, filename, size in conn.execute(
+                'SELECT key, filename, size FROM extracts ORDER BY last_access ASC;').fetchall():
+            if total <= self.max_size:
+                break
+            self.remove(conn, key, filename)
+            self.increment(conn, 'evictions')
+            total -= size
+
+    def remove(self, conn, key, filename):
+        conn.execute('DELETE FROM extract_footprints WHERE id IN (SELECT rowid FROM extracts WHERE key = ?);',
+                     (key,))
+        conn.execute('DELETE FROM extracts WHERE key = ?;', (key,))
+        try:
+            os.remove(self.get_path(filename))
+        except OSError:
+            pass
+
+    def get_path(self, filename):
+        return os.path.join(self.cache_dir, filename)
+
+    @staticmethod
+    def increment(conn, name):
+        conn.execute('UPDATE stats SET value = value + 1 WHERE name = ?;', (name,))
+
+    def stats(self):
+        """
+        Return:
+            a dict with the hit, containing hit, miss and eviction counters and the current size of the cache.
+        """
+        with closing(self.connect()) as conn:
+            stats = dict(conn.execute('SELECT name, value FROM stats;').fetchall())
+            stats['entries'], stats['size'] = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extracts;').fetchone()
+        stats['max_size'] = self.max_size
+        # Lookups served from a containing extract were first counted as misses.
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits'] + stats['containing_hits']) / lookups if lookups else 0.0
+        return stats
+
+
+def link_or_copy(src, dst):
+    """
+    Hard link src to dst, copying it if they are on different file systems.
+    Cached extracts are never modified in place, evictions only unlink them.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, dst)
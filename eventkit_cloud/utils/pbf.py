@@ -2,9 +2,16 @@
 from __future__ import with_statement
 
 import argparse
+import errno
+import json
 import logging
 import os
+import struct
 import subprocess
+import time
+import zlib
+from tempfile import TemporaryFile
+from django.conf import settings
 from ..tasks.task_process import TaskProcess
 from string import Template
 
@@ -16,13 +23,14 @@ class OSMToPBF(object):
     Convert OSM to PBF.
     """
 
-    def __init__(self, osm=None, pbffile=None, debug=False, task_uid=None):
+    def __init__(self, osm=None, pbffile=None, debug=False, task_uid=None, bbox=None):
         """
         Initialize the OSMToPBF utility.
 
         Args:
             osm: the raw osm file to convert
             pbffile: the location of the pbf output file
+            bbox: an optional [minx, miny, maxx, maxy] bbox to clip the data to while converting
         """
         self.osm = osm
         if not os.path.exists(self.osm):
@@ -33,16 +41,24 @@ class OSMToPBF(object):
             root = self.osm.split('.')[0]
             self.pbffile = root + '.pbf'
         self.debug = debug
-        self.cmd = Template('osmconvert $osm --out-pbf >$pbf')
+        self.bbox = bbox
+        if self.bbox:
+            self.cmd = Template('osmconvert $osm -b=$bbox --out-pbf >$pbf')
+        else:
+            self.cmd = Template('osmconvert $osm --out-pbf >$pbf')
         self.task_uid = task_uid
+        self.stats = None
 
     def convert(self, ):
         """
         Convert the raw osm to pbf.
         """
-        convert_cmd = self.cmd.safe_substitute({'osm': self.osm, 'pbf': self.pbffile})
+        convert_cmd = self.cmd.safe_substitute({
+            'osm': self.osm, 'pbf': self.pbffile, 'bbox': ','.join(str(coord) for coord in self.bbox or [])
+        })
         if (self.debug):
             print 'Running: %s' % convert_cmd
+        start = time.time()
         task_process = TaskProcess(task_uid=self.task_uid)
         task_process.start_process(convert_cmd, shell=True, executable='/bin/bash', stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
@@ -54,9 +70,296 @@ class OSMToPBF(object):
 
         if (self.debug):
             print 'Osmconvert returned: %s' % task_process.exitcode
+        osm_bytes = get_size(self.osm)
+        self.stats = conversion_stats(osm_bytes, self.pbffile, time.time() - start, staged_bytes=osm_bytes)
+        return self.pbffile
+
+
+class OSMStreamToPBF(object):
+    """
+    Convert a stream of OSM XML to PBF without staging the OSM XML on disk.
+    """
+
+    def __init__(self, pbffile=None, debug=False, task_uid=None):
+        """
+        Initialize the OSMStreamToPBF utility.
+
+        Args:
+            pbffile: the location of the pbf output file
+        """
+        self.pbffile = pbffile
+        self.debug = debug
+        self.cmd = ['osmconvert', '-', '--out-pbf']
+        self.task_uid = task_uid
+        self.stats = None
+
+    def convert(self, chunks, user_details=None):
+        """
+        Pipe the chunks of OSM XML into osmconvert, which writes the PBF through an audited file.
+        """
+        from audit_logging.file_logging import logging_open
+
+        if (self.debug):
+            print 'Running: %s' % ' '.join(self.cmd)
+        start = time.time()
+        bytes_in = 0
+        with TemporaryFile() as stderr, logging_open(self.pbffile, 'wb', user_details=user_details) as out:
+            proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=out, stderr=stderr)
+            TaskProcess(task_uid=self.task_uid).store_pid(pid=proc.pid)
+            try:
+                for chunk in chunks:
+                    proc.stdin.write(chunk)
+                    bytes_in += len(chunk)
+                proc.stdin.close()
+            except IOError as e:
+                # osmconvert exited early, its exit code and stderr explain why.
+                if e.errno != errno.EPIPE:
+                    proc.kill()
+                    proc.wait()
+                    raise
+            except Exception:
+                proc.kill()
+                proc.wait()
+                raise
+            exitcode = proc.wait()
+            if exitcode != 0:
+                stderr.seek(0)
+                logger.error('{0}'.format(stderr.read()))
+                logger.error("osmconvert failed with return code: {0}".format(exitcode))
+                logger.error("osmconvert most commonly fails due to lack of memory.")
+                raise Exception("Osmconvert Failed.")
+
+        if (self.debug):
+            print 'Osmconvert returned: %s' % exitcode
+        self.stats = conversion_stats(bytes_in, self.pbffile, time.time() - start)
         return self.pbffile
 
 
+class PBFExtract(object):
+    """
+    Extract an area from a locally maintained regional or planet PBF.
+    """
+
+    def __init__(self, pbf=None, pbffile=None, boundary=None, debug=False, task_uid=None):
+        """
+        Initialize the PBFExtract utility.
+
+        Args:
+            pbf: the regional pbf to extract from
+            pbffile: the location of the pbf output file
+            boundary: a [minx, miny, maxx, maxy] bbox, or the path of a geojson file with the polygon to extract
+        """
+        self.pbf = pbf
+        if not os.path.exists(self.pbf):
+            raise IOError('Cannot find the regional PBF {0}.'.format(self.pbf))
+        self.pbffile = pbffile
+        self.boundary = boundary
+        self.poly_file = '{0}.poly'.format(os.path.splitext(self.pbffile)[0])
+        self.debug = debug
+        # Ways and relations crossing the boundary are kept whole, as they are in the overpass query results.
+        self.cmd = Template('osmconvert $pbf -B=$poly --complete-ways --complex-ways --out-pbf -o=$out')
+        self.task_uid = task_uid
+        self.stats = None
+
+    def extract(self, ):
+        """
+        Extract the boundary from the regional pbf.
+        """
+        write_poly_file(self.boundary, self.poly_file)
+        extract_cmd = self.cmd.safe_substitute({'pbf': self.pbf, 'poly': self.poly_file, 'out': self.pbffile})
+        if (self.debug):
+            print 'Running: %s' % extract_cmd
+        start = time.time()
+        task_process = TaskProcess(task_uid=self.task_uid)
+        task_process.start_process(extract_cmd, shell=True, executable='/bin/bash', stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        if task_process.exitcode != 0:
+            logger.error('{0}'.format(task_process.stderr))
+            logger.error("osmconvert failed with return code: {0}".format(task_process.exitcode))
+            raise Exception("Osmconvert Failed.")
+
+        if (self.debug):
+            print 'Osmconvert returned: %s' % task_process.exitcode
+        self.stats = conversion_stats(get_size(self.pbf), self.pbffile, time.time() - start)
+        return self.pbffile
+
+
+# The bounds of the regional PBFs by path and modification time, so each header is only read once.
+_pbf_bounds = {}
+
+
+def get_local_pbf(url, bbox=None):
+    """
+    Resolve the url of an osm-local provider to the regional PBF it names.
+    Relative paths are relative to OSM_LOCAL_PBF_DIR.  The url may name a directory of regional extracts, in which
+    case the smallest extract covering the bbox is used.
+    """
+    path = url[len('file://'):] if url.startswith('file://') else url
+    if not os.path.isabs(path):
+        local_dir = getattr(settings, 'OSM_LOCAL_PBF_DIR', None)
+        if not local_dir:
+            raise Exception('OSM_LOCAL_PBF_DIR must be set to use relative PBF paths.')
+        path = os.path.join(local_dir, path)
+    if bbox and os.path.isdir(path):
+        return select_extract(path, bbox)
+    return path
+
+
+def select_extract(directory, bbox):
+    """
+    Choose the smallest PBF in the directory whose bounds contain the bbox.  Extracting from it only reads the region
+    around the bbox rather than the whole planet.  PBFs without bounds in their header are treated as covering the
+    whole world.
+
+    Args:
+        directory: a directory of regional extracts
+        bbox: a [minx, miny, maxx, maxy] bbox
+    """
+    minx, miny, maxx, maxy = [float(coord) for coord in bbox]
+    candidates = []
+    for filename in os.listdir(directory):
+        if not filename.endswith('.pbf'):
+            continue
+        path = os.path.join(directory, filename)
+        bounds = read_pbf_bounds(path) or [-180, -90, 180, 90]
+        if bounds[0] <= minx and bounds[1] <= miny and bounds[2] >= maxx and bounds[3] >= maxy:
+            candidates.append(((bounds[2] - bounds[0]) * (bounds[3] - bounds[1]), get_size(path), path))
+    if not candidates:
+        raise Exception('None of the regional PBFs in {0} cover {1}.'.format(directory, bbox))
+    return min(candidates)[2]
+
+
+def read_pbf_bounds(path):
+    """
+    Read the bounding box from the header block of a PBF.
+
+    Return:
+        the [minx, miny, maxx, maxy] bounds, or None if the header doesn't have any
+    """
+    key = (path, os.path.getmtime(path))
+    if key not in _pbf_bounds:
+        with open(path, 'rb') as pbf_file:
+            header_length, = struct.unpack('>i', pbf_file.read(4))
+            blob_header = dict(read_protobuf(pbf_file.read(header_length)))
+            blob = dict(read_protobuf(pbf_file.read(blob_header[3])))
+        if blob_header.get(1) != 'OSMHeader':
+            raise Exception('{0} is not an OSM PBF.'.format(path))
+        # The block is either stored raw or zlib compressed.
+        header_block = dict(read_protobuf(blob[1] if 1 in blob else zlib.decompress(blob[3])))
+        bounds = None
+        if 1 in header_block:
+            # The left, right, top and bottom of the HeaderBBox, zigzag encoded nanodegrees.
+            bbox = dict((field, ((value >> 1) ^ -(value & 1)) / 1e9)
+                        for field, value in read_protobuf(header_block[1]))
+            bounds = [bbox.get(1, 0), bbox.get(4, 0), bbox.get(2, 0), bbox.get(3, 0)]
+        _pbf_bounds[key] = bounds
+    return _pbf_bounds[key]
+
+
+def read_protobuf(data):
+    """
+    Return:
+        the field numbers and values of a protocol buffer message, for varint and length delimited fields
+    """
+    fields = []
+    index = 0
+    while index < len(data):
+        key, index = read_varint(data, index)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, index = read_varint(data, index)
+        elif wire_type == 2:
+            length, index = read_varint(data, index)
+            value, index = data[index:index + length], index + length
+        elif wire_type in (1, 5):
+            length = 8 if wire_type == 1 else 4
+            value, index = data[index:index + length], index + length
+        else:
+            raise Exception('Unsupported protocol buffer wire type {0}.'.format(wire_type))
+        fields.append((field, value))
+    return fields
+
+
+def read_varint(data, index):
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[index])
+        index += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, index
+
+
+def write_poly_file(boundary, poly_file):
+    """
+    Write a boundary in the osmosis polygon filter format used by osmconvert.
+
+    Args:
+        boundary: a [minx, miny, maxx, maxy] bbox, or the path of a geojson file with a (multi)polygon
+        poly_file: the path to write to
+    """
+    if isinstance(boundary, basestring):
+        with open(boundary) as geojson_file:
+            polygons = get_polygons(json.load(geojson_file))
+    else:
+        minx, miny, maxx, maxy = boundary
+        polygons = [[[[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]]]
+    lines = ['boundary']
+    for index, polygon in enumerate(polygons):
+        for ring_index, ring in enumerate(polygon):
+            # The first ring is the exterior, the rest are holes.
+            lines.append('{0}{1}'.format('!' if ring_index else '', '{0}_{1}'.format(index + 1, ring_index + 1)))
+            lines += ['{0} {1}'.format(coord[0], coord[1]) for coord in ring]
+            lines.append('END')
+    lines.append('END')
+    with open(poly_file, 'w') as open_file:
+        open_file.write('\n'.join(lines) + '\n')
+    return poly_file
+
+
+def get_polygons(geojson):
+    """
+    Return:
+        the polygon coordinates of a geojson geometry, feature or feature collection.
+    """
+    if geojson.get('type') == 'FeatureCollection':
+        return [polygon for feature in geojson.get('features') for polygon in get_polygons(feature)]
+    if geojson.get('type') == 'Feature':
+        return get_polygons(geojson.get('geometry'))
+    if geojson.get('type') == 'Polygon':
+        return [geojson.get('coordinates')]
+    if geojson.get('type') == 'MultiPolygon':
+        return geojson.get('coordinates')
+    raise Exception('The boundary must be a polygon or multipolygon.')
+
+
+def get_size(path):
+    # The stats are informational only, a missing file shouldn't fail the conversion.
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def conversion_stats(bytes_in, pbffile, seconds, staged_bytes=0):
+    """
+    Log and return the throughput of an OSM to PBF conversion and the disk it used at its peak.
+    """
+    pbf_bytes = get_size(pbffile)
+    stats = {
+        'osm_bytes': bytes_in,
+        'pbf_bytes': pbf_bytes,
+        'seconds': seconds,
+        'throughput': bytes_in / seconds if seconds else 0,
+        'peak_disk_bytes': staged_bytes + pbf_bytes,
+    }
+    logger.info('Converted {osm_bytes} bytes of OSM to {pbf_bytes} bytes of PBF in {seconds:.1f}s '
+                '({throughput:.0f} B/s), peak disk usage {peak_disk_bytes} bytes.'.format(**stats))
+    return stats
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Converts OSM XML to PBF')
     parser.add_argument('-o', '--osm-file', required=True, dest="osm", help='The OSM file to convert')
@@ -4,6 +4,7 @@ from django.utils.translation import ugettext as _
 from enum import Enum
 import json
 import logging
+import os
 from osgeo import ogr
 import re
 import requests
@@ -518,11 +519,36 @@ class TMSProviderCheck(ProviderCheck):
         self.service_url = self.service_url.format(z='0', y='0', x='0')
 
 
+class LocalPBFProviderCheck(ProviderCheck):
+    """
+    Implementation of ProviderCheck for osm-local providers, which only need their regional PBF to be on disk.
+    """
+
+    def get_check_response(self):
+        from eventkit_cloud.utils.pbf import get_local_pbf
+
+        if not self.service_url:
+            self.result = CheckResults.NO_URL
+            return None
+        try:
+            pbf_path = get_local_pbf(self.service_url)
+        except Exception as ex:
+            logger.error("Provider check failed for {}: {}".format(self.service_url, ex.message))
+            self.result = CheckResults.NOT_FOUND
+            return None
+        if not os.path.isfile(pbf_path) and not os.path.isdir(pbf_path):
+            logger.error("The regional PBF {} was not found".format(pbf_path))
+            self.result = CheckResults.NOT_FOUND
+            return None
+        return pbf_path
+
+
 PROVIDER_CHECK_MAP = {
     "wfs": WFSProviderCheck,
     "wcs": WCSProviderCheck,
     "wms": WMSProviderCheck,
     "osm": OverpassProviderCheck,
+    "osm-local": LocalPBFProviderCheck,
     "wmts": WMTSProviderCheck,
     "arcgis-raster": ProviderCheck,
     "arcgis-feature": ProviderCheck,
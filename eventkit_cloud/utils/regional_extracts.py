@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import glob
+import logging
+import os
+import subprocess
+import time
+from string import Template
+
+from django.conf import settings
+
+from ..tasks.task_process import TaskProcess
+
+logger = logging.getLogger(__name__)
+
+CHANGE_FILE_PATTERNS = ('*.osc', '*.osc.gz')
+
+# osmupdate exits with 21 when there are no diffs newer than the file.
+OSMUPDATE_UP_TO_DATE = 21
+
+
+class RegionalExtract(object):
+    """
+    A regional PBF on local disk, kept current by applying OSM change files instead of downloading it again.
+
+    Change files placed in the change directory of the region (<region>.changes next to the PBF) are applied in name
+    order and removed.  If update_url is set, osmupdate also fetches and applies the replication diffs published since
+    the timestamp of the PBF.  If a <region>.poly file is next to the PBF the updated data is clipped to it, so that
+    planet wide diffs don't grow the extract beyond its region.
+    """
+
+    def __init__(self, pbf, update_url=None, task_uid=None):
+        """
+        Initialize the RegionalExtract.
+
+        Args:
+            pbf: the regional pbf to keep current
+            update_url: the base url of an OSM replication server to fetch diffs from
+        """
+        self.pbf = pbf
+        self.region = get_region_name(pbf)
+        base = os.path.join(os.path.dirname(pbf), self.region)
+        self.changes_dir = '{0}.changes'.format(base)
+        self.poly_file = '{0}.poly'.format(base)
+        if not os.path.isfile(self.poly_file):
+            self.poly_file = None
+        self.lock_file = '{0}.lock'.format(base)
+        # Not a .pbf, so a partial update is never mistaken for a region.
+        self.update_file = '{0}.pbf.updating'.format(base)
+        self.update_url = update_url
+        self.task_uid = task_uid
+        self.apply_cmd = Template('osmconvert $pbf $changes $clip --out-pbf -o=$out')
+        self.fetch_cmd = Template('osmupdate $pbf $out --base-url=$url --tempfiles=$tempfiles $clip')
+
+    def update(self, ):
+        """
+        Bring the PBF up to date.  The updated PBF replaces the old one atomically, exports which already opened the
+        old file keep reading it.
+
+        Return:
+            True if the PBF was updated, False if it was current or another worker is updating it.
+        """
+        with open(self.lock_file, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                logger.info('{0} is already being updated.'.format(self.pbf))
+                return False
+            start = time.time()
+            updated = bool(self.apply_changes())
+            if self.update_url:
+                updated = self.fetch_changes() or updated
+            if updated:
+                logger.info('Updated {0} in {1:.1f}s.'.format(self.pbf, time.time() - start))
+            return updated
+
+    def pending_changes(self, ):
+        """
+        Return:
+            the change files waiting to be applied, in the order to apply them.
+        """
+        changes = []
+        for pattern in CHANGE_FILE_PATTERNS:
+            changes += glob.glob(os.path.join(self.changes_dir, pattern))
+        return sorted(changes, key=os.path.basename)
+
+    def apply_changes(self, ):
+        """
+        Apply the pending change files to the PBF in a single pass.
+
+        Return:
+            the change files that were applied.
+        """
+        changes = self.pending_changes()
+        if not changes:
+            return []
+        logger.info('Applying {0} change files to {1}.'.format(len(changes), self.pbf))
+        task_process = self.run(self.apply_cmd.safe_substitute({
+            'pbf': self.pbf, 'changes': ' '.join(changes), 'clip': self.get_clip_option(), 'out': self.update_file
+        }))
+        if task_process.exitcode != 0:
+            logger.error('{0}'.format(task_process.stderr))
+            logger.error("osmconvert failed with return code: {0}".format(task_process.exitcode))
+            self.remove_update_file()
+            raise Exception("Osmconvert Failed.")
+        os.rename(self.update_file, self.pbf)
+        for change_file in changes:
+            os.remove(change_file)
+        return changes
+
+    def fetch_changes(self, ):
+        """
+        Fetch and apply the diffs published since the timestamp of the PBF.
+
+        Return:
+            True if the PBF was updated.
+        """
+        tempfiles = os.path.join(self.changes_dir, 'osmupdate_temp')
+        if not os.path.isdir(tempfiles):
+            os.makedirs(tempfiles)
+        task_process = self.run(self.fetch_cmd.safe_substitute({
+            'pbf': self.pbf, 'out': self.update_file, 'url': self.update_url,
+            'tempfiles': os.path.join(tempfiles, 'temp'), 'clip': self.get_clip_option()
+        }))
+        if task_process.exitcode == OSMUPDATE_UP_TO_DATE:
+            logger.info('{0} is up to date.'.format(self.pbf))
+            self.remove_update_file()
+            return False
+        if task_process.exitcode != 0:
+            logger.error('{0}'.format(task_process.stderr))
+            logger.error("osmupdate failed with return code: {0}".format(task_process.exitcode))
+            self.remove_update_file()
+            raise Exception("Osmupdate Failed.")
+        os.rename(self.update_file, self.pbf)
+        return True
+
+    def get_clip_option(self, ):
+        return '-B={0}'.format(self.poly_file) if self.poly_file else ''
+
+    def run(self, cmd):
+        logger.debug('Running: {0}'.format(cmd))
+        task_process = TaskProcess(task_uid=self.task_uid)
+        task_process.start_process(cmd, shell=True, executable='/bin/bash', stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        return task_process
+
+    def remove_update_file(self, ):
+        if os.path.exists(self.update_file):
+            os.remove(self.update_file)
+
+
+def get_region_name(pbf):
+    name = os.path.basename(pbf)
+    for extension in ('.osm.pbf', '.pbf'):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def get_regional_extracts(pbf_dir=None):
+    """
+    Return:
+        a RegionalExtract for each PBF in pbf_dir, which defaults to OSM_LOCAL_PBF_DIR.
+    """
+    pbf_dir = pbf_dir or getattr(settings, 'OSM_LOCAL_PBF_DIR', None)
+    if not pbf_dir:
+        return []
+    update_url = getattr(settings, 'OSM_LOCAL_UPDATE_URL', None)
+    return [RegionalExtract(pbf, update_url=update_url)
+            for pbf in sorted(glob.glob(os.path.join(pbf_dir, '*.pbf')))]
+
+
+def update_regional_extracts(pbf_dir=None):
+    """
+    Update every regional PBF in pbf_dir.  A region which fails to update is logged and skipped, so that one bad
+    change file doesn't hold back the other regions.
+
+    Return:
+        the PBFs which were updated.
+    """
+    updated = []
+    for extract in get_regional_extracts(pbf_dir):
+        try:
+            if extract.update():
+                updated.append(extract.pbf)
+        except Exception as e:
+            logger.error('Could not update {0}: {1}'.format(extract.pbf, e))
+    return updated
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from mapproxy.grid import MetaGrid
+from mapproxy.seed import seeder
+
+logger = logging.getLogger(__name__)
+
+# MapProxy logs each request to a source on this logger with the method, url, status, size and duration in ms.
+REQUEST_LOGGER = 'mapproxy.source.request'
+
+# The statuses services use to ask clients to slow down.
+THROTTLE_STATUSES = ['429', '503']
+# Back off when more requests than this fail.
+MAX_ERROR_RATE = 0.05
+# Back off when requests take this much longer than they usually do.
+LATENCY_TOLERANCE = 1.5
+# Weight of the latest level in the usual latency.
+LATENCY_SMOOTHING = 0.3
+# Levels with fewer requests than this say too little about the service to change the concurrency.
+MIN_REQUESTS = 20
+# Levels are seeded in bands of about this many tiles, so the concurrency also changes within the large levels.
+BATCH_TILES = 1024
+# How long the concurrency learned for a provider is kept.
+STATE_TIMEOUT = 60 * 60 * 24 * 7
+
+
+class RequestStats(object):
+    """
+    Counts the requests MapProxy makes to the provider.  The counts are kept in shared memory, so that the seeding
+    workers forked by MapProxy all add to them.
+    """
+
+    def __init__(self):
+        self.lock = multiprocessing.Lock()
+        self.requests = multiprocessing.RawValue('l', 0)
+        self.errors = multiprocessing.RawValue('l', 0)
+        self.throttled = multiprocessing.RawValue('l', 0)
+        self.duration = multiprocessing.RawValue('l', 0)
+
+    def add(self, status, duration):
+        status = str(status)
+        with self.lock:
+            self.requests.value += 1
+            # Missing tiles are expected, only server and connection errors count against the service.
+            if status == '429' or not status.isdigit() or int(status) >= 500:
+                self.errors.value += 1
+            if status in THROTTLE_STATUSES:
+                self.throttled.value += 1
+            if str(duration).isdigit():
+                self.duration.value += int(duration)
+
+    def take(self):
+        """
+        Return:
+            the counts since the last call, as keyword arguments for ConcurrencyController.update.
+        """
+        with self.lock:
+            counts = {'requests': self.requests.value, 'errors': self.errors.value,
+                      'throttled': self.throttled.value, 'duration': self.duration.value}
+            for value in [self.requests, self.errors, self.throttled, self.duration]:
+                value.value = 0
+        return counts
+
+
+class RequestStatsHandler(logging.Handler):
+
+    def __init__(self, stats):
+        logging.Handler.__init__(self)
+        self.stats = stats
+
+    def emit(self, record):
+        try:
+            method, url, status, size, duration = record.args[:5]
+        except (TypeError, ValueError):
+            return
+        self.stats.add(status, duration)
+
+
+@contextmanager
+def record_requests(stats):
+    """
+    Count the requests MapProxy makes to sources in stats.
+    """
+    request_logger = logging.getLogger(REQUEST_LOGGER)
+    level, propagate = request_logger.level, request_logger.propagate
+    if not request_logger.isEnabledFor(logging.INFO):
+        # Count the requests without logging each of them.
+        request_logger.setLevel(logging.INFO)
+        request_logger.propagate = False
+    handler = RequestStatsHandler(stats)
+    request_logger.addHandler(handler)
+    try:
+        yield stats
+    finally:
+        request_logger.removeHandler(handler)
+        request_logger.setLevel(level)
+        request_logger.propagate = propagate
+
+
+class ConcurrencyController(object):
+    """
+    Chooses how many requests seeding makes to a provider at once.
+
+    The concurrency doubles while the provider keeps up, until it first has to back off, and then grows by one request
+    at a time.  It is halved when the provider throttles or fails requests, and reduced by one when requests take much
+    longer than they usually do.  The concurrency is kept in the cache, so that the next export of the provider starts
+    from it.
+    """
+
+    def __init__(self, provider, max_concurrency=None, cache=None):
+        """
+        Args:
+            provider: the slug of the provider
+            max_concurrency: the most requests to make at once, defaults to MAPPROXY_CONCURRENCY
+            cache: the cache to keep the concurrency in
+        """
+        default = max(1, int(getattr(settings, 'MAPPROXY_CONCURRENCY', 1)))
+        self.provider = provider
+        self.max_concurrency = max(1, int(max_concurrency or default))
+        self.cache = cache or caches['default']
+        state = self.cache.get(self.cache_key) or {}
+        self.concurrency = max(1, min(state.get('concurrency', default), self.max_concurrency))
+        self.latency = state.get('latency')
+        self.slow_start = state.get('slow_start', True)
+
+    @property
+    def cache_key(self):
+        return 'seed_concurrency_{0}'.format(self.provider)
+
+    def update(self, requests=0, errors=0, throttled=0, duration=0):
+        """
+        Adjust the concurrency to the requests made at the current concurrency.
+
+        Args:
+            requests: the number of requests made
+            errors: the number of requests which failed, including the throttled ones
+            throttled: the number of requests the provider refused with 429 or 503
+            duration: the total time the requests took, in ms
+        Return:
+            the new concurrency.
+        """
+        if requests < MIN_REQUESTS:
+            return self.concurrency
+        latency = float(duration) / requests
+        previous = self.concurrency
+        if throttled or float(errors) / requests > MAX_ERROR_RATE:
+            self.concurrency = max(1, self.concurrency // 2)
+            self.slow_start = False
+        elif self.latency and latency > self.latency * LATENCY_TOLERANCE:
+            self.concurrency = max(1, self.concurrency - 1)
+            self.slow_start = False
+        else:
+            self.latency = latency if not self.latency else \
+                (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+            step = self.concurrency if self.slow_start else 1
+            self.concurrency = min(self.max_concurrency, self.concurrency + step)
+        if self.concurrency != previous:
+            logger.info('Changed the concurrency of {0} from {1} to {2} after {3} requests, {4} failed, {5} throttled '
+                        'and {6:.0f}ms on average.'.format(self.provider, previous, self.concurrency, requests, errors,
+                                                            throttled, latency))
+        self.save()
+        return self.concurrency
+
+    def save(self):
+        self.cache.set(self.cache_key, {'concurrency': self.concurrency, 'latency': self.latency,
+                                        'slow_start': self.slow_start}, STATE_TIMEOUT)
+
+
+class LevelSeedTask(seeder.SeedTask):
+    """
+    A single level of a MapProxy seed task, or a band of rows of it.  MapProxy checkpoints the progress of a task under
+    its id, which is the same for all of the levels of the task, so the level and band are added to the id to give each
+    of them a checkpoint of its own.
+    """
+
+    def __init__(self, task, level, band=None, batch=0):
+        """
+        Args:
+            task: the MapProxy seed task
+            level: the level to seed
+            band: the (miny, maxy) of the rows to seed, in the srs of the grid, or None for the whole level
+            batch: the number of the band in the level
+        """
+        super(LevelSeedTask, self).__init__(task.md, task.tile_manager, [level], task.refresh_timestamp, task.coverage)
+        self.band = band
+        self.batch = batch
+        if band:
+            # Tiles which only touch the band, give or take rounding, belong to the next one.
+            self.tolerance = self.grid.resolutions[level] * self.grid.tile_size[1] / 100.0
+
+    @property
+    def id(self):
+        return super(LevelSeedTask, self).id + (self.levels[0], self.batch)
+
+    def intersects(self, bbox):
+        intersection = super(LevelSeedTask, self).intersects(bbox)
+        if not intersection or not self.band:
+            return intersection
+        miny, maxy = self.band
+        if bbox[1] >= maxy - self.tolerance or bbox[3] <= miny + self.tolerance:
+            return seeder.NONE
+        if bbox[1] < miny - self.tolerance or bbox[3] > maxy + self.tolerance:
+            return seeder.INTERSECTS
+        return intersection
+
+
+def level_bands(task, level):
+    """
+    Split a level of a seed task into bands of whole rows of meta tiles with about BATCH_TILES tiles each.
+
+    Return:
+        the (miny, maxy) of each band in the srs of the grid, or [None] if the level fits in one.
+    """
+    meta_size = task.tile_manager.meta_grid.meta_size if task.tile_manager.meta_grid else (1, 1)
+    grid = MetaGrid(task.grid, meta_size=meta_size, meta_buffer=0)
+    bbox, (columns, rows), tiles = grid.get_affected_level_tiles(task.coverage.extent.bbox_for(task.grid.srs), level)
+    rows_per_band = max(1, BATCH_TILES // (columns * meta_size[0] * meta_size[1]))
+    if rows_per_band >= rows:
+        return [None]
+    row_height = float(bbox[3] - bbox[1]) / rows
+    return [(bbox[1] + row * row_height, bbox[1] + min(rows, row + rows_per_band) * row_height)
+            for row in range(0, rows, rows_per_band)]
+
+
+def seed(tasks, controller, progress_logger=None):
+    """
+    Seed the tasks a level, or a band of a large level, at a time, with the concurrency the controller chooses from
+    the requests of the previous ones.
+
+    Args:
+        tasks: the MapProxy seed tasks
+        controller: a ConcurrencyController for the provider
+        progress_logger: a CustomLogger, which is told how much of the whole seeding each band is
+    """
+    levels = [(task, level) for task in tasks for level in task.levels]
+    # Each level has four times the tiles of the level above it.
+    weights = [4 ** level for task, level in levels]
+    total = float(sum(weights))
+    done = 0
+    with record_requests(RequestStats()) as stats:
+        for (task, level), weight in zip(levels, weights):
+            bands = level_bands(task, level)
+            for batch, band in enumerate(bands):
+                level_task = LevelSeedTask(task, level, band, batch)
+                # The bands of a level are the same height, but for the last one.
+                band_weight = weight * (band[1] - band[0]) / (bands[-1][1] - bands[0][0]) if band else weight
+                if progress_logger:
+                    progress_logger.progress_offset = done / total
+                    progress_logger.progress_scale = band_weight / total
+                seeder.seed(tasks=[level_task], concurrency=controller.concurrency, progress_logger=progress_logger)
+                done += band_weight
+                controller.update(**stats.take())
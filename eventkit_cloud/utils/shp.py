@@ -7,6 +7,7 @@ import os
 import shutil
 import subprocess
 from ..tasks.task_process import TaskProcess
+from .gdalutils import run_gdal
 from string import Template
 
 logger = logging.getLogger(__name__)
@@ -48,9 +49,7 @@ class GPKGToShp(object):
         convert_cmd = self.cmd.safe_substitute({'shp': self.shapefile, 'gpkg': self.gpkg, 'layer_name': layer_name})
         if (self.debug):
             print 'Running: %s' % convert_cmd
-        task_process = TaskProcess(task_uid=self.task_uid)
-        task_process.start_process(convert_cmd, shell=True, executable='/bin/bash',
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        task_process = run_gdal(convert_cmd, task_uid=self.task_uid)
         if task_process.exitcode != 0:
             logger.error('%s', task_process.stderr)
             raise Exception, "ogr2ogr process failed with returncode {0}".format(task_process.exitcode)
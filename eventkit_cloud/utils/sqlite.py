@@ -4,8 +4,7 @@ from __future__ import with_statement
 import argparse
 import logging
 import os
-import subprocess
-from ..tasks.task_process import TaskProcess
+from .gdalutils import run_gdal
 from string import Template
 from pysqlite2 import dbapi2 as sqlite3
 
@@ -46,9 +45,7 @@ class GPKGToSQLite(object):
                                                 'gpkg': self.gpkg})
         if (self.debug):
             print 'Running: %s' % convert_cmd
-        task_process = TaskProcess(task_uid=self.task_uid)
-        task_process.start_process(convert_cmd, shell=True, executable='/bin/bash',
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        task_process = run_gdal(convert_cmd, task_uid=self.task_uid)
         if task_process.exitcode != 0:
             logger.error('%s', task_process.stderr)
             raise Exception, "ogr2ogr process failed with returncode: {0}".format(task_process.exitcode)
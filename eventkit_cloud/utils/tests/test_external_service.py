@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
+import shutil
+import tempfile
 import yaml as real_yaml
 from mock import Mock, patch, MagicMock
 from django.core.files.temp import NamedTemporaryFile
@@ -60,13 +63,14 @@ class TestGeopackage(TransactionTestCase):
     @patch('eventkit_cloud.utils.external_service.check_zoom_levels')
     @patch('eventkit_cloud.utils.external_service.check_service')
     @patch('eventkit_cloud.utils.geopackage.remove_empty_zoom_levels')
+    @patch('eventkit_cloud.utils.geopackage.remove_blank_tiles')
     @patch('eventkit_cloud.utils.external_service.connections')
     @patch('eventkit_cloud.utils.external_service.SeedingConfiguration')
-    @patch('eventkit_cloud.utils.external_service.seeder')
+    @patch('eventkit_cloud.utils.external_service.ConcurrencyController')
     @patch('eventkit_cloud.utils.external_service.load_config')
     @patch('eventkit_cloud.utils.external_service.get_cache_template')
     @patch('eventkit_cloud.utils.external_service.get_seed_template')
-    def test_convert(self, seed_template, cache_template, load_config, seeder, seeding_config, connections, remove_zoom_levels, check_service, mock_check_zoom_levels, mock_set_gpkg_contents_bounds, validate_options, validate_seed_conf):
+    def test_convert(self, seed_template, cache_template, load_config, concurrency_controller, seeding_config, connections, remove_blank_tiles, remove_zoom_levels, check_service, mock_check_zoom_levels, mock_set_gpkg_contents_bounds, validate_options, validate_seed_conf):
         gpkgfile = '/var/lib/eventkit/test.gpkg'
         config = "layers:\r\n - name: imagery\r\n   title: imagery\r\n   sources: [cache]\r\n\r\nsources:\r\n  imagery_wmts:\r\n    type: tile\r\n    grid: webmercator\r\n    url: http://a.tile.openstreetmap.fr/hot/%(z)s/%(x)s/%(y)s.png\r\n\r\ngrids:\r\n  webmercator:\r\n    srs: EPSG:3857\r\n    tile_size: [256, 256]\r\n    origin: nw"
         json_config = real_yaml.load(config)
@@ -89,6 +93,7 @@ class TestGeopackage(TransactionTestCase):
                                service_type='wmts',
                                task_uid=self.task_uid)
         result = w2g.convert()
+        concurrency_controller.assert_called_once_with('imagery', None)
         mock_check_zoom_levels.assert_called_once()
         connections.close_all.assert_called_once()
         self.assertEqual(result, gpkgfile)
@@ -102,6 +107,7 @@ class TestGeopackage(TransactionTestCase):
         
         check_service.assert_called_once_with(json_config)
         load_config.assert_called_once_with(mapproxy_config, config_dict=json_config)
+        remove_blank_tiles.assert_called_once_with(gpkgfile)
         remove_zoom_levels.assert_called_once_with(gpkgfile)
         mock_set_gpkg_contents_bounds.assert_called_once_with(gpkgfile, 'imagery', bbox)
         seed_template.assert_called_once_with(bbox=bbox, coverage_file=None, level_from=0, level_to=10)
@@ -109,6 +115,74 @@ class TestGeopackage(TransactionTestCase):
         with self.assertRaises(Exception):
             w2g.convert()
 
+    @patch('eventkit_cloud.utils.external_service.validate_references')
+    @patch('eventkit_cloud.utils.external_service.SeedingConfiguration')
+    @patch('eventkit_cloud.utils.external_service.ProxyConfiguration')
+    @patch('eventkit_cloud.utils.external_service.load_config')
+    @patch('eventkit_cloud.utils.external_service.TileCache')
+    def test_get_check_config_tile_cache(self, mock_tile_cache, load_config, proxy_config, seeding_config,
+                                         validate_references):
+        gpkgfile = '/var/lib/eventkit/test.gpkg'
+        config = "sources:\r\n  imagery_wmts:\r\n    type: tile\r\n    grid: webmercator\r\n    url: http://a.tile.openstreetmap.fr/hot/%(z)s/%(x)s/%(y)s.png\r\n\r\ngrids:\r\n  webmercator:\r\n    srs: EPSG:3857\r\n    tile_size: [256, 256]\r\n    origin: nw"
+        mock_tile_cache.from_settings.return_value = Mock(filename='/var/lib/eventkit/tile_cache/imagery.gpkg')
+        validate_references.return_value = []
+        w2g = ExternalRasterServiceToGeopackage(config=config, gpkgfile=gpkgfile, bbox=[-2, -2, 2, 2],
+                                                layer='imagery', name='imagery', service_type='wmts',
+                                                task_uid=self.task_uid)
+        conf_dict, seed_configuration, mapproxy_configuration = w2g.get_check_config()
+
+        # the run cache is seeded from the shared cache, which is seeded from the provider
+        mock_tile_cache.from_settings.assert_called_once_with('imagery')
+        self.assertEqual(conf_dict['caches']['shared_cache'],
+                         get_cache_template(['imagery_wmts'], ['webmercator'],
+                                            '/var/lib/eventkit/tile_cache/imagery.gpkg', table_name='tiles'))
+        self.assertEqual(conf_dict['caches']['cache'],
+                         get_cache_template(['shared_cache'], ['webmercator'], gpkgfile, table_name='imagery'))
+
+
+    @patch('eventkit_cloud.utils.external_service.set_gpkg_contents_bounds')
+    @patch('eventkit_cloud.utils.external_service.check_zoom_levels')
+    @patch('eventkit_cloud.utils.geopackage.remove_empty_zoom_levels')
+    @patch('eventkit_cloud.utils.geopackage.remove_blank_tiles')
+    @patch('eventkit_cloud.utils.external_service.connections')
+    @patch('eventkit_cloud.utils.external_service.check_service')
+    @patch('eventkit_cloud.utils.external_service.ConcurrencyController')
+    @patch('eventkit_cloud.utils.external_service.ProgressStore')
+    @patch.object(ExternalRasterServiceToGeopackage, 'get_check_config')
+    def test_convert_resume(self, get_check_config, progress_store, concurrency_controller, check_service,
+                            connections, remove_blank_tiles, remove_zoom_levels, check_zoom_levels,
+                            set_gpkg_contents_bounds):
+        stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, stage_dir)
+        gpkgfile = os.path.join(stage_dir, 'test.gpkg')
+        checkpoint = '{0}.seed_progress'.format(gpkgfile)
+        open(checkpoint, 'w').close()
+        get_check_config.return_value = ({}, Mock(), Mock())
+        self.task_process.return_value.exitcode = 1
+        self.task_process.return_value.start_process.side_effect = lambda **kwargs: setattr(
+            self.task_process.return_value, 'exitcode', 0 if self.task_process.call_count == 2 else 1)
+
+        w2g = ExternalRasterServiceToGeopackage(gpkgfile=gpkgfile, bbox=[-2, -2, 2, 2], layer='imagery',
+                                                name='imagery', service_type='wmts', task_uid=self.task_uid)
+        self.assertEqual(w2g.convert(), gpkgfile)
+
+        # the failed attempt is resumed from the checkpoint
+        self.assertEqual(self.task_process.call_count, 2)
+        progress_store.assert_called_with(checkpoint, continue_seed=True)
+        kwargs = self.task_process.return_value.start_process.call_args[1]['kwargs']
+        self.assertEqual(kwargs['progress_logger'].progress_store, progress_store.return_value)
+        self.assertFalse(os.path.exists(checkpoint))
+
+        # the checkpoint is kept if every attempt fails
+        open(checkpoint, 'w').close()
+        self.task_process.reset_mock()
+        self.task_process.return_value.start_process.side_effect = None
+        self.task_process.return_value.exitcode = 1
+        with self.settings(MAPPROXY_SEED_RETRIES=1):
+            with self.assertRaises(Exception):
+                w2g.convert()
+        self.assertEqual(self.task_process.call_count, 2)
+        self.assertTrue(os.path.exists(checkpoint))
 
 class TestHelpers(TransactionTestCase):
 
@@ -195,10 +269,24 @@ class TestLogger(TransactionTestCase):
         test_timestamp = 1490641718
         test_progress = 0.42
         custom_logger = CustomLogger(task_uid=test_task_uid)
-        custom_logger.log_step_counter = 0
         self.assertIsNotNone(custom_logger)
         mock_progress = MagicMock()
         mock_progress.progress = test_progress
         mock_progress.eta.eta.return_value = test_timestamp
         custom_logger.log_step(mock_progress)
         mock_update_progress.assert_called_once_with(test_task_uid, progress=test_progress*100)
+
+    @patch('eventkit_cloud.utils.external_service.time')
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    def test_log_step_throttle(self, mock_update_progress, mock_time):
+        custom_logger = CustomLogger(task_uid="1234")
+        custom_logger.update_interval = 10
+        custom_logger.update_delta = 1
+        mock_progress = MagicMock()
+        for timestamp, progress in [(0, 0.1), (1, 0.105), (2, 0.115), (5, 0.116), (12, 0.116), (30, 0.116)]:
+            mock_time.time.return_value = timestamp
+            mock_progress.progress = progress
+            custom_logger.log_step(mock_progress)
+        # progress is written when it advances by a percent, or when it has changed at all after 10 seconds
+        self.assertEqual([kwargs['progress'] for args, kwargs in mock_update_progress.call_args_list],
+                         [0.1 * 100, 0.115 * 100, 0.116 * 100])
@@ -2,11 +2,12 @@
 import logging
 import os
 from osgeo import gdal, ogr
-from mock import Mock, patch, call
+from mock import ANY, Mock, patch, call
 from uuid import uuid4
 from django.test import TestCase
 
-from ..gdalutils import open_ds, cleanup_ds, clip_dataset, convert, driver_for
+from ..gdalutils import open_ds, cleanup_ds, clip_dataset, convert, driver_for, get_raster_options, \
+    get_raster_profile, run_gdal, parse_gdal_command, execute_gdal_command, GdalProgress, DatasetPipeline
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +18,16 @@ class TestGdalUtils(TestCase):
         self.task_process_patcher = patch('eventkit_cloud.utils.gdalutils.TaskProcess')
         self.task_process = self.task_process_patcher.start()
         self.addCleanup(self.task_process_patcher.stop)
+        self.raster_profile_patcher = patch('eventkit_cloud.utils.gdalutils.get_raster_profile')
+        self.raster_profile = self.raster_profile_patcher.start()
+        self.raster_profile.return_value = {'threads': 2, 'warp_memory': 256, 'cache_max': 512}
+        self.addCleanup(self.raster_profile_patcher.stop)
+        self.profile = "-multi -wo NUM_THREADS=2 -wm 256 --config GDAL_NUM_THREADS 2 --config GDAL_CACHEMAX 512"
+        # The commands are checked as they would run in a shell, run_gdal is tested on its own.
+        self.settings_patcher = patch('eventkit_cloud.utils.gdalutils.settings')
+        self.settings = self.settings_patcher.start()
+        self.settings.GDAL_IN_PROCESS = False
+        self.addCleanup(self.settings_patcher.stop)
         self.task_uid = uuid4()
 
     @patch('eventkit_cloud.utils.gdalutils.os.path.isfile')
@@ -64,7 +75,8 @@ class TestGdalUtils(TestCase):
         in_dataset = "/path/to/old_dataset"
         fmt = "gpkg"
         band_type = "-ot byte"
-        expected_cmd = "gdalwarp -cutline {0} -crop_to_cutline -dstalpha -of {1} {2} {3} {4}".format(
+        expected_cmd = "gdalwarp {0} -cutline {1} -crop_to_cutline -dstalpha -of {2} {3} {4} {5}".format(
+            self.profile,
             geojson_file,
             fmt,
             band_type,
@@ -81,7 +93,8 @@ class TestGdalUtils(TestCase):
         # Geotiff
         fmt = "gtiff"
         band_type = ""
-        expected_cmd = "gdalwarp -cutline {0} -crop_to_cutline -dstalpha -of {1} {2} {3} {4}".format(
+        expected_cmd = "gdalwarp {0} -cutline {1} -crop_to_cutline -dstalpha -of {2} {3} {4} {5}".format(
+            self.profile,
             geojson_file,
             fmt,
             band_type,
@@ -130,7 +143,8 @@ class TestGdalUtils(TestCase):
         in_dataset = "/path/to/old_dataset"
         fmt = "gpkg"
         band_type = "-ot byte"
-        expected_cmd = "gdalwarp -of {0} {1} {2} {3}".format(
+        expected_cmd = "gdalwarp {0} -of {1} {2} {3} {4}".format(
+            self.profile,
             fmt,
             band_type,
             in_dataset,
@@ -145,7 +159,8 @@ class TestGdalUtils(TestCase):
         # Geotiff from raster geopackage
         fmt = "gtiff"
         band_type = ""
-        expected_cmd = "gdalwarp -of {0} {1} {2} {3}".format(
+        expected_cmd = "gdalwarp {0} -of {1} {2} {3} {4}".format(
+            self.profile,
             fmt,
             band_type,
             in_dataset,
@@ -167,3 +182,209 @@ class TestGdalUtils(TestCase):
         convert(dataset=dataset, fmt=fmt, task_uid=self.task_uid)
         self.task_process().start_process.assert_called_with(expected_cmd, executable='/bin/bash', shell=True,
                                                              stderr=-1, stdout=-1)
+
+    @patch('eventkit_cloud.utils.gdalutils.os.sysconf')
+    @patch('eventkit_cloud.utils.gdalutils.multiprocessing.cpu_count')
+    @patch('eventkit_cloud.utils.gdalutils.settings')
+    def test_get_raster_profile(self, mock_settings, cpu_count, sysconf):
+        # 8 cores and 16GB shared between 2 tasks
+        cpu_count.return_value = 8
+        sysconf.side_effect = lambda name: {'SC_PAGE_SIZE': 4096, 'SC_PHYS_PAGES': 4194304}[name]
+        mock_settings.RASTER_WORKER_TASKS = 2
+        mock_settings.RASTER_THREADS = None
+        mock_settings.RASTER_WARP_MEMORY = None
+        mock_settings.RASTER_CACHE_MAX = None
+        self.assertEqual(get_raster_profile(), {'threads': 4, 'warp_memory': 2048, 'cache_max': 2048})
+
+        mock_settings.RASTER_WORKER_TASKS = 16
+        self.assertEqual(get_raster_profile(), {'threads': 1, 'warp_memory': 256, 'cache_max': 256})
+
+        mock_settings.RASTER_THREADS = 'ALL_CPUS'
+        mock_settings.RASTER_WARP_MEMORY = '500'
+        mock_settings.RASTER_CACHE_MAX = '100'
+        self.assertEqual(get_raster_profile(), {'threads': 'ALL_CPUS', 'warp_memory': 500, 'cache_max': 100})
+
+    def test_get_raster_options(self):
+        self.assertEqual(get_raster_options(), self.profile)
+        self.assertEqual(get_raster_options(warp=False), "--config GDAL_NUM_THREADS 2 --config GDAL_CACHEMAX 512")
+        self.assertEqual(get_raster_options(threads=8),
+                         "-multi -wo NUM_THREADS=8 -wm 256 --config GDAL_NUM_THREADS 8 --config GDAL_CACHEMAX 512")
+
+    def test_parse_gdal_command(self):
+        self.assertEqual(parse_gdal_command("ogr2ogr -f 'ESRI Shapefile' /out/shp /in.gpkg -lco ENCODING=UTF-8 "
+                                            "-nln test -overwrite"),
+                         {'utility': 'ogr2ogr', 'config': {}, 'sources': ['/in.gpkg'], 'destination': '/out/shp',
+                          'options': ['-f', 'ESRI Shapefile', '-lco', 'ENCODING=UTF-8', '-nln', 'test',
+                                      '-overwrite']})
+        # bbox values aren't datasets, layers after the source are options
+        self.assertEqual(parse_gdal_command("ogr2ogr -update -f gpkg -clipsrc -10 -5 10 5 out.gpkg in.gpkg layer"),
+                         {'utility': 'ogr2ogr', 'config': {}, 'sources': ['in.gpkg'], 'destination': 'out.gpkg',
+                          'options': ['-update', '-f', 'gpkg', '-clipsrc', '-10', '-5', '10', '5', 'layer']})
+        self.assertEqual(parse_gdal_command("ogr2ogr -skipfailures -f GPKG out.gpkg WFS:'http://a/wfs?a=b&c=d'"),
+                         {'utility': 'ogr2ogr', 'config': {}, 'sources': ['WFS:http://a/wfs?a=b&c=d'],
+                          'destination': 'out.gpkg', 'options': ['-skipfailures', '-f', 'GPKG']})
+        self.assertEqual(parse_gdal_command("gdalwarp {0} -cutline b.geojson -of gpkg in.tif out.gpkg".format(
+            self.profile)),
+                         {'utility': 'gdalwarp', 'config': {'GDAL_NUM_THREADS': '2', 'GDAL_CACHEMAX': '512'},
+                          'sources': ['in.tif'], 'destination': 'out.gpkg',
+                          'options': ['-multi', '-wo', 'NUM_THREADS=2', '-wm', '256', '-cutline', 'b.geojson',
+                                      '-of', 'gpkg']})
+        self.assertEqual(parse_gdal_command("gdal_translate -projwin -45 45 45 -45 -of gtiff wcs.xml out.tif"),
+                         {'utility': 'gdal_translate', 'config': {}, 'sources': ['wcs.xml'],
+                          'destination': 'out.tif', 'options': ['-projwin', '-45', '45', '45', '-45', '-of', 'gtiff']})
+
+        # commands the bindings can't run
+        self.assertIsNone(parse_gdal_command("osmconvert in.osm --out-pbf >out.pbf"))
+        self.assertIsNone(parse_gdal_command("ogr2ogr -f GPKG out.gpkg in.gpkg | tee log"))
+        self.assertIsNone(parse_gdal_command("ogr2ogr -unknown_option out.gpkg in.gpkg"))
+        self.assertIsNone(parse_gdal_command("gdal_translate -of gtiff in.tif"))
+        self.assertIsNone(parse_gdal_command("ogr2ogr -f 'GPKG out.gpkg in.gpkg"))
+
+    @patch('eventkit_cloud.utils.gdalutils.Pipe')
+    def test_run_gdal(self, mock_pipe):
+        self.settings.GDAL_IN_PROCESS = True
+        receiver, sender = Mock(), Mock()
+        mock_pipe.return_value = (receiver, sender)
+        receiver.poll.return_value = True
+        receiver.recv.return_value = "ogr2ogr failed: in.gpkg: No such file or directory"
+        self.task_process.return_value = Mock(stderr=None)
+        task_process = run_gdal("ogr2ogr -f GPKG out.gpkg in.gpkg", task_uid=self.task_uid)
+        self.task_process.assert_called_once_with(task_uid=self.task_uid)
+        self.assertEqual(task_process, self.task_process())
+        command = {'utility': 'ogr2ogr', 'config': {}, 'sources': ['in.gpkg'], 'destination': 'out.gpkg',
+                   'options': ['-f', 'GPKG']}
+        task_process.start_process.assert_called_once_with(billiard=True, target=execute_gdal_command,
+                                                           kwargs={'command': command, 'task_uid': self.task_uid,
+                                                                   'error_pipe': sender, 'progress_offset': 0.0,
+                                                                   'progress_scale': 1.0})
+        # the error the child process sent is the stderr of the command
+        mock_pipe.assert_called_once_with(duplex=False)
+        self.assertEqual(task_process.stderr, "ogr2ogr failed: in.gpkg: No such file or directory")
+        self.assertEqual((receiver.close.call_count, sender.close.call_count), (1, 1))
+
+        # the shell runs what the bindings can't, and everything when running in process is turned off
+        run_gdal("zip -j out.zip in.gpkg", task_uid=self.task_uid, executable='/bin/sh')
+        task_process.start_process.assert_called_with("zip -j out.zip in.gpkg", executable='/bin/sh', shell=True,
+                                                      stderr=-1, stdout=-1)
+        self.settings.GDAL_IN_PROCESS = False
+        run_gdal("ogr2ogr -f GPKG out.gpkg in.gpkg", task_uid=self.task_uid)
+        task_process.start_process.assert_called_with("ogr2ogr -f GPKG out.gpkg in.gpkg", executable='/bin/bash',
+                                                      shell=True, stderr=-1, stdout=-1)
+
+    @patch('eventkit_cloud.utils.gdalutils.os.path.exists')
+    @patch('eventkit_cloud.utils.gdalutils.gdal')
+    def test_execute_gdal_command(self, mock_gdal, exists):
+        command = {'utility': 'ogr2ogr', 'config': {'OGR_SQLITE_SYNCHRONOUS': 'OFF'}, 'sources': ['in.gpkg'],
+                   'destination': 'out.gpkg', 'options': ['-f', 'GPKG']}
+        execute_gdal_command(command, task_uid=self.task_uid)
+        mock_gdal.SetConfigOption.assert_called_once_with('OGR_SQLITE_SYNCHRONOUS', 'OFF')
+        mock_gdal.OpenEx.assert_called_once_with('in.gpkg', mock_gdal.OF_VECTOR)
+        args, kwargs = mock_gdal.VectorTranslate.call_args
+        self.assertEqual(args, ('out.gpkg', mock_gdal.OpenEx()))
+        self.assertEqual(kwargs['options'], ['-f', 'GPKG'])
+        self.assertIsInstance(kwargs['callback'], GdalProgress)
+        self.assertEqual(kwargs['callback'].task_uid, self.task_uid)
+        execute_gdal_command(command, task_uid=self.task_uid, progress_offset=0.5, progress_scale=0.25)
+        callback = mock_gdal.VectorTranslate.call_args[1]['callback']
+        self.assertEqual((callback.progress_offset, callback.progress_scale), (0.5, 0.25))
+
+        # existing datasets are updated
+        exists.return_value = True
+        command['options'] = ['-f', 'GPKG', '-overwrite']
+        execute_gdal_command(command)
+        mock_gdal.OpenEx.assert_called_with('out.gpkg', mock_gdal.OF_VECTOR | mock_gdal.OF_UPDATE)
+        self.assertEqual(mock_gdal.VectorTranslate.call_args[0][0], mock_gdal.OpenEx())
+
+        command = {'utility': 'gdalwarp', 'config': {}, 'sources': ['a.tif', 'b.tif'], 'destination': 'out.gpkg',
+                   'options': ['-of', 'gpkg']}
+        execute_gdal_command(command)
+        mock_gdal.Warp.assert_called_once_with('out.gpkg', [mock_gdal.Open(), mock_gdal.Open()], options=['-of', 'gpkg'],
+                                               callback=ANY)
+
+        command = {'utility': 'gdal_translate', 'config': {}, 'sources': ['wcs.xml'], 'destination': 'out.tif',
+                   'options': []}
+        mock_gdal.Translate.return_value = None
+        mock_gdal.GetLastErrorMsg.return_value = "wcs.xml: No such file or directory"
+        error_pipe = Mock()
+        with self.assertRaises(Exception):
+            execute_gdal_command(command, error_pipe=error_pipe)
+        mock_gdal.Open.assert_called_with('wcs.xml')
+        # the parent process is sent why the command failed
+        error_pipe.send.assert_called_once_with("gdal_translate failed: wcs.xml: No such file or directory")
+
+    @patch('eventkit_cloud.utils.gdalutils.GdalProgress.is_canceled')
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    @patch('eventkit_cloud.utils.gdalutils.time.time')
+    def test_gdal_progress(self, mock_time, update_progress, is_canceled):
+        self.settings.PROGRESS_UPDATE_INTERVAL = 10
+        self.settings.PROGRESS_UPDATE_DELTA = 5
+        is_canceled.return_value = False
+        progress = GdalProgress(self.task_uid)
+        mock_time.return_value = 0
+        self.assertEqual(progress(0.25), 1)
+        # not written until it has advanced by the delta or the interval has passed
+        mock_time.return_value = 5
+        self.assertEqual(progress(0.28125), 1)
+        mock_time.return_value = 10
+        self.assertEqual(progress(0.28125), 1)
+        self.assertEqual(progress(0.375), 1)
+        self.assertEqual([call[1]['progress'] for call in update_progress.call_args_list], [25.0, 28.125, 37.5])
+        self.assertEqual(is_canceled.call_count, 3)
+
+        # the command is stopped once the task is canceled
+        is_canceled.return_value = True
+        self.assertEqual(progress(0.5), 0)
+        self.assertEqual(GdalProgress()(0.5), 1)
+
+        # a command which is part of a task reports within its share of the task
+        update_progress.reset_mock()
+        is_canceled.return_value = False
+        progress = GdalProgress(self.task_uid, progress_offset=0.5, progress_scale=0.25)
+        progress(0.0)
+        progress(1.0)
+        self.assertEqual([call[1]['progress'] for call in update_progress.call_args_list], [50.0, 75.0])
+
+    @patch('eventkit_cloud.utils.gdalutils.os.remove')
+    @patch('eventkit_cloud.utils.gdalutils.os.rename')
+    @patch('eventkit_cloud.utils.gdalutils.run_gdal')
+    @patch('eventkit_cloud.utils.gdalutils.driver_for')
+    def test_dataset_pipeline(self, driver_for_mock, mock_run_gdal, rename, remove):
+        dataset = "/path/to/dataset.gpkg"
+        in_dataset = "/path/to/old_dataset.gpkg"
+        mock_run_gdal.return_value = Mock(exitcode=0)
+
+        # nothing to do
+        driver_for_mock.return_value = ('GPKG', True)
+        self.assertEqual(DatasetPipeline(dataset).convert('gpkg').run(),
+                         {'result': dataset, 'driver': 'gpkg', 'raster': True})
+        driver_for_mock.assert_called_once_with(dataset)
+        mock_run_gdal.assert_not_called()
+
+        # clipped, reprojected and converted in one pass, with the driver known from the previous task
+        driver_for_mock.reset_mock()
+        result = DatasetPipeline(dataset, driver='GPKG', raster=True, task_uid=self.task_uid) \
+            .clip("selection.geojson").reproject("EPSG:3857").convert('gtiff').run()
+        driver_for_mock.assert_not_called()
+        self.assertEqual(result, {'result': dataset, 'driver': 'gtiff', 'raster': True})
+        mock_run_gdal.assert_called_once_with(
+            "gdalwarp {0} -cutline selection.geojson -crop_to_cutline -dstalpha -t_srs EPSG:3857 -of gtiff {1} {2}"
+            .format(self.profile, in_dataset, dataset), task_uid=self.task_uid)
+        rename.assert_called_once_with(dataset, in_dataset)
+        remove.assert_called_once_with(in_dataset)
+
+        # geopackage rasters are cast to bytes, vectors are clipped with ogr2ogr
+        DatasetPipeline(dataset, driver='GTiff', raster=True).convert('gpkg').run(out_dataset="/path/to/out.gpkg")
+        mock_run_gdal.assert_called_with("gdalwarp {0} -of gpkg -ot byte {1} /path/to/out.gpkg".format(
+            self.profile, dataset), task_uid=None)
+        DatasetPipeline(dataset, driver='GPKG', raster=False).clip([-1, -1, 1, 1]).cast('uint16').run()
+        mock_run_gdal.assert_called_with("ogr2ogr -f GPKG -clipsrc -1 -1 1 1 {0} {1}".format(dataset, in_dataset),
+                                         task_uid=None)
+
+        # the input is put back when the pipeline fails
+        rename.reset_mock()
+        remove.reset_mock()
+        mock_run_gdal.return_value = Mock(exitcode=1)
+        with self.assertRaises(Exception):
+            DatasetPipeline(dataset, driver='GPKG', raster=True).clip("selection.geojson").run()
+        self.assertEqual(rename.call_args_list, [call(dataset, in_dataset), call(in_dataset, dataset)])
+        remove.assert_not_called()
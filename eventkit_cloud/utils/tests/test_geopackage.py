@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+import shutil
+import tempfile
+from io import BytesIO
 
 from mock import Mock, patch, call
+from PIL import Image
+from pysqlite2 import dbapi2 as sqlite3
 from uuid import uuid4
 from django.test import TransactionTestCase
 
@@ -11,7 +16,7 @@ from ..geopackage import (SQliteToGeopackage, get_table_count, get_tile_table_na
                           remove_empty_zoom_levels, check_content_exists, check_zoom_levels,
                           add_geojson_to_geopackage, clip_geopackage, create_table_from_existing, get_table_info,
                           get_table_gpkg_contents_information, set_gpkg_contents_bounds, create_extension_table,
-                          create_metadata_tables, add_file_metadata)
+                          create_metadata_tables, add_file_metadata, remove_blank_tiles, get_blank_tile)
 
 
 logger = logging.getLogger(__name__)
@@ -20,9 +25,9 @@ logger = logging.getLogger(__name__)
 class TestGeopackage(TransactionTestCase):
     def setUp(self, ):
         self.path = os.path.dirname(os.path.realpath(__file__))
-        self.task_process_patcher = patch('eventkit_cloud.utils.geopackage.TaskProcess')
-        self.task_process = self.task_process_patcher.start()
-        self.addCleanup(self.task_process_patcher.stop)
+        self.run_gdal_patcher = patch('eventkit_cloud.utils.geopackage.run_gdal')
+        self.run_gdal = self.run_gdal_patcher.start()
+        self.addCleanup(self.run_gdal_patcher.stop)
         self.task_uid = uuid4()
 
     @patch('os.path.isfile')
@@ -31,16 +36,14 @@ class TestGeopackage(TransactionTestCase):
         gpkgfile = '/path/to/query.gpkg'
         cmd = "ogr2ogr -f 'GPKG' {0} {1}".format(gpkgfile, sqlite)
         isfile.return_value = True
-        self.task_process.return_value = Mock(exitcode=0)
+        self.run_gdal.return_value = Mock(exitcode=0)
         s2g = SQliteToGeopackage(sqlite=sqlite, gpkgfile=gpkgfile, debug=False, task_uid=self.task_uid)
         isfile.assert_called_once_with(sqlite)
         out = s2g.convert()
-        self.task_process.assert_called_once_with(task_uid=self.task_uid)
-        self.task_process().start_process.assert_called_once_with(cmd, executable='/bin/bash', shell=True, stderr=-1,
-                                                                  stdout=-1)
+        self.run_gdal.assert_called_once_with(cmd, task_uid=self.task_uid)
         self.assertEquals(out, gpkgfile)
 
-        self.task_process.return_value = Mock(exitcode=1)
+        self.run_gdal.return_value = Mock(exitcode=1)
         with self.assertRaises(Exception):
             s2g.convert()
 
@@ -224,13 +227,14 @@ class TestGeopackage(TransactionTestCase):
         geojson = "{}"
         gpkg = "test.gpkg"
         layer_name = "test_layer"
-        self.task_process.return_value = Mock(exitcode=0)
+        self.run_gdal.return_value = Mock(exitcode=0)
         add_geojson_to_geopackage(geojson=geojson, gpkg=gpkg, layer_name=layer_name, task_uid=self.task_uid)
-        self.task_process.assert_called_once_with(task_uid=self.task_uid)
+        self.run_gdal.assert_called_once_with("ogr2ogr -f 'GPKG' test.gpkg test.geojson -nln test_layer",
+                                              task_uid=self.task_uid)
         open.assert_called_once_with(os.path.join(os.path.dirname(gpkg),
                                 "{0}.geojson".format(os.path.splitext(os.path.basename(gpkg))[0])), 'w')
 
-        self.task_process.return_value = Mock(exitcode=1)
+        self.run_gdal.return_value = Mock(exitcode=1)
         with self.assertRaises(Exception):
             add_geojson_to_geopackage(geojson=geojson, gpkg=gpkg, layer_name=layer_name, task_uid=self.task_uid)
 
@@ -250,21 +254,18 @@ class TestGeopackage(TransactionTestCase):
 
         sqlite3.connect().__enter__().execute.return_value = expected_tables_no_tiles
         expected_call = "ogr2ogr -f GPKG -clipsrc {0} {2} {1}".format(geojson_file, in_gpkg, gpkg)
-        self.task_process.return_value = Mock(exitcode=0)
+        self.run_gdal.return_value = Mock(exitcode=0)
         clip_geopackage(geojson_file=geojson_file, gpkg=gpkg, task_uid=self.task_uid)
-        self.task_process.assert_called_once_with(task_uid=self.task_uid)
-        self.task_process().start_process.assert_called_once_with(expected_call, executable='/bin/bash', shell=True,
-                                                                  stderr=-1, stdout=-1)
+        self.run_gdal.assert_called_once_with(expected_call, task_uid=self.task_uid)
         rename.assert_called_once_with(gpkg, in_gpkg)
 
         sqlite3.connect().__enter__().execute.return_value = expected_tables_with_tiles
         expected_call = "gdalwarp -cutline {0} -crop_to_cutline -dstalpha {1} {2}".format(geojson_file, in_gpkg, gpkg)
-        self.task_process.return_value = Mock(exitcode=0)
+        self.run_gdal.return_value = Mock(exitcode=0)
         clip_geopackage(geojson_file=geojson_file, gpkg=gpkg, task_uid=self.task_uid)
-        self.task_process().start_process.assert_called_with(expected_call, executable='/bin/bash', shell=True,
-                                                                  stderr=-1, stdout=-1)
+        self.run_gdal.assert_called_with(expected_call, task_uid=self.task_uid)
 
-        self.task_process.return_value = Mock(exitcode=1)
+        self.run_gdal.return_value = Mock(exitcode=1)
         with self.assertRaises(Exception):
             clip_geopackage(geojson=geojson, gpkg=gpkg, task_uid=self.task_uid)
 
@@ -334,3 +335,53 @@ class TestGeopackage(TransactionTestCase):
         add_file_metadata(gpkg, metadata)
         mock_sqlite3.connect().__enter__().execute.assert_called()
         mock_create_metadata_tables.assert_called_once_with(gpkg)
+
+    def get_tile(self, color, image_format='PNG', mode='RGBA', noise=False):
+        image = Image.new(mode, (256, 256), color)
+        if noise:
+            for x in range(0, 256, 3):
+                image.putpixel((x, (x * 7) % 256), (x, 255 - x, 0))
+        output = BytesIO()
+        image.save(output, image_format)
+        return output.getvalue()
+
+    def test_get_blank_tile(self):
+        self.assertEqual(get_blank_tile(self.get_tile((0, 0, 0, 0))), '')
+        self.assertIsNone(get_blank_tile(self.get_tile((0, 0, 255), noise=True)))
+        self.assertIsNone(get_blank_tile(self.get_tile((0, 0, 255, 128))))
+        self.assertIsNone(get_blank_tile('not an image'))
+        tile = self.get_tile((0, 0, 255), image_format='JPEG', mode='RGB')
+        blank_tile = get_blank_tile(tile)
+        self.assertLess(len(blank_tile), len(tile))
+        image = Image.open(BytesIO(blank_tile))
+        self.assertEqual((image.format, image.size), ('PNG', (256, 256)))
+        self.assertEqual(image.convert('RGBA').getextrema(), Image.open(BytesIO(tile)).convert('RGBA').getextrema())
+
+    def test_remove_blank_tiles(self):
+        stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, stage_dir)
+        gpkg = os.path.join(stage_dir, 'test.gpkg')
+        transparent = self.get_tile((0, 0, 0, 0))
+        blue = self.get_tile((0, 0, 255), image_format='JPEG', mode='RGB')
+        imagery = self.get_tile((0, 0, 255), noise=True)
+        tiles = [transparent, blue, imagery, transparent, blue]
+        with sqlite3.connect(gpkg) as conn:
+            conn.execute("CREATE TABLE gpkg_contents (table_name TEXT, data_type TEXT)")
+            conn.execute("INSERT INTO gpkg_contents VALUES ('imagery', 'tiles')")
+            conn.execute("CREATE TABLE imagery (id INTEGER PRIMARY KEY AUTOINCREMENT, zoom_level INTEGER NOT NULL, "
+                         "tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL, tile_data BLOB NOT NULL)")
+            for index, tile in enumerate(tiles):
+                conn.execute("INSERT INTO imagery (zoom_level, tile_column, tile_row, tile_data) VALUES (2, ?, 0, ?)",
+                             (index, sqlite3.Binary(tile)))
+
+        with patch('eventkit_cloud.utils.geopackage.get_blank_tile', side_effect=get_blank_tile) as mock_blank_tile:
+            stats = remove_blank_tiles(gpkg)
+        # each distinct tile is only decoded once
+        self.assertEqual(mock_blank_tile.call_count, 3)
+        self.assertEqual((stats['removed'], stats['recompressed']), (2, 2))
+        blank_tile = get_blank_tile(blue)
+        self.assertEqual(stats['saved'], 2 * len(transparent) + 2 * (len(blue) - len(blank_tile)))
+        with sqlite3.connect(gpkg) as conn:
+            tiles = conn.execute("SELECT tile_column, tile_data FROM imagery ORDER BY tile_column").fetchall()
+        self.assertEqual([(column, bytes(tile)) for column, tile in tiles],
+                         [(1, blank_tile), (2, imagery), (4, blank_tile)])
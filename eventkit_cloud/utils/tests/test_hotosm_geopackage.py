@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.test import TestCase
+from mock import Mock, patch
+from pysqlite2 import dbapi2 as sqlite3
+
+from eventkit_cloud.feature_selection.feature_selection import FeatureSelection
+from ..hotosm_geopackage import CLIP_SQL, SPATIAL_SQL, Geopackage
+
+
+class TestGeopackage(TestCase):
+
+    def setUp(self, ):
+        self.stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.stage_dir)
+        self.output_gpkg = os.path.join(self.stage_dir, 'thematic.gpkg')
+        self.feature_selection = FeatureSelection('\n'.join([
+            'theme{0}:\n    types:\n        - points\n        - lines\n    select:\n        - name'.format(index)
+            for index in range(5)]))
+        # the thematic geopackage as left by Geopackage.run, with text standing in for the geometries
+        conn = sqlite3.connect(self.output_gpkg)
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT, srs_id INTEGER, organization TEXT, "
+                    "organization_coordsys_id INTEGER, definition TEXT, description TEXT)")
+        cur.execute("INSERT INTO gpkg_spatial_ref_sys VALUES ('WGS 84', 4326, 'EPSG', 4326, '', '')")
+        cur.execute("CREATE TABLE gpkg_contents (table_name TEXT, data_type TEXT, identifier TEXT, description TEXT, "
+                    "last_change TEXT, min_x REAL, min_y REAL, max_x REAL, max_y REAL, srs_id INTEGER)")
+        cur.execute("CREATE TABLE gpkg_geometry_columns (table_name TEXT, column_name TEXT, geometry_type_name TEXT, "
+                    "srs_id INTEGER, z TINYINT, m TINYINT)")
+        for table in self.feature_selection.tables:
+            cur.execute("CREATE TABLE {0} (fid INTEGER PRIMARY KEY, geom TEXT, osm_id TEXT, name TEXT)".format(table))
+            cur.execute("INSERT INTO {0} (geom, osm_id, name) VALUES ('geom', '1', '{0}')".format(table))
+        conn.commit()
+        conn.close()
+
+    @patch('eventkit_cloud.utils.hotosm_geopackage.Pool')
+    def test_create_theme_gpkgs(self, mock_pool):
+        gpkg = Geopackage('query.pbf', self.output_gpkg, self.stage_dir, self.feature_selection, Mock(),
+                          per_theme=True, theme_workers=3)
+        mock_pool.return_value.map.side_effect = lambda func, jobs, chunksize: map(func, jobs)
+        theme_gpkgs = gpkg.create_theme_gpkgs()
+        mock_pool.assert_called_once_with(processes=3)
+        mock_pool.return_value.join.assert_called_once_with()
+
+        self.assertEqual(theme_gpkgs, [artifact.parts[0] for artifact in gpkg.results])
+        for artifact in gpkg.results:
+            theme = artifact.theme
+            conn = sqlite3.connect(artifact.parts[0])
+            cur = conn.cursor()
+            for geom_type in ['points', 'lines']:
+                table = '{0}_{1}'.format(theme, geom_type)
+                self.assertEqual(cur.execute("SELECT name FROM {0}".format(table)).fetchall(), [(table,)])
+            self.assertEqual(len(cur.execute("SELECT * FROM gpkg_contents").fetchall()), 2)
+            conn.close()
+
+    @patch('eventkit_cloud.utils.hotosm_geopackage.Pool')
+    def test_create_theme_gpkgs_failure(self, mock_pool):
+        gpkg = Geopackage('query.pbf', self.output_gpkg, self.stage_dir, self.feature_selection, Mock(),
+                          per_theme=True, theme_workers=3)
+        mock_pool.return_value.map.side_effect = Exception('theme failed')
+        with self.assertRaises(Exception):
+            gpkg.create_theme_gpkgs()
+        mock_pool.return_value.terminate.assert_called_once_with()
+
+    @patch('eventkit_cloud.utils.hotosm_geopackage.Pool')
+    def test_create_theme_gpkgs_single_worker(self, mock_pool):
+        gpkg = Geopackage('query.pbf', self.output_gpkg, self.stage_dir, self.feature_selection, Mock(),
+                          per_theme=True, theme_workers=1)
+        self.assertEqual(len(gpkg.create_theme_gpkgs()), 5)
+        mock_pool.assert_not_called()
+        for artifact in gpkg.results:
+            self.assertTrue(os.path.isfile(artifact.parts[0]))
+
+
+class TestGeopackageClip(TestCase):
+
+    # An L shaped boundary, its bbox is [0.1, 0.1, 0.9, 0.9] and the notch [0.4, 0.4, 0.9, 0.9] is outside of it.
+    boundary = 'POLYGON((0.1 0.1, 0.9 0.1, 0.9 0.4, 0.4 0.4, 0.4 0.9, 0.1 0.9, 0.1 0.1))'
+    # osm_id: (wkt, the clipped wkt or None if the feature is deleted)
+    features = {
+        'points': {
+            'inside': ('POINT(0.2 0.2)', 'POINT(0.2 0.2)'),
+            'notch': ('POINT(0.7 0.7)', None),
+            'outside': ('POINT(2 2)', None),
+        },
+        'lines': {
+            'inside': ('LINESTRING(0.2 0.2, 0.3 0.3)', 'LINESTRING(0.2 0.2, 0.3 0.3)'),
+            'crossing': ('LINESTRING(0.2 0.5, 0.6 0.5)', 'LINESTRING(0.2 0.5, 0.4 0.5)'),
+            'notch': ('LINESTRING(0.6 0.6, 0.8 0.8)', None),
+            'outside': ('LINESTRING(2 2, 3 3)', None),
+        },
+        'multipolygons': {
+            'inside': ('MULTIPOLYGON(((0.2 0.2, 0.3 0.2, 0.3 0.3, 0.2 0.3, 0.2 0.2)))',
+                       'MULTIPOLYGON(((0.2 0.2, 0.3 0.2, 0.3 0.3, 0.2 0.3, 0.2 0.2)))'),
+            'crossing': ('MULTIPOLYGON(((0.3 0.5, 0.5 0.5, 0.5 0.6, 0.3 0.6, 0.3 0.5)))',
+                         'POLYGON((0.3 0.5, 0.4 0.5, 0.4 0.6, 0.3 0.6, 0.3 0.5))'),
+            'notch': ('MULTIPOLYGON(((0.6 0.6, 0.7 0.6, 0.7 0.7, 0.6 0.7, 0.6 0.6)))', None),
+            'outside': ('MULTIPOLYGON(((2 2, 3 2, 3 3, 2 3, 2 2)))', None),
+        },
+    }
+
+    def setUp(self, ):
+        self.stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.stage_dir)
+        self.output_gpkg = os.path.join(self.stage_dir, 'query.gpkg')
+        self.feature_selection = FeatureSelection(
+            'clip:\n    types:\n        - points\n        - lines\n        - polygons\n    select:\n        - name')
+
+    def connect(self):
+        conn = sqlite3.connect(self.output_gpkg)
+        conn.enable_load_extension(True)
+        cur = conn.cursor()
+        cur.execute("select load_extension('mod_spatialite')")
+        return conn, cur
+
+    def ingest(self, *args, **kwargs):
+        """
+        Write the geopackage as ogr2ogr does, GPB geometries with an rtree and its triggers on each layer.
+        """
+        conn, cur = self.connect()
+        cur.execute("CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT, srs_id INTEGER, organization TEXT, "
+                    "organization_coordsys_id INTEGER, definition TEXT, description TEXT)")
+        cur.execute("INSERT INTO gpkg_spatial_ref_sys VALUES ('WGS 84', 4326, 'EPSG', 4326, '', '')")
+        cur.execute("CREATE TABLE gpkg_contents (table_name TEXT, data_type TEXT, identifier TEXT, description TEXT, "
+                    "last_change TEXT, min_x REAL, min_y REAL, max_x REAL, max_y REAL, srs_id INTEGER)")
+        cur.execute("CREATE TABLE gpkg_geometry_columns (table_name TEXT, column_name TEXT, geometry_type_name TEXT, "
+                    "srs_id INTEGER, z TINYINT, m TINYINT)")
+        cur.execute("CREATE TABLE gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT, "
+                    "definition TEXT, scope TEXT)")
+        layers = [('points', 'POINT', ', osm_id TEXT, name TEXT'),
+                  ('lines', 'LINESTRING', ', osm_id TEXT, name TEXT'),
+                  ('multipolygons', 'MULTIPOLYGON', ', osm_id TEXT, osm_way_id TEXT, name TEXT'),
+                  ('multilinestrings', 'MULTILINESTRING', ''),
+                  ('other_relations', 'GEOMETRYCOLLECTION', '')]
+        for table, geometry_type, columns in layers:
+            cur.execute("CREATE TABLE {0} (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom {1}{2})".format(
+                table, geometry_type, columns))
+            cur.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) "
+                        "VALUES (?, 'features', ?, 4326)", (table, table))
+            cur.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, 4326, 0, 0)", (table, geometry_type))
+            cur.execute("SELECT gpkgAddSpatialIndex('{0}', 'geom')".format(table))
+        for table, features in self.features.items():
+            for osm_id, (wkt, clipped) in features.items():
+                cur.execute("INSERT INTO {0} (geom, osm_id, name) VALUES (AsGPB(GeomFromText(?, 4326)), ?, ?)".format(
+                    table), (wkt, osm_id, osm_id))
+            cur.execute("INSERT OR REPLACE INTO rtree_{0}_geom SELECT fid, MbrMinX(g), MbrMaxX(g), MbrMinY(g), "
+                        "MbrMaxY(g) FROM (SELECT fid, GeomFromGPB(geom) AS g FROM {0})".format(table))
+        conn.commit()
+        conn.close()
+
+    def rtree_triggers(self, cur, table):
+        return [name for name, in cur.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ? AND name LIKE 'rtree_%'",
+            (table,)).fetchall()]
+
+    def test_spatial_sql_keeps_ingest_rtrees(self):
+        self.ingest()
+        conn, cur = self.connect()
+        bboxes = dict((table, cur.execute("SELECT * FROM rtree_{0}_geom ORDER BY id".format(table)).fetchall())
+                      for table in self.features)
+        for table in self.features:
+            self.assertEqual(len(self.rtree_triggers(cur, table)), 6)
+        cur.execute("CREATE TABLE boundary (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, geom GEOMETRY)")
+        cur.execute("INSERT INTO boundary (geom) VALUES (GeomFromText(?, 4326))", (self.boundary,))
+        # The triggers are dropped before the geometries are converted from GPB, so that the clip
+        # runs against the rtrees as they were written by ogr2ogr.
+        cur.executescript(SPATIAL_SQL[:SPATIAL_SQL.index(CLIP_SQL)])
+        for table in self.features:
+            self.assertEqual(self.rtree_triggers(cur, table), [])
+            self.assertEqual(cur.execute("SELECT * FROM rtree_{0}_geom ORDER BY id".format(table)).fetchall(),
+                             bboxes[table])
+            self.assertEqual(cur.execute("SELECT COUNT(*) FROM {0} WHERE IsValidGPB(geom)".format(table)).fetchone(),
+                             (0,))
+        conn.close()
+
+    @patch('eventkit_cloud.utils.hotosm_geopackage.subprocess')
+    def test_run_clips_to_boundary(self, mock_subprocess):
+        mock_subprocess.check_call.side_effect = self.ingest
+        gpkg = Geopackage('query.pbf', self.output_gpkg, self.stage_dir, self.feature_selection,
+                          GEOSGeometry(self.boundary, srid=4326))
+        gpkg.run()
+        self.assertEqual(mock_subprocess.check_call.call_count, 1)
+
+        conn, cur = self.connect()
+        for table, theme_table in [('points', 'clip_points'), ('lines', 'clip_lines'),
+                                   ('multipolygons', 'clip_polygons')]:
+            kept = dict((osm_id, clipped) for osm_id, (wkt, clipped) in self.features[table].items() if clipped)
+            rows = cur.execute("SELECT osm_id, AsBinary(GeomFromGPB(geom)) FROM {0}".format(theme_table)).fetchall()
+            # exterior features are deleted
+            self.assertEqual(sorted(osm_id for osm_id, geom in rows), sorted(kept))
+            for osm_id, geom in rows:
+                if osm_id == 'inside':
+                    # interior features are left unchanged
+                    self.assertEqual(geom, cur.execute("SELECT AsBinary(GeomFromText(?, 4326))",
+                                                       (kept[osm_id],)).fetchone()[0])
+                else:
+                    # features crossing the boundary are intersected with it
+                    self.assertEqual(cur.execute("SELECT ST_Equals(GeomFromWKB(?, 4326), GeomFromText(?, 4326))",
+                                                 (geom, kept[osm_id])).fetchone(), (1,))
+            # the theme tables get a new rtree and triggers, holding the bboxes of the clipped features
+            self.assertEqual(len(self.rtree_triggers(cur, theme_table)), 6)
+            for osm_id, minx, maxx in cur.execute(
+                    "SELECT t.osm_id, r.minx, r.maxx FROM {0} t, rtree_{0}_geom r WHERE t.fid = r.id".format(
+                        theme_table)).fetchall():
+                expected = cur.execute("SELECT MbrMinX(g), MbrMaxX(g) FROM (SELECT GeomFromText(?, 4326) AS g)",
+                                       (kept[osm_id],)).fetchone()
+                self.assertAlmostEqual(minx, expected[0], places=5)
+                self.assertAlmostEqual(maxx, expected[1], places=5)
+        for table in ['points', 'lines', 'multipolygons']:
+            self.assertEqual(cur.execute("SELECT name FROM sqlite_master WHERE name = ?", (table,)).fetchall(), [])
+        conn.close()
@@ -19,6 +19,9 @@ class TestGPKGToKml(TransactionTestCase):
         self.task_process_patcher = patch('eventkit_cloud.utils.kml.TaskProcess')
         self.task_process = self.task_process_patcher.start()
         self.addCleanup(self.task_process_patcher.stop)
+        self.run_gdal_patcher = patch('eventkit_cloud.utils.kml.run_gdal')
+        self.run_gdal = self.run_gdal_patcher.start()
+        self.addCleanup(self.run_gdal_patcher.stop)
         self.task_uid = uuid4()
 
     @patch('os.path.exists')
@@ -27,18 +30,16 @@ class TestGPKGToKml(TransactionTestCase):
         kmlfile = '/path/to/query.kml'
         cmd = "ogr2ogr -f 'KML' {0} {1}".format(kmlfile, gpkg)
         exists.return_value = True
-        self.task_process.return_value = Mock(exitcode=0)
+        self.run_gdal.return_value = Mock(exitcode=0)
         # set zipped to False for testing
         s2k = GPKGToKml(gpkg=gpkg, kmlfile=kmlfile,
                         zipped=False, debug=False, task_uid=self.task_uid)
         out = s2k.convert()
-        self.task_process.assert_called_once_with(task_uid=self.task_uid)
         exists.assert_called_once_with(gpkg)
-        self.task_process().start_process.assert_called_once_with(cmd, executable='/bin/bash', shell=True, stderr=-1,
-                                                                  stdout=-1)
+        self.run_gdal.assert_called_once_with(cmd, task_uid=self.task_uid)
         self.assertEquals(out, kmlfile)
 
-        self.task_process.return_value = Mock(exitcode=1)
+        self.run_gdal.return_value = Mock(exitcode=1)
         with self.assertRaises(Exception):
             s2k.convert()
 
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from django.contrib.gis.geos import Polygon
+from django.test import TestCase
+from mock import ANY, Mock, patch
+
+from ..land_polygons import CLIP_SQL, SWAP_SQL, WKBStream, add_land_polygons, connect, load_land_polygons
+
+
+class TestLandPolygons(TestCase):
+
+    def setUp(self, ):
+        self.database = {'NAME': 'feature_data', 'HOST': 'postgis', 'PORT': '', 'USER': 'eventkit',
+                         'PASSWORD': 'password'}
+
+    @patch('eventkit_cloud.utils.land_polygons.psycopg2')
+    def test_connect(self, mock_psycopg2):
+        connect(self.database)
+        mock_psycopg2.connect.assert_called_once_with(dbname='feature_data', host='postgis', user='eventkit',
+                                                      password='password')
+
+    def get_layer(self, wkbs):
+        features = [Mock(GetGeometryRef=Mock(return_value=Mock(ExportToWkb=Mock(return_value=wkb)) if wkb else None))
+                    for wkb in wkbs]
+        return Mock(GetNextFeature=Mock(side_effect=features + [None]))
+
+    def test_wkb_stream(self):
+        stream = WKBStream(self.get_layer(['\x01\x02', None, '\x03' * 10]))
+        self.assertEqual(stream.read(4), '0102')
+        self.assertEqual(stream.read(4), '\n030')
+        self.assertEqual(stream.read(), '3' + '03' * 8 + '\n')
+        self.assertEqual(stream.read(8), '')
+        self.assertEqual(stream.rows, 2)
+
+    @patch('eventkit_cloud.utils.land_polygons.ogr')
+    @patch('eventkit_cloud.utils.land_polygons.psycopg2')
+    def test_load_land_polygons(self, mock_psycopg2, mock_ogr):
+        mock_ogr.Open.return_value.GetLayer.return_value = self.get_layer(['\x01', '\x02'])
+        conn = mock_psycopg2.connect.return_value
+        cur = conn.cursor.return_value.__enter__.return_value
+        cur.fetchone.return_value = (10,)
+        copied = []
+        cur.copy_expert.side_effect = lambda sql, stream: copied.append(stream.read())
+
+        stats = load_land_polygons('/path/to/land_polygons.shp', self.database)
+
+        self.assertEqual(copied, ['01\n02\n'])
+        self.assertEqual((stats['rows'], stats['pieces']), (2, 10))
+        self.assertIn('rows_per_second', stats)
+        cur.copy_expert.assert_called_once_with('COPY land_polygons_load (geom) FROM STDIN', ANY)
+        # the live table is only replaced once the staging table is complete
+        sqls = [args[0] for args, kwargs in cur.execute.call_args_list]
+        swap_sql = SWAP_SQL.format(table='land_polygons', staging='land_polygons_staging', old='land_polygons_old')
+        self.assertEqual(sqls.index(swap_sql), len(sqls) - 2)
+        self.assertIn('CREATE INDEX ON land_polygons_staging USING GIST (geom);', sqls[1])
+        conn.close.assert_called_once_with()
+
+        # a failed load leaves the live table alone
+        cur.execute.reset_mock()
+        mock_ogr.Open.return_value.GetLayer.return_value = self.get_layer(['\x01'])
+        cur.copy_expert.side_effect = Exception('COPY failed')
+        with self.assertRaises(Exception):
+            load_land_polygons('/path/to/land_polygons.shp', self.database)
+        self.assertNotIn(swap_sql, [args[0] for args, kwargs in cur.execute.call_args_list])
+        conn.rollback.assert_called_once_with()
+
+    @patch('eventkit_cloud.utils.land_polygons.ogr')
+    @patch('eventkit_cloud.utils.land_polygons.psycopg2')
+    def test_add_land_polygons(self, mock_psycopg2, mock_ogr):
+        boundary = Polygon.from_bbox((-10.85, 6.25, -10.62, 6.40))
+        cur = mock_psycopg2.connect.return_value.cursor.return_value.__enter__.return_value
+        cur.__iter__.return_value = iter([('wkb1',), ('wkb2',)])
+        layer = mock_ogr.Open.return_value.CreateLayer.return_value
+
+        self.assertEqual(add_land_polygons('/path/to/job.gpkg', boundary, self.database), 2)
+
+        # the pieces are streamed with a server side cursor and a single query
+        mock_psycopg2.connect.return_value.cursor.assert_called_once_with(name='land_polygons')
+        cur.execute.assert_called_once_with(CLIP_SQL.format(table='land_polygons'), {'aoi': boundary.wkt})
+        mock_ogr.Open.assert_called_once_with('/path/to/job.gpkg', update=True)
+        name, srs, geom_type, options = mock_ogr.Open.return_value.CreateLayer.call_args[0]
+        self.assertEqual((name, geom_type, options), ('land_polygons', mock_ogr.wkbMultiPolygon, ['SPATIAL_INDEX=YES']))
+        self.assertEqual(layer.CreateFeature.call_count, 2)
+        mock_ogr.CreateGeometryFromWkb.assert_called_with('wkb2')
+        layer.CommitTransaction.assert_called_once_with()
+        mock_psycopg2.connect.return_value.close.assert_called_once_with()
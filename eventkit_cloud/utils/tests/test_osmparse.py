@@ -6,6 +6,7 @@ from mock import MagicMock, Mock, patch, call
 from django.test import TestCase
 
 from ..osmparse import OSMParser
+from ..zindex import NOT_EMPTY, zindex_sql
 from uuid import uuid4
 
 
@@ -62,6 +63,11 @@ class TestOSMParser(TestCase):
         exists.return_value = True
         ogr_ds = MagicMock()
         ogr_ds.GetLayerCount.return_value = 3
+        fields = ['osm_id', 'highway', 'railway', 'z_index']
+        ogr_ds.GetLayerByIndex.return_value.GetName.return_value = 'planet_osm_line'
+        defn = ogr_ds.GetLayerByIndex.return_value.GetLayerDefn.return_value
+        defn.GetFieldCount.return_value = len(fields)
+        defn.GetFieldDefn.side_effect = lambda index: Mock(GetName=Mock(return_value=fields[index]))
         ogr_ds.ExecuteSQL = MagicMock()
         ogr_ds.Destroy = MagicMock()
         ogr_open.return_value = ogr_ds
@@ -69,5 +75,7 @@ class TestOSMParser(TestCase):
         parser.update_zindexes()
         exists.assert_called_with('/path/to/query.gpkg')
         ogr_open.assert_called_once_with('/path/to/query.gpkg', update=True)
-        self.assertEquals(30, ogr_ds.ExecuteSQL.call_count)
+        # a single pass per layer
+        self.assertEquals(3, ogr_ds.ExecuteSQL.call_count)
+        ogr_ds.ExecuteSQL.assert_called_with(zindex_sql('planet_osm_line', fields, present=NOT_EMPTY))
         ogr_ds.Destroy.assert_called_once()
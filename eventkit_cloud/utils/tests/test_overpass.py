@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+import threading
+import time
 
 import mock
 from mock import patch, Mock
@@ -8,11 +10,11 @@ from mock import patch, Mock
 from django.conf import settings
 from django.contrib.auth.models import Group, User
 from django.contrib.gis.geos import GEOSGeometry, Polygon
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from eventkit_cloud.jobs.models import ExportFormat, Job, DatamodelPreset
 
-from ..overpass import Overpass
+from ..overpass import Overpass, format_bbox
 
 logger = logging.getLogger(__name__)
 
@@ -98,3 +100,168 @@ class TestOverpass(TestCase):
         self.assertEqual(data, expected[0])
         f.close()
         os.remove(out)
+
+    @patch('eventkit_cloud.utils.overpass.auth_requests.post')
+    def test_get_tiles(self, mock_post):
+        # Small bounding boxes are never split or counted.
+        op = Overpass(stage_dir=self.path + '/files/', bbox=self.bbox, job_name='testjob')
+        self.assertEqual(op.get_tiles(), [self.bbox])
+        mock_post.assert_not_called()
+
+        bbox = [-11.0, 6.0, -9.0, 8.0]
+        op = Overpass(stage_dir=self.path + '/files/', bbox=bbox, job_name='testjob')
+        mock_post.return_value = Mock(content='{"elements": [{"type": "count", "tags": {"nodes": "%d"}}]}' %
+                                              (settings.OVERPASS_TILE_MAX_NODES * 4))
+        tiles = op.get_tiles()
+        self.assertEqual(tiles, [[-11.0, 6.0, -10.0, 7.0], [-10.0, 6.0, -9.0, 7.0],
+                                 [-11.0, 7.0, -10.0, 8.0], [-10.0, 7.0, -9.0, 8.0]])
+
+        # If the density can't be estimated fall back to a single query.
+        mock_post.return_value = Mock(content='not json')
+        self.assertEqual(op.get_tiles(), [bbox])
+
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    @patch('eventkit_cloud.utils.overpass.auth_requests.post')
+    def test_run_tiled_query(self, mock_post, mock_update_progress):
+        bbox = [-11.0, 6.0, -9.0, 8.0]
+        op = Overpass(stage_dir=self.path + '/files/', bbox=bbox, job_name='testjob', raw_data_filename='tiled.osm')
+        tiles = [[-11.0, 6.0, -10.0, 8.0], [-10.0, 6.0, -9.0, 8.0]]
+        responses = {
+            op.build_query('6.0,-11.0,8.0,-10.0'): '<osm><node id="1"/><node id="2"/><way id="5"/></osm>',
+            op.build_query('6.0,-10.0,8.0,-9.0'): '<osm><node id="2"/><node id="3"/><way id="5"/></osm>',
+        }
+
+        def post(url, data=None, **kwargs):
+            return Mock(headers={'content-length': len(responses[data])},
+                        iter_content=Mock(return_value=[responses[data]]))
+
+        mock_post.side_effect = post
+        out = op.run_tiled_query(tiles)
+        with open(out) as f:
+            data = f.read()
+        os.remove(out)
+        self.assertEqual(data.count('<node id="2" />'), 1)
+        self.assertEqual(data.count('<way id="5" />'), 1)
+        self.assertIn('<node id="1" />', data)
+        self.assertIn('<node id="3" />', data)
+        self.assertEqual(mock_update_progress.call_count, 2)
+        self.assertFalse(any('tiled_tile_' in filename for filename in os.listdir(self.path + '/files/')))
+
+    @override_settings(OVERPASS_TILE_WORKERS=3, OVERPASS_TILE_RETRIES=0, OVERPASS_TILE_MAX_SPLITS=0)
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    @patch('eventkit_cloud.utils.overpass.auth_requests.post')
+    def test_run_tiled_query_failed_tile(self, mock_post, mock_update_progress):
+        bbox = [-11.0, 6.0, -8.0, 8.0]
+        op = Overpass(stage_dir=self.path + '/files/', bbox=bbox, job_name='testjob', raw_data_filename='failed.osm')
+        tiles = [[-11.0, 6.0, -10.0, 8.0], [-10.0, 6.0, -9.0, 8.0], [-9.0, 6.0, -8.0, 8.0]]
+        queries = [op.build_query(format_bbox(tile)) for tile in tiles]
+        release = threading.Event()
+
+        def stream():
+            yield '<osm><node id="1"/>'
+            release.wait(5)
+            yield '</osm>'
+
+        def post(url, data=None, **kwargs):
+            if data == queries[2]:
+                raise Exception('down')
+            content = stream() if data == queries[1] else ['<osm><node id="2"/></osm>']
+            return Mock(headers={'content-length': 100}, iter_content=Mock(return_value=content))
+
+        mock_post.side_effect = post
+        # The failure doesn't wait for the tile still downloading.
+        start = time.time()
+        with self.assertRaises(Exception):
+            op.run_tiled_query(tiles)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(mock_post.call_count, 3)
+
+        # which stops once it is released, and none of the tiles are left behind
+        release.set()
+        time.sleep(0.2)
+        self.assertFalse(any('failed_tile_' in filename for filename in os.listdir(self.path + '/files/')))
+
+    @patch('eventkit_cloud.utils.overpass.Overpass.fetch')
+    def test_fetch_tile_splits_failed_tile(self, mock_fetch):
+        op = Overpass(stage_dir=self.path + '/files/', bbox=self.bbox, job_name='testjob')
+        tile = [0.0, 0.0, 2.0, 2.0]
+        failing_query = op.build_query('0.0,0.0,2.0,2.0')
+
+        def fetch(query, out_file, **kwargs):
+            if query == failing_query:
+                raise Exception('timeout')
+            return out_file
+
+        mock_fetch.side_effect = fetch
+        files = op.fetch_tile(tile, '/tmp/tile.osm')
+        self.assertEqual(files, ['/tmp/tile_0.osm', '/tmp/tile_1.osm', '/tmp/tile_2.osm', '/tmp/tile_3.osm'])
+        self.assertEqual(mock_fetch.call_count, settings.OVERPASS_TILE_RETRIES + 1 + 4)
+
+        mock_fetch.side_effect = Exception('down')
+        with self.assertRaises(Exception):
+            op.fetch_tile(tile, '/tmp/tile.osm')
+
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    @patch('eventkit_cloud.utils.overpass.auth_requests.post')
+    @patch('eventkit_cloud.utils.overpass.OverpassCache')
+    def test_run_query_cached(self, mock_cache, mock_post, mock_update_progress):
+        cache = mock_cache.from_settings.return_value
+        op = Overpass(stage_dir=self.path + '/files/', bbox=self.bbox, job_name='testjob')
+        cache.get.return_value = op.raw_osm
+        self.assertEqual(op.run_query(), op.raw_osm)
+        cache.get.assert_called_once_with(op.bounds, op.default_template.template, op.raw_osm)
+        mock_post.assert_not_called()
+        cache.put.assert_not_called()
+
+        # On a miss the extract is downloaded and stored.
+        cache.get.return_value = None
+        mock_post.return_value = Mock(headers={'content-length': 20},
+                                      iter_content=Mock(return_value=['<osm>some data</osm>']))
+        op.run_query()
+        cache.put.assert_called_once_with(op.bounds, op.default_template.template, op.raw_osm)
+        os.remove(op.raw_osm)
+
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    @patch('eventkit_cloud.utils.overpass.auth_requests.post')
+    @patch('eventkit_cloud.utils.overpass.OverpassCache')
+    def test_run_query_containing_extract(self, mock_cache, mock_post, mock_update_progress):
+        cache = mock_cache.from_settings.return_value
+        cache.get.return_value = None
+        op = Overpass(stage_dir=self.path + '/files/', bbox=self.bbox, job_name='testjob')
+        cache.get_containing.return_value = op.raw_osm
+        self.assertEqual(op.run_query(), op.raw_osm)
+        cache.get_containing.assert_called_once_with(op.bounds, op.default_template.template, op.raw_osm)
+        self.assertEqual(op.clip_bbox, op.bounds)
+        mock_post.assert_not_called()
+        cache.put.assert_not_called()
+
+    def test_filtered_query(self):
+        feature_selection = Mock()
+        feature_selection.overpass_filters.return_value = {
+            'node': ['["amenity"]'],
+            'way': ['["highway"]', '["name"~"^(a|b)$"]'],
+        }
+        op = Overpass(stage_dir=self.path + '/files/', bbox=self.bbox, job_name='testjob',
+                      feature_selection=feature_selection)
+        self.assertEqual(op.get_query(),
+                         '[maxsize:2147483648][timeout:1600];('
+                         'node["amenity"](6.25,-10.85,6.4,-10.62);'
+                         'way["highway"](6.25,-10.85,6.4,-10.62);'
+                         'way["name"~"^(a|b)$"](6.25,-10.85,6.4,-10.62);'
+                         ');(._;>;);out body;')
+
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    @patch('eventkit_cloud.utils.pbf.OSMStreamToPBF')
+    @patch('eventkit_cloud.utils.overpass.auth_requests.post')
+    def test_run_query_to_pbf(self, mock_post, mock_stream, mock_update_progress):
+        op = Overpass(stage_dir=self.path + '/files/', bbox=self.bbox, job_name='testjob', task_uid=1)
+        pbffile = self.path + '/files/query.pbf'
+        mock_stream.return_value.convert.return_value = pbffile
+        chunks = ['<osm>', '</osm>']
+        mock_post.return_value = Mock(iter_content=Mock(return_value=chunks))
+        user_details = {'username': 'test_user'}
+        self.assertEqual(op.run_query_to_pbf(pbffile, user_details=user_details), pbffile)
+        mock_stream.assert_called_once_with(pbffile=pbffile, task_uid=1)
+        mock_stream.return_value.convert.assert_called_once_with(chunks, user_details=user_details)
+        # The OSM XML is never staged.
+        self.assertFalse(os.path.exists(op.raw_osm))
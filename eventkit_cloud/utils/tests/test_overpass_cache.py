@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from django.test import TestCase
+
+from ..overpass_cache import OverpassCache, get_cache_key, sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+class TestOverpassCache(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.addCleanup(shutil.rmtree, self.stage_dir)
+        self.bbox = [-10.85, 6.25, -10.62, 6.4]
+        self.template = '(node($bbox);<;);out body;'
+
+    def write(self, name, size):
+        path = os.path.join(self.stage_dir, name)
+        with open(path, 'wb') as f:
+            f.write('x' * size)
+        return path
+
+    def test_connections_closed(self):
+        connections = []
+        connect = sqlite3.connect
+
+        def open_connection(*args, **kwargs):
+            connections.append(connect(*args, **kwargs))
+            return connections[-1]
+
+        with patch('eventkit_cloud.utils.overpass_cache.sqlite3.connect', side_effect=open_connection):
+            cache = OverpassCache(self.cache_dir, max_size=100, ttl=60)
+            out = os.path.join(self.stage_dir, 'out.osm')
+            cache.put(self.bbox, self.template, self.write('query.osm', 10))
+            cache.get(self.bbox, self.template, out)
+            cache.get_containing([-10.8, 6.3, -10.7, 6.35], self.template, out)
+            cache.stats()
+        self.assertEqual(len(connections), 5)
+        for connection in connections:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                connection.execute('SELECT 1;')
+
+        # and what they wrote was committed
+        stats = OverpassCache(self.cache_dir, max_size=100, ttl=60).stats()
+        self.assertEqual((stats['hits'], stats['containing_hits'], stats['entries']), (1, 1, 1))
+
+    def test_get_cache_key(self):
+        self.assertEqual(get_cache_key(self.bbox, self.template),
+                         get_cache_key([-10.850000001, 6.25, -10.62, 6.4], self.template))
+        self.assertNotEqual(get_cache_key(self.bbox, self.template), get_cache_key(self.bbox, 'node($bbox);out;'))
+        self.assertNotEqual(get_cache_key(self.bbox, self.template), get_cache_key([0, 0, 1, 1], self.template))
+
+    def test_get_and_put(self):
+        cache = OverpassCache(self.cache_dir, max_size=100, ttl=60)
+        out = os.path.join(self.stage_dir, 'out.osm')
+        self.assertIsNone(cache.get(self.bbox, self.template, out))
+
+        cache.put(self.bbox, self.template, self.write('query.osm', 10))
+        self.assertEqual(cache.get(self.bbox, self.template, out), out)
+        with open(out) as f:
+            self.assertEqual(f.read(), 'x' * 10)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['size'], 10)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    @patch('eventkit_cloud.utils.overpass_cache.time.time')
+    def test_stale_extract(self, mock_time):
+        cache = OverpassCache(self.cache_dir, max_size=100, ttl=60)
+        mock_time.return_value = 1000
+        cache.put(self.bbox, self.template, self.write('query.osm', 10))
+        mock_time.return_value = 1061
+        self.assertIsNone(cache.get(self.bbox, self.template, os.path.join(self.stage_dir, 'out.osm')))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    @patch('eventkit_cloud.utils.overpass_cache.time.time')
+    def test_lru_eviction(self, mock_time):
+        cache = OverpassCache(self.cache_dir, max_size=25, ttl=600)
+        bboxes = [[0, 0, 1, 1], [1, 1, 2, 2], [2, 2, 3, 3]]
+        for index, bbox in enumerate(bboxes[:2]):
+            mock_time.return_value = 1000 + index
+            cache.put(bbox, self.template, self.write('{0}.osm'.format(index), 10))
+        # Reading the first extract makes the second one the least recently used.
+        mock_time.return_value = 1010
+        self.assertTrue(cache.get(bboxes[0], self.template, os.path.join(self.stage_dir, 'out.osm')))
+        mock_time.return_value = 1020
+        cache.put(bboxes[2], self.template, self.write('2.osm', 10))
+
+        self.assertTrue(cache.get(bboxes[0], self.template, os.path.join(self.stage_dir, 'out.osm')))
+        self.assertIsNone(cache.get(bboxes[1], self.template, os.path.join(self.stage_dir, 'out.osm')))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['size'], 20)
+
+        # Extracts larger than the cache are never stored.
+        self.assertIsNone(cache.put(bboxes[1], self.template, self.write('big.osm', 30)))
+
+    def test_get_containing(self):
+        cache = OverpassCache(self.cache_dir, max_size=100, ttl=60)
+        out = os.path.join(self.stage_dir, 'out.osm')
+        cache.put([-11, 6, -10, 7], self.template, self.write('country.osm', 20))
+        cache.put([-10.9, 6.2, -10.5, 6.5], self.template, self.write('city.osm', 10))
+        cache.put([-10.8, 6.3, -10.7, 6.35], self.template, self.write('neighbourhood.osm', 5))
+
+        # The smallest extract that contains the bbox is used.
+        self.assertEqual(cache.get_containing(self.bbox, self.template, out), out)
+        with open(out) as f:
+            self.assertEqual(f.read(), 'x' * 10)
+        self.assertEqual(cache.stats()['containing_hits'], 1)
+
+        self.assertIsNone(cache.get_containing([-12, 6, -10, 7], self.template, out))
+        self.assertIsNone(cache.get_containing(self.bbox, 'node($bbox);out;', out))
+
+        # Evicted extracts are removed from the footprint index.
+        cache.put([0, 0, 1, 1], self.template, self.write('other.osm', 70))
+        self.assertIsNone(cache.get_containing([-10.95, 6.1, -10.6, 6.9], self.template, out))
+        self.assertEqual(cache.get_containing(self.bbox, self.template, out), out)
@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 import logging
 
+from distutils.spawn import find_executable
+import json
 from mock import Mock, patch
+import subprocess
+from unittest import skipUnless
 
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, override_settings
 
-from ..pbf import OSMToPBF
+from ..pbf import OSMToPBF, OSMStreamToPBF, PBFExtract, get_local_pbf, read_pbf_bounds, write_poly_file
 from uuid import uuid4
 import os
+import shutil
+import tempfile
 
 logger = logging.getLogger(__name__)
 
@@ -38,3 +44,153 @@ class TestOSMToPBF(TransactionTestCase):
         self.task_process.return_value = Mock(exitcode=1)
         with self.assertRaises(Exception):
             o2p.convert()
+
+    @patch('os.path.exists')
+    def test_convert_with_bbox(self, exists):
+        osm = '/path/to/sample.osm'
+        pbffile = '/path/to/sample.pbf'
+        convert_cmd = 'osmconvert {0} -b=-10.85,6.25,-10.62,6.4 --out-pbf >{1}'.format(osm, pbffile)
+        exists.return_value = True
+        self.task_process.return_value = Mock(exitcode=0)
+        o2p = OSMToPBF(osm=osm, pbffile=pbffile, task_uid=self.task_uid, bbox=[-10.85, 6.25, -10.62, 6.4])
+        out = o2p.convert()
+        self.task_process().start_process.assert_called_once_with(convert_cmd, executable='/bin/bash', shell=True,
+                                                                  stderr=-1, stdout=-1)
+        self.assertEquals(out, pbffile)
+
+
+class TestOSMStreamToPBF(TransactionTestCase):
+
+    def setUp(self, ):
+        self.task_process_patcher = patch('eventkit_cloud.utils.pbf.TaskProcess')
+        self.task_process = self.task_process_patcher.start()
+        self.addCleanup(self.task_process_patcher.stop)
+        self.task_uid = uuid4()
+        self.stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.stage_dir)
+
+    @patch('audit_logging.file_logging.logging_open')
+    def test_convert(self, logging_open):
+        logging_open.side_effect = lambda filename, mode, user_details=None: open(filename, mode)
+        pbffile = os.path.join(self.stage_dir, 'sample.pbf')
+        o2p = OSMStreamToPBF(pbffile=pbffile, task_uid=self.task_uid)
+        self.assertEqual(o2p.cmd, ['osmconvert', '-', '--out-pbf'])
+        # Stand in for osmconvert with a command that copies stdin to the output.
+        o2p.cmd = ['cat']
+        user_details = {'username': 'test_user'}
+        out = o2p.convert(['<osm>', 'some data', '</osm>'], user_details=user_details)
+        self.assertEqual(out, pbffile)
+        # The download is written through the audit log.
+        logging_open.assert_called_once_with(pbffile, 'wb', user_details=user_details)
+        with open(pbffile) as f:
+            self.assertEqual(f.read(), '<osm>some data</osm>')
+        self.task_process.assert_called_once_with(task_uid=self.task_uid)
+        self.assertEqual(o2p.stats['osm_bytes'], 20)
+        self.assertEqual(o2p.stats['peak_disk_bytes'], 20)
+
+        o2p.cmd = ['sh', '-c', 'exit 1']
+        with self.assertRaises(Exception):
+            o2p.convert(['<osm>', 'some data', '</osm>'])
+
+
+class TestPBFExtract(TransactionTestCase):
+
+    def setUp(self, ):
+        self.path = os.path.dirname(os.path.realpath(__file__))
+        # A small regional extract: a building and a school inside [0, 0, 0.5, 0.5], a road crossing its edge and
+        # another school outside of it.
+        self.region = os.path.join(self.path, 'files', 'sample.osm.pbf')
+        self.task_uid = uuid4()
+        self.stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.stage_dir)
+
+    @patch('eventkit_cloud.utils.pbf.TaskProcess')
+    def test_extract(self, task_process):
+        pbffile = os.path.join(self.stage_dir, 'sample.pbf')
+        poly_file = os.path.join(self.stage_dir, 'sample.poly')
+        extract_cmd = 'osmconvert {0} -B={1} --complete-ways --complex-ways --out-pbf -o={2}'.format(
+            self.region, poly_file, pbffile)
+        task_process.return_value = Mock(exitcode=0)
+        extract = PBFExtract(pbf=self.region, pbffile=pbffile, boundary=[0, 0, 0.5, 0.5], task_uid=self.task_uid)
+        out = extract.extract()
+        task_process.assert_called_once_with(task_uid=self.task_uid)
+        task_process().start_process.assert_called_once_with(extract_cmd, executable='/bin/bash', shell=True,
+                                                             stderr=-1, stdout=-1)
+        self.assertEquals(out, pbffile)
+        self.assertTrue(os.path.isfile(poly_file))
+
+        task_process.return_value = Mock(exitcode=1)
+        with self.assertRaises(Exception):
+            extract.extract()
+
+        with self.assertRaises(IOError):
+            PBFExtract(pbf='/path/to/missing.pbf', pbffile=pbffile, boundary=[0, 0, 0.5, 0.5])
+
+    @skipUnless(find_executable('osmconvert'), 'osmconvert is not installed')
+    def test_extract_fixture(self):
+        pbffile = os.path.join(self.stage_dir, 'sample.pbf')
+        PBFExtract(pbf=self.region, pbffile=pbffile, boundary=[0, 0, 0.5, 0.5], task_uid=self.task_uid).extract()
+        osm = subprocess.check_output(['osmconvert', pbffile, '--out-osm'])
+        self.assertIn('<way id="101"', osm)
+        self.assertIn('<node id="7"', osm)
+        # The road crossing the boundary is kept whole.
+        self.assertIn('<way id="102"', osm)
+        self.assertIn('<node id="6"', osm)
+        self.assertNotIn('<node id="8"', osm)
+
+    def test_write_poly_file(self):
+        poly_file = os.path.join(self.stage_dir, 'bbox.poly')
+        write_poly_file([0, 0, 0.5, 0.5], poly_file)
+        with open(poly_file) as f:
+            self.assertEqual(f.read(), 'boundary\n1_1\n0 0\n0.5 0\n0.5 0.5\n0 0.5\n0 0\nEND\nEND\n')
+
+        selection = os.path.join(self.stage_dir, 'selection.geojson')
+        with open(selection, 'w') as f:
+            json.dump({'type': 'MultiPolygon', 'coordinates': [
+                [[[0, 0], [2, 0], [2, 2], [0, 0]], [[1, 0.2], [1.8, 0.2], [1.8, 1], [1, 0.2]]],
+                [[[5, 5], [6, 5], [6, 6], [5, 5]]]
+            ]}, f)
+        write_poly_file(selection, poly_file)
+        with open(poly_file) as f:
+            self.assertEqual(f.read().split('\n'), [
+                'boundary', '1_1', '0 0', '2 0', '2 2', '0 0', 'END', '!1_2', '1 0.2', '1.8 0.2', '1.8 1', '1 0.2',
+                'END', '2_1', '5 5', '6 5', '6 6', '5 5', 'END', 'END', ''
+            ])
+
+    def test_get_local_pbf(self):
+        self.assertEqual(get_local_pbf('/data/osm/africa.osm.pbf'), '/data/osm/africa.osm.pbf')
+        self.assertEqual(get_local_pbf('file:///data/osm/africa.osm.pbf'), '/data/osm/africa.osm.pbf')
+        with override_settings(OSM_LOCAL_PBF_DIR='/data/osm'):
+            self.assertEqual(get_local_pbf('africa.osm.pbf'), '/data/osm/africa.osm.pbf')
+        with override_settings(OSM_LOCAL_PBF_DIR=None):
+            with self.assertRaises(Exception):
+                get_local_pbf('africa.osm.pbf')
+
+    def test_read_pbf_bounds(self):
+        self.assertEqual(read_pbf_bounds(self.region), [0, 0, 1, 1])
+
+    @patch('eventkit_cloud.utils.pbf.read_pbf_bounds')
+    def test_get_local_pbf_from_extracts(self, read_pbf_bounds):
+        extracts = {'planet.osm.pbf': None, 'africa.osm.pbf': [-20, -35, 52, 38], 'liberia.osm.pbf': [-12, 4, -7, 9],
+                    'liberia.osm.pbf.updating': [-12, 4, -7, 9]}
+        for filename in extracts:
+            open(os.path.join(self.stage_dir, filename), 'w').close()
+        read_pbf_bounds.side_effect = lambda path: extracts[os.path.basename(path)]
+
+        # The smallest extract covering the bbox is read.
+        self.assertEqual(get_local_pbf(self.stage_dir, bbox=[-10.85, 6.25, -10.62, 6.40]),
+                         os.path.join(self.stage_dir, 'liberia.osm.pbf'))
+        self.assertEqual(get_local_pbf(self.stage_dir, bbox=[-15, 6, -10, 7]),
+                         os.path.join(self.stage_dir, 'africa.osm.pbf'))
+        # PBFs without bounds cover the world.
+        self.assertEqual(get_local_pbf(self.stage_dir, bbox=[100, 6, 101, 7]),
+                         os.path.join(self.stage_dir, 'planet.osm.pbf'))
+        with override_settings(OSM_LOCAL_PBF_DIR=self.stage_dir):
+            self.assertEqual(get_local_pbf('.', bbox=[-10.85, 6.25, -10.62, 6.40]),
+                             os.path.join(self.stage_dir, '.', 'liberia.osm.pbf'))
+        # Without a bbox the directory itself is returned.
+        self.assertEqual(get_local_pbf(self.stage_dir), self.stage_dir)
+
+        os.remove(os.path.join(self.stage_dir, 'planet.osm.pbf'))
+        with self.assertRaises(Exception):
+            get_local_pbf(self.stage_dir, bbox=[100, 6, 101, 7])
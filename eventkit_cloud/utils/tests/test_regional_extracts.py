@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from distutils.spawn import find_executable
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import skipUnless
+
+from mock import Mock, patch
+
+from django.test import TransactionTestCase
+
+from ..regional_extracts import RegionalExtract, get_region_name, update_regional_extracts
+
+logger = logging.getLogger(__name__)
+
+
+class TestRegionalExtract(TransactionTestCase):
+
+    def setUp(self, ):
+        self.path = os.path.dirname(os.path.realpath(__file__))
+        self.pbf_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.pbf_dir)
+        self.pbf = os.path.join(self.pbf_dir, 'sample.osm.pbf')
+        shutil.copy(os.path.join(self.path, 'files', 'sample.osm.pbf'), self.pbf)
+        self.changes_dir = os.path.join(self.pbf_dir, 'sample.changes')
+        os.mkdir(self.changes_dir)
+        self.change_files = [os.path.join(self.changes_dir, name) for name in ['000002.osc', '000001.osc']]
+        for change_file in self.change_files:
+            shutil.copy(os.path.join(self.path, 'files', 'sample.osc'), change_file)
+
+    def write_update_file(self, exitcode):
+        def start_process(cmd, *args, **kwargs):
+            if exitcode == 0:
+                with open(os.path.join(self.pbf_dir, 'sample.pbf.updating'), 'w') as f:
+                    f.write('updated')
+        return Mock(exitcode=exitcode, start_process=Mock(side_effect=start_process))
+
+    @patch('eventkit_cloud.utils.regional_extracts.TaskProcess')
+    def test_apply_changes(self, task_process):
+        task_process.return_value = self.write_update_file(0)
+        extract = RegionalExtract(self.pbf)
+        self.assertEqual(extract.pending_changes(), sorted(self.change_files))
+        self.assertTrue(extract.update())
+        apply_cmd = 'osmconvert {0} {1}  --out-pbf -o={2}'.format(
+            self.pbf, ' '.join(sorted(self.change_files)), os.path.join(self.pbf_dir, 'sample.pbf.updating'))
+        task_process().start_process.assert_called_once_with(apply_cmd, executable='/bin/bash', shell=True,
+                                                             stderr=-1, stdout=-1)
+        with open(self.pbf) as f:
+            self.assertEqual(f.read(), 'updated')
+        self.assertEqual(extract.pending_changes(), [])
+
+        # Nothing left to apply.
+        task_process.reset_mock()
+        self.assertFalse(extract.update())
+        task_process.assert_not_called()
+
+    @patch('eventkit_cloud.utils.regional_extracts.TaskProcess')
+    def test_apply_changes_failure(self, task_process):
+        task_process.return_value = self.write_update_file(1)
+        with open(self.pbf) as f:
+            original = f.read()
+        extract = RegionalExtract(self.pbf)
+        with self.assertRaises(Exception):
+            extract.update()
+        # The PBF and the change files are left for the next attempt.
+        with open(self.pbf) as f:
+            self.assertEqual(f.read(), original)
+        self.assertEqual(extract.pending_changes(), sorted(self.change_files))
+
+    @patch('eventkit_cloud.utils.regional_extracts.TaskProcess')
+    def test_fetch_changes(self, task_process):
+        for change_file in self.change_files:
+            os.remove(change_file)
+        with open(os.path.join(self.pbf_dir, 'sample.poly'), 'w') as f:
+            f.write('sample\n1\n0 0\n1 0\n1 1\n0 0\nEND\nEND\n')
+        task_process.return_value = self.write_update_file(0)
+        extract = RegionalExtract(self.pbf, update_url='http://example.com/replication')
+        self.assertTrue(extract.update())
+        fetch_cmd = 'osmupdate {0} {1} --base-url=http://example.com/replication --tempfiles={2} -B={3}'.format(
+            self.pbf, os.path.join(self.pbf_dir, 'sample.pbf.updating'),
+            os.path.join(self.changes_dir, 'osmupdate_temp', 'temp'), os.path.join(self.pbf_dir, 'sample.poly'))
+        task_process().start_process.assert_called_once_with(fetch_cmd, executable='/bin/bash', shell=True,
+                                                             stderr=-1, stdout=-1)
+
+        task_process.return_value = self.write_update_file(21)
+        self.assertFalse(extract.update())
+
+    @patch('eventkit_cloud.utils.regional_extracts.TaskProcess')
+    def test_update_locked(self, task_process):
+        extract = RegionalExtract(self.pbf)
+        with open(extract.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertFalse(extract.update())
+        task_process.assert_not_called()
+
+    @patch('eventkit_cloud.utils.regional_extracts.TaskProcess')
+    def test_update_regional_extracts(self, task_process):
+        shutil.copy(self.pbf, os.path.join(self.pbf_dir, 'other.osm.pbf'))
+        task_process.return_value = self.write_update_file(0)
+        self.assertEqual(update_regional_extracts(self.pbf_dir), [self.pbf])
+
+        # A failing region doesn't stop the others from updating.
+        os.mkdir(os.path.join(self.pbf_dir, 'other.changes'))
+        shutil.copy(os.path.join(self.path, 'files', 'sample.osc'), os.path.join(self.pbf_dir, 'other.changes'))
+        task_process.return_value = self.write_update_file(1)
+        self.assertEqual(update_regional_extracts(self.pbf_dir), [])
+
+    def test_get_region_name(self):
+        self.assertEqual(get_region_name('/data/osm/africa.osm.pbf'), 'africa')
+        self.assertEqual(get_region_name('/data/osm/africa.pbf'), 'africa')
+
+    @skipUnless(find_executable('osmconvert'), 'osmconvert is not installed')
+    def test_apply_changes_fixture(self):
+        os.remove(self.change_files[0])
+        RegionalExtract(self.pbf).update()
+        osm = subprocess.check_output(['osmconvert', self.pbf, '--out-osm'])
+        self.assertIn('<node id="9"', osm)
+        self.assertIn('Central School', osm)
+        self.assertNotIn('<node id="8"', osm)
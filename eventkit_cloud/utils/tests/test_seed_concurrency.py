@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.test import TestCase
+from mapproxy.config.config import load_config, load_default_config
+from mapproxy.config.loader import ProxyConfiguration
+from mapproxy.seed.config import SeedingConfiguration
+from mapproxy.seed.seeder import seed as seed_task
+from mapproxy.seed.util import ProgressLog, ProgressStore
+from mock import Mock, patch
+
+from ..seed_concurrency import REQUEST_LOGGER, ConcurrencyController, RequestStats, level_bands, record_requests, \
+    seed
+
+
+def log_requests(*statuses, **kwargs):
+    request_logger = logging.getLogger(REQUEST_LOGGER)
+    for status in statuses:
+        request_logger.info('%s %s %s %s %s', 'GET', 'http://tiles.example.com/1/0/0.png', status, 100,
+                            kwargs.get('duration', '20'))
+
+
+def get_seed_tasks(cache_dir):
+    """
+    Return:
+        MapProxy seed tasks of levels 0 to 3 of GLOBAL_GEODETIC, which have 1, 2, 8 and 32 tiles, from a debug source
+        to a file cache in cache_dir.
+    """
+    conf_dict = {
+        'sources': {'debug': {'type': 'debug'}},
+        'caches': {'cache': {'sources': ['debug'], 'grids': ['GLOBAL_GEODETIC'], 'meta_size': [1, 1],
+                             'cache': {'type': 'file', 'directory': cache_dir}}},
+        'layers': [{'name': 'debug', 'title': 'debug', 'sources': ['cache']}],
+        'services': {'demo': None}
+    }
+    mapproxy_config = load_default_config()
+    load_config(mapproxy_config, config_dict=conf_dict)
+    mapproxy_configuration = ProxyConfiguration(mapproxy_config, seed=True, renderd=None)
+    seed_dict = {'seeds': {'seed': {'caches': ['cache'], 'levels': {'from': 0, 'to': 3},
+                                    'refresh_before': {'minutes': 0}}}}
+    return SeedingConfiguration(seed_dict, mapproxy_conf=mapproxy_configuration).seeds(['seed'])
+
+
+def count_tiles(cache_dir, level):
+    return sum(len(files) for root, dirs, files in os.walk(os.path.join(cache_dir, '{0:02d}'.format(level))))
+
+
+class TestRequestStats(TestCase):
+
+    def test_record_requests(self):
+        request_logger = logging.getLogger(REQUEST_LOGGER)
+        level, propagate = request_logger.level, request_logger.propagate
+        with record_requests(RequestStats()) as stats:
+            log_requests(200, 200, 404)
+            log_requests(429, 500, '-', duration='-')
+            self.assertEqual(stats.take(), {'requests': 6, 'errors': 3, 'throttled': 1, 'duration': 60})
+            self.assertEqual(stats.take(), {'requests': 0, 'errors': 0, 'throttled': 0, 'duration': 0})
+        self.assertEqual((request_logger.level, request_logger.propagate), (level, propagate))
+        self.assertEqual(request_logger.handlers, [])
+
+
+class TestConcurrencyController(TestCase):
+
+    def setUp(self):
+        self.state = {}
+        self.cache = Mock(get=Mock(side_effect=self.state.get),
+                          set=Mock(side_effect=lambda key, value, timeout: self.state.update({key: value})))
+
+    @patch('eventkit_cloud.utils.seed_concurrency.settings')
+    def test_default_concurrency(self, mock_settings):
+        mock_settings.MAPPROXY_CONCURRENCY = '2'
+        controller = ConcurrencyController('imagery', cache=self.cache)
+        self.assertEqual((controller.concurrency, controller.max_concurrency), (2, 2))
+        controller = ConcurrencyController('imagery', max_concurrency=16, cache=self.cache)
+        self.assertEqual((controller.concurrency, controller.max_concurrency), (2, 16))
+
+    def test_update(self):
+        controller = ConcurrencyController('imagery', max_concurrency=16, cache=self.cache)
+        controller.concurrency = 1
+        # too few requests to judge the provider by
+        self.assertEqual(controller.update(requests=5, errors=5, throttled=5, duration=500), 1)
+
+        # doubles while the provider keeps up
+        self.assertEqual(controller.update(requests=100, duration=2000), 2)
+        self.assertEqual(controller.update(requests=100, duration=2000), 4)
+        self.assertEqual(controller.update(requests=100, errors=2, duration=2000), 8)
+        # halves once the provider throttles, then grows one request at a time
+        self.assertEqual(controller.update(requests=100, errors=3, throttled=3, duration=2000), 4)
+        self.assertEqual(controller.update(requests=100, duration=2000), 5)
+        # backs off when requests slow down or fail
+        self.assertEqual(controller.update(requests=100, duration=4000), 4)
+        self.assertEqual(controller.update(requests=100, errors=10, duration=2000), 2)
+
+        # the next export starts where this one left off
+        controller = ConcurrencyController('imagery', max_concurrency=16, cache=self.cache)
+        self.assertEqual((controller.concurrency, controller.slow_start), (2, False))
+        self.assertAlmostEqual(controller.latency, 20.0)
+        # but never above the maximum of the provider
+        controller = ConcurrencyController('imagery', max_concurrency=1, cache=self.cache)
+        self.assertEqual(controller.concurrency, 1)
+        self.assertEqual(controller.update(requests=100, duration=2000), 1)
+
+    @patch('eventkit_cloud.utils.seed_concurrency.level_bands', Mock(return_value=[None]))
+    @patch('eventkit_cloud.utils.seed_concurrency.seeder')
+    def test_seed(self, mock_seeder):
+        controller = ConcurrencyController('imagery', max_concurrency=16, cache=self.cache)
+        controller.concurrency = 4
+        progress_logger = Mock()
+        calls = []
+
+        def seed_level(tasks, concurrency, progress_logger):
+            calls.append((tasks[0].levels, concurrency, progress_logger.progress_offset,
+                          progress_logger.progress_scale))
+            log_requests(*([200] * 40 if concurrency < 8 else [429] * 40))
+
+        mock_seeder.seed.side_effect = seed_level
+        seed([Mock(levels=[0, 1, 2])], controller, progress_logger)
+
+        self.assertEqual(calls, [([0], 4, 0.0, 1 / 21.0), ([1], 8, 1 / 21.0, 4 / 21.0),
+                                 ([2], 4, 5 / 21.0, 16 / 21.0)])
+        self.assertEqual(controller.concurrency, 5)
+
+    @patch('eventkit_cloud.utils.seed_concurrency.BATCH_TILES', 8)
+    @patch('eventkit_cloud.utils.seed_concurrency.seeder')
+    def test_seed_backs_off_within_level(self, mock_seeder):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        controller = ConcurrencyController('debug', max_concurrency=16, cache=self.cache)
+        controller.concurrency = 4
+        calls = []
+
+        def seed_band(tasks, concurrency, progress_logger):
+            level, batch = tasks[0].id[-2:]
+            calls.append((level, batch, concurrency))
+            # the provider starts throttling in the second band of the last level
+            log_requests(*([429] * 40 if (level, batch) >= (3, 1) else [200] * 40))
+
+        mock_seeder.seed.side_effect = seed_band
+        seed(get_seed_tasks(cache_dir), controller)
+
+        # the last level is seeded a row of 8 tiles at a time, and backs off before it is done
+        self.assertEqual(calls, [(0, 0, 4), (1, 0, 8), (2, 0, 16), (3, 0, 16), (3, 1, 16), (3, 2, 8), (3, 3, 4)])
+        self.assertEqual(controller.concurrency, 2)
+
+    @patch('eventkit_cloud.utils.seed_concurrency.BATCH_TILES', 8)
+    def test_seed_checkpoints_each_band(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        tasks = get_seed_tasks(cache_dir)
+        progress_store = ProgressStore(os.path.join(cache_dir, 'seed_progress'), continue_seed=True)
+        progress_logger = ProgressLog(out=StringIO(), progress_store=progress_store)
+        controller = ConcurrencyController('debug', max_concurrency=1, cache=self.cache)
+        self.assertEqual(len(level_bands(tasks[0], 3)), 4)
+        seeded = []
+
+        def seed_band(**kwargs):
+            seed_task(**kwargs)
+            seeded.append(count_tiles(cache_dir, 3))
+
+        with patch('eventkit_cloud.utils.seed_concurrency.seeder.seed', side_effect=seed_band):
+            seed(tasks, controller, progress_logger)
+
+        # a band doesn't resume from the checkpoint of the band or level before it
+        self.assertEqual(sorted(progress_store.status),
+                         [('seed', 'cache', 'GLOBAL_GEODETIC', level, 0) for level in range(3)] +
+                         [('seed', 'cache', 'GLOBAL_GEODETIC', 3, batch) for batch in range(4)])
+        self.assertEqual([count_tiles(cache_dir, level) for level in range(4)], [1, 2, 8, 32])
+        # each band of the last level seeds its own row of tiles
+        self.assertEqual(seeded[-4:], [8, 16, 24, 32])
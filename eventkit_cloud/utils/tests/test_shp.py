@@ -20,6 +20,9 @@ class TestGPKGToShp(TestCase):
         self.task_process_patcher = patch('eventkit_cloud.utils.shp.TaskProcess')
         self.task_process = self.task_process_patcher.start()
         self.addCleanup(self.task_process_patcher.stop)
+        self.run_gdal_patcher = patch('eventkit_cloud.utils.shp.run_gdal')
+        self.run_gdal = self.run_gdal_patcher.start()
+        self.addCleanup(self.run_gdal_patcher.stop)
         self.task_uid = uuid4()
 
     @patch('os.path.exists')
@@ -30,16 +33,14 @@ class TestGPKGToShp(TestCase):
         cmd = "ogr2ogr -f 'ESRI Shapefile' {0} {1} -lco ENCODING=UTF-8 -nln {2} -overwrite".format(shapefile, gpkg, layer_name)
         exists.return_value = True
 
-        self.task_process.return_value = Mock(exitcode=0)
+        self.run_gdal.return_value = Mock(exitcode=0)
         # set zipped to False for testing
         s2s = GPKGToShp(gpkg=gpkg, shapefile=shapefile,
                         zipped=False, debug=False, task_uid=self.task_uid)
         out = s2s.convert()
-        # export_task.assert_called_once()
-        self.task_process.assert_called_once_with(task_uid=self.task_uid)
         exists.assert_called_once_with(gpkg)
-        self.task_process().start_process.assert_called_once_with(cmd, executable='/bin/bash', shell=True, stderr=-1, stdout=-1)
-        self.task_process.return_value = Mock(exitcode=1)
+        self.run_gdal.assert_called_once_with(cmd, task_uid=self.task_uid)
+        self.run_gdal.return_value = Mock(exitcode=1)
         self.assertEquals(out, shapefile)
         with self.assertRaises(Exception):
             s2s.convert()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from mock import patch
+from pysqlite2 import dbapi2 as sqlite3
+
+from ..tile_cache import TileCache
+
+
+class TestTileCache(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = TileCache(self.cache_dir, 'imagery', max_size=100, ttl=60)
+        # the shared cache as created by MapProxy
+        with sqlite3.connect(self.cache.filename) as conn:
+            conn.execute("CREATE TABLE tiles (id INTEGER PRIMARY KEY, zoom_level INTEGER NOT NULL, "
+                         "tile_column INTEGER NOT NULL, tile_row INTEGER NOT NULL, tile_data BLOB NOT NULL, "
+                         "UNIQUE (zoom_level, tile_column, tile_row))")
+
+    def add_tiles(self, gpkg, table, tiles, size=10):
+        with sqlite3.connect(gpkg) as conn:
+            for z, x, y in tiles:
+                conn.execute("INSERT OR REPLACE INTO {0} (zoom_level, tile_column, tile_row, tile_data) "
+                             "VALUES (?, ?, ?, ?)".format(table), (z, x, y, sqlite3.Binary('x' * size)))
+
+    def set_created(self, created):
+        with sqlite3.connect(self.cache.filename) as conn:
+            conn.execute("UPDATE tile_cache_meta SET created = ?", (created,))
+
+    def get_tiles(self):
+        with sqlite3.connect(self.cache.filename) as conn:
+            return conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles ORDER BY id").fetchall()
+
+    def run_gpkg(self, tiles):
+        gpkg = os.path.join(self.cache_dir, 'run.gpkg')
+        with sqlite3.connect(gpkg) as conn:
+            conn.execute("CREATE TABLE gpkg_contents (table_name TEXT, data_type TEXT)")
+            conn.execute("INSERT INTO gpkg_contents VALUES ('imagery', 'tiles')")
+            conn.execute("CREATE TABLE imagery (id INTEGER PRIMARY KEY, zoom_level INTEGER, tile_column INTEGER, "
+                         "tile_row INTEGER, tile_data BLOB)")
+        self.add_tiles(gpkg, 'imagery', tiles)
+        return gpkg
+
+    @patch('eventkit_cloud.utils.tile_cache.settings')
+    def test_from_settings(self, mock_settings):
+        mock_settings.TILE_CACHE_DIR = None
+        self.assertIsNone(TileCache.from_settings('imagery'))
+        self.assertEqual(TileCache.all_from_settings(), [])
+
+        mock_settings.TILE_CACHE_DIR = self.cache_dir
+        mock_settings.TILE_CACHE_MAX_SIZE = 1000
+        mock_settings.TILE_CACHE_TTL = 3600
+        cache = TileCache.from_settings('imagery')
+        self.assertEqual((cache.filename, cache.max_size, cache.ttl), (self.cache.filename, 1000, 3600))
+        self.assertEqual([cache.provider for cache in TileCache.all_from_settings()], ['imagery'])
+
+    def test_install(self):
+        # tiles stored before the cache was tracked are backfilled, new tiles are timed by the trigger
+        self.add_tiles(self.cache.filename, 'tiles', [(0, 0, 0)])
+        self.cache.prepare()
+        self.add_tiles(self.cache.filename, 'tiles', [(1, 0, 0), (1, 1, 0)])
+        stats = self.cache.stats()
+        self.assertEqual((stats['tiles'], stats['size']), (3, 30))
+
+        # installing again doesn't touch the recorded tiles
+        with self.cache.connect() as conn:
+            self.assertTrue(self.cache.install(conn))
+        self.assertEqual(self.cache.stats()['tiles'], 3)
+
+    def test_install_before_mapproxy(self):
+        os.remove(self.cache.filename)
+        self.cache.prepare()
+        self.assertFalse(os.path.isfile(self.cache.filename))
+        with sqlite3.connect(self.cache.filename) as conn:
+            self.assertFalse(self.cache.install(conn))
+
+    @patch('eventkit_cloud.utils.tile_cache.time.time')
+    def test_expire(self, mock_time):
+        mock_time.return_value = 1000
+        self.cache.prepare()
+        self.add_tiles(self.cache.filename, 'tiles', [(0, 0, 0), (1, 0, 0)])
+        self.set_created(1000)
+        self.add_tiles(self.cache.filename, 'tiles', [(1, 1, 0)])
+
+        mock_time.return_value = 1061
+        self.cache.prepare()
+        self.assertEqual(self.get_tiles(), [(1, 1, 0)])
+        stats = self.cache.stats()
+        self.assertEqual((stats['tiles'], stats['expirations']), (1, 2))
+
+    def test_evict(self):
+        self.cache.prepare()
+        self.add_tiles(self.cache.filename, 'tiles', [(1, 0, 0), (1, 1, 0), (1, 0, 1)], size=30)
+        with sqlite3.connect(self.cache.filename) as conn:
+            conn.execute("UPDATE tile_cache_meta SET created = created - 10 + tile_column + 2 * tile_row")
+        self.add_tiles(self.cache.filename, 'tiles', [(2, 0, 0)], size=30)
+
+        # the oldest tile is evicted to fit 120 bytes of tiles into 100
+        self.cache.prepare()
+        self.assertEqual(self.get_tiles(), [(1, 1, 0), (1, 0, 1), (2, 0, 0)])
+        stats = self.cache.stats()
+        self.assertEqual((stats['size'], stats['evictions']), (90, 1))
+
+    @patch('eventkit_cloud.utils.geopackage.get_tile_table_names')
+    def test_connections_closed(self, get_tile_table_names):
+        get_tile_table_names.return_value = ['imagery']
+        gpkg = self.run_gpkg([(0, 0, 0)])
+        connections = []
+        connect = sqlite3.connect
+
+        def open_connection(*args, **kwargs):
+            connections.append(connect(*args, **kwargs))
+            return connections[-1]
+
+        with patch('eventkit_cloud.utils.tile_cache.sqlite3.connect', side_effect=open_connection):
+            start = self.cache.prepare()
+        self.add_tiles(self.cache.filename, 'tiles', [(0, 0, 0)])
+        with patch('eventkit_cloud.utils.tile_cache.sqlite3.connect', side_effect=open_connection):
+            self.cache.record(gpkg, start)
+            self.cache.stats()
+        self.assertEqual(len(connections), 4)
+        for connection in connections:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                connection.execute('SELECT 1;')
+
+        # and what they wrote was committed
+        stats = TileCache(self.cache_dir, 'imagery', max_size=100, ttl=60).stats()
+        self.assertEqual((stats['misses'], stats['tiles']), (1, 1))
+
+    @patch('eventkit_cloud.utils.tile_cache.time.time')
+    def test_record(self, mock_time):
+        mock_time.return_value = 1000
+        self.cache.prepare()
+        self.add_tiles(self.cache.filename, 'tiles', [(0, 0, 0), (1, 0, 0), (1, 1, 0)])
+        self.set_created(990)
+
+        # the run only fetched the last tile from the provider
+        start = self.cache.prepare()
+        self.add_tiles(self.cache.filename, 'tiles', [(1, 0, 1)])
+        gpkg = self.run_gpkg([(0, 0, 0), (1, 0, 0), (1, 1, 0), (1, 0, 1)])
+        self.assertEqual(self.cache.record(gpkg, start), (3, 1))
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (3, 1, 0.75))
+        self.assertEqual((stats['tiles'], stats['size'], stats['max_size']), (4, 40, 100))
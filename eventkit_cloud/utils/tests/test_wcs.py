@@ -18,6 +18,10 @@ class TestWCSConverter(TransactionTestCase):
         self.path = settings.ABS_PATH()
         self.task_process_patcher = patch('eventkit_cloud.utils.wcs.TaskProcess')
         self.task_process = self.task_process_patcher.start()
+        self.raster_options_patcher = patch('eventkit_cloud.utils.wcs.get_raster_options')
+        self.raster_options = self.raster_options_patcher.start()
+        self.raster_options.return_value = '--config GDAL_NUM_THREADS 2'
+        self.addCleanup(self.raster_options_patcher.stop)
         self.addCleanup(self.task_process_patcher.stop)
         self.task_uid = uuid4()
 
@@ -28,7 +32,7 @@ class TestWCSConverter(TransactionTestCase):
         layer = 'awesomeLayer'
         name = 'Great export'
         service_url = 'http://my-service.org/some-server/wcs?'
-        cmd = Template("gdal_translate -projwin $minX $maxY $maxX $minY -of gtiff $type $wcs $out")
+        cmd = Template("gdal_translate $profile -projwin $minX $maxY $maxX $minY -of gtiff $type $wcs $out")
 
         exists.return_value = True
         self.task_process.return_value = Mock(exitcode=0)
@@ -47,7 +51,8 @@ class TestWCSConverter(TransactionTestCase):
         exists.assert_called_once_with(os.path.dirname(geotiff))
 
         cmd = cmd.safe_substitute({'out': geotiff, 'wcs': wcs_conv.wcs_xml_path, 'minX': bbox[0], 'minY': bbox[1],
-                                   'maxX': bbox[2], 'maxY': bbox[3], 'type': ''})
+                                   'maxX': bbox[2], 'maxY': bbox[3], 'type': '',
+                                   'profile': '--config GDAL_NUM_THREADS 2'})
         self.task_process().start_process.assert_called_once_with(cmd, executable='/bin/sh', shell=True, stderr=-1,
                                                                   stdout=-1)
         self.assertEquals(out, geotiff)
@@ -63,7 +68,7 @@ class TestWCSConverter(TransactionTestCase):
         layer = 'awesomeLayer'
         name = 'Great export'
         service_url = 'http://my-service.org/some-server/wcs?'
-        cmd = Template("gdal_translate -projwin $minX $maxY $maxX $minY -of gpkg $type $wcs $out")
+        cmd = Template("gdal_translate $profile -projwin $minX $maxY $maxX $minY -of gpkg $type $wcs $out")
 
         exists.return_value = True
         self.task_process.return_value = Mock(exitcode=0)
@@ -82,7 +87,8 @@ class TestWCSConverter(TransactionTestCase):
         exists.assert_called_once_with(os.path.dirname(geotiff))
 
         cmd = cmd.safe_substitute({'out': geotiff, 'wcs': wcs_conv.wcs_xml_path, 'minX': bbox[0], 'minY': bbox[1],
-                                   'maxX': bbox[2], 'maxY': bbox[3], 'type': '-ot byte'})
+                                   'maxX': bbox[2], 'maxY': bbox[3], 'type': '-ot byte',
+                                   'profile': '--config GDAL_NUM_THREADS 2'})
         self.task_process().start_process.assert_called_once_with(cmd, executable='/bin/sh', shell=True, stderr=-1,
                                                                   stdout=-1)
         self.assertEquals(out, geotiff)
@@ -1,26 +1,125 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 from mock import Mock, patch, MagicMock
 import requests
 from django.conf import settings
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, override_settings
 from string import Template
+from ..gdalutils import GdalProgress
 from ..wfs import WFSToGPKG
+from ...tasks.exceptions import CancelException
+from ...tasks.export_tasks import TaskStates
 from uuid import uuid4
 
 logger = logging.getLogger(__name__)
 
 
+class StandInWFSServer(ThreadingMixIn, HTTPServer):
+    """
+    A local WFS 2.0 service with a layer of numbered point features, which records the pages it is asked for.
+    It returns at most count_default features a page, which its capabilities declare unless hide_count_default is set.
+    """
+    daemon_threads = True
+
+    def __init__(self, features=25, supports_paging=True, delay=0.1, count_default=None, hide_count_default=False,
+                 implements_sorting=False):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInWFSHandler)
+        self.features = features
+        self.supports_paging = supports_paging
+        self.delay = delay
+        self.count_default = count_default
+        self.hide_count_default = hide_count_default
+        self.implements_sorting = implements_sorting
+        self.pages = []
+        self.sort_by = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:{0}/wfs'.format(self.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInWFSHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        if not server.supports_paging or params.get('VERSION') != '2.0.0':
+            self.reply(400, '<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows/1.1"/>')
+        elif params.get('REQUEST') == 'GetCapabilities':
+            constraints = {'ImplementsSorting': str(server.implements_sorting).upper()}
+            if server.count_default and not server.hide_count_default:
+                constraints['CountDefault'] = server.count_default
+            self.reply(200, '<wfs:WFS_Capabilities xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+                            'xmlns:ows="http://www.opengis.net/ows/1.1"><ows:OperationsMetadata>{0}'
+                            '</ows:OperationsMetadata></wfs:WFS_Capabilities>'.format(''.join(
+                                '<ows:Constraint name="{0}"><ows:NoValues/><ows:DefaultValue>{1}</ows:DefaultValue>'
+                                '</ows:Constraint>'.format(*constraint) for constraint in constraints.items())))
+        elif params.get('REQUEST') == 'DescribeFeatureType':
+            self.reply(200, '<xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">'
+                            '<xsd:complexType name="pointType"><xsd:complexContent>'
+                            '<xsd:extension base="gml:AbstractFeatureType"><xsd:sequence>'
+                            '<xsd:element name="the_geom" type="gml:PointPropertyType"/>'
+                            '<xsd:element name="id" type="xsd:int"/></xsd:sequence></xsd:extension>'
+                            '</xsd:complexContent></xsd:complexType></xsd:schema>')
+        elif params.get('RESULTTYPE') == 'hits':
+            self.reply(200, '<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+                            'numberMatched="{0}" numberReturned="0"/>'.format(server.features))
+        else:
+            with server.lock:
+                server.active += 1
+                server.max_active = max(server.max_active, server.active)
+                server.pages.append((int(params['STARTINDEX']), int(params['COUNT'])))
+                server.sort_by.append(params.get('SORTBY'))
+            time.sleep(server.delay)
+            start = int(params['STARTINDEX'])
+            count = min(int(params['COUNT']), server.count_default or server.features)
+            ids = range(start, min(start + count, server.features))
+            features = ''.join('<wfs:member><test:point gml:id="point.{0}"><test:id>{0}</test:id></test:point>'
+                               '</wfs:member>'.format(feature_id) for feature_id in ids)
+            with server.lock:
+                server.active -= 1
+            self.reply(200, '<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+                            'xmlns:gml="http://www.opengis.net/gml/3.2" xmlns:test="http://test" '
+                            'numberReturned="{0}">{1}</wfs:FeatureCollection>'.format(len(ids), features))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
 class TestWFSToGPKG(TransactionTestCase):
 
     def setUp(self, ):
         self.path = settings.ABS_PATH()
-        self.task_process_patcher = patch('eventkit_cloud.utils.wfs.TaskProcess')
-        self.task_process = self.task_process_patcher.start()
-        self.addCleanup(self.task_process_patcher.stop)
+        self.run_gdal_patcher = patch('eventkit_cloud.utils.wfs.run_gdal')
+        self.run_gdal = self.run_gdal_patcher.start()
+        self.addCleanup(self.run_gdal_patcher.stop)
         self.task_uid = uuid4()
 
+    @patch('eventkit_cloud.utils.wfs.WFSToGPKG.get_hit_count', Mock(return_value=None))
     @patch('eventkit_cloud.utils.wfs.check_content_exists')
     @patch('eventkit_cloud.utils.wfs.os.path.exists')
     def test_create_convert(self, exists, check_content_exists):
@@ -34,7 +133,7 @@ class TestWFSToGPKG(TransactionTestCase):
         cmd = cmd.safe_substitute({'gpkg': gpkg, 'url': expected_url, 'minX': bbox[0], 'minY': bbox[1], 'maxX': bbox[2], 'maxY': bbox[3]})
         exists.return_value = True
         check_content_exists.return_value = True
-        self.task_process.return_value = Mock(exitcode=0)
+        self.run_gdal.return_value = Mock(exitcode=0)
         # set zipped to False for testing
         w2g = WFSToGPKG(gpkg=gpkg,
                         bbox=bbox,
@@ -45,14 +144,160 @@ class TestWFSToGPKG(TransactionTestCase):
                         service_type=None,
                         task_uid=self.task_uid)
         out = w2g.convert()
-        self.task_process.assert_called_once_with(task_uid=self.task_uid)
         exists.assert_called_once_with(os.path.dirname(gpkg))
-        self.task_process().start_process.assert_called_once_with(cmd, executable='/bin/sh', shell=True, stderr=-1,
-                                                                  stdout=-1)
+        self.run_gdal.assert_called_once_with(cmd, task_uid=self.task_uid, executable='/bin/sh')
         self.assertEquals(out, gpkg)
 
-        self.task_process.return_value = Mock(exitcode=1)
+        self.run_gdal.return_value = Mock(exitcode=1)
         with self.assertRaises(Exception):
             w2g.convert()
 
+    @override_settings(WFS_PAGE_SIZE=10, WFS_PAGE_WORKERS=1, WFS_PAGE_RETRIES=0)
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    @patch('eventkit_cloud.utils.wfs.check_content_exists')
+    def test_convert_pages(self, check_content_exists, update_progress):
+        stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, stage_dir)
+        gpkg = os.path.join(stage_dir, 'wfs.gpkg')
+        check_content_exists.return_value = True
+        appended = []
+
+        def append_page(cmd, task_uid=None, progress_offset=0.0, progress_scale=1.0):
+            self.assertEquals(task_uid, self.task_uid)
+            page_file = cmd.split()[-1]
+            with open(page_file) as page:
+                appended.append(page.read().count('<test:point '))
+            # ogr2ogr reports its progress through the page
+            progress = GdalProgress(task_uid, progress_offset=progress_offset, progress_scale=progress_scale)
+            for complete in (0.0, 0.5, 1.0):
+                progress(complete)
+            return Mock(exitcode=0)
+        self.run_gdal.side_effect = append_page
+
+        with StandInWFSServer(features=25) as server:
+            w2g = WFSToGPKG(gpkg=gpkg, bbox=[-45, -30, 45, 30], service_url='{0}?map=test'.format(server.url),
+                            layer='test:point', name='wfs', task_uid=self.task_uid, max_concurrency=3)
+            out = w2g.convert()
+
+        self.assertEquals(out, gpkg)
+        self.assertEquals([(0, 10), (10, 10), (20, 5)], sorted(server.pages))
+        self.assertEquals([None] * 3, server.sort_by)
+        # The pages are requested as concurrently as the provider allows.
+        self.assertEquals(3, server.max_active)
+        self.assertEquals([5, 10, 10], sorted(appended))
+        commands = [call[0][0] for call in self.run_gdal.call_args_list]
+        self.assertNotIn('-append', commands[0])
+        self.assertTrue(all('-append' in cmd for cmd in commands[1:]))
+        self.assertTrue(all(cmd.startswith('ogr2ogr -skipfailures') for cmd in commands))
+        self.assertEquals([], [name for name in os.listdir(stage_dir) if name.endswith('.gml')])
+        self.assertAlmostEquals(100.0, update_progress.call_args[1]['progress'])
+        # The progress of the pages and of ogr2ogr within them only goes forward.
+        progress = [call[1]['progress'] for call in update_progress.call_args_list]
+        self.assertEquals(sorted(progress), progress)
+        self.assertGreater(len(progress), 3)
+
+        # A page the service fails to return fails the export.
+        with StandInWFSServer(features=25) as server:
+            w2g = WFSToGPKG(gpkg=gpkg, service_url=server.url, layer='test:point', name='wfs',
+                            task_uid=self.task_uid)
+            with patch.object(w2g, 'get_params', return_value={'VERSION': '1.0.0'}):
+                with self.assertRaises(Exception):
+                    w2g.convert_pages(server.url, 25, 10)
+        self.assertEquals([], [name for name in os.listdir(stage_dir) if name.endswith('.gml')])
+
+    @override_settings(WFS_PAGE_SIZE=10, WFS_PAGE_WORKERS=2, WFS_PAGE_RETRIES=0)
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    @patch('eventkit_cloud.utils.wfs.check_content_exists')
+    def test_convert_pages_count_default(self, check_content_exists, update_progress):
+        stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, stage_dir)
+        gpkg = os.path.join(stage_dir, 'wfs.gpkg')
+        check_content_exists.return_value = True
+        appended = []
+
+        def append_page(cmd, **kwargs):
+            with open(cmd.split()[-1]) as page:
+                appended.extend(re.findall(r'<test:id>(\d+)</test:id>', page.read()))
+            return Mock(exitcode=0)
+        self.run_gdal.side_effect = append_page
+
+        # The pages are no larger than the CountDefault of the service, and sorted when the service can sort them.
+        with StandInWFSServer(features=25, count_default=4, implements_sorting=True) as server:
+            w2g = WFSToGPKG(gpkg=gpkg, service_url=server.url, layer='test:point', name='wfs',
+                            task_uid=self.task_uid)
+            w2g.convert()
+        self.assertEquals([(start, 4) for start in range(0, 24, 4)] + [(24, 1)], sorted(server.pages))
+        self.assertEquals(['id ASC'] * 7, server.sort_by)
+        self.assertEquals([str(feature_id) for feature_id in range(25)], sorted(appended, key=int))
+
+        # The rest of the pages a service returns short of their features is fetched.
+        del appended[:]
+        with StandInWFSServer(features=25, count_default=4, hide_count_default=True) as server:
+            w2g = WFSToGPKG(gpkg=gpkg, service_url=server.url, layer='test:point', name='wfs',
+                            task_uid=self.task_uid)
+            w2g.convert()
+        self.assertEquals([(0, 10), (4, 6), (8, 2), (10, 10), (14, 6), (18, 2), (20, 5), (24, 1)],
+                          sorted(server.pages))
+        self.assertEquals([None] * 8, server.sort_by)
+        self.assertEquals([str(feature_id) for feature_id in range(25)], sorted(appended, key=int))
+        self.assertAlmostEquals(100.0, update_progress.call_args[1]['progress'])
+
+        # A page which returns none of its features fails the export.
+        with StandInWFSServer(features=20) as server:
+            w2g = WFSToGPKG(gpkg=gpkg, service_url=server.url, layer='test:point', name='wfs',
+                            task_uid=self.task_uid)
+            with self.assertRaises(Exception):
+                w2g.convert_pages(server.url, 25, 10)
+        self.assertEquals([], [name for name in os.listdir(stage_dir) if name.endswith('.gml')])
+
+    @override_settings(WFS_PAGE_SIZE=10, WFS_PAGE_WORKERS=1, WFS_PAGE_RETRIES=0)
+    @patch('eventkit_cloud.tasks.models.ExportTaskRecord')
+    @patch('eventkit_cloud.tasks.export_tasks.update_progress')
+    def test_convert_pages_canceled(self, update_progress, export_task_record):
+        stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, stage_dir)
+        gpkg = os.path.join(stage_dir, 'wfs.gpkg')
+        export_task = export_task_record.objects.filter.return_value.first.return_value
+        export_task.status = TaskStates.RUNNING.value
+        # Tasks canceled by the system have no cancel user.
+        export_task.cancel_user = None
+
+        def cancel(cmd, task_uid=None, **kwargs):
+            # The export is canceled while the first page is appended.
+            export_task.status = TaskStates.CANCELED.value
+            return Mock(exitcode=0)
+        self.run_gdal.side_effect = cancel
+
+        with StandInWFSServer(features=100, delay=0.2) as server:
+            w2g = WFSToGPKG(gpkg=gpkg, service_url=server.url, layer='test:point', name='wfs',
+                            task_uid=self.task_uid, max_concurrency=2)
+            with self.assertRaises(CancelException):
+                w2g.convert()
+
+        export_task_record.objects.filter.assert_called_with(uid=self.task_uid)
+        self.assertEquals(1, self.run_gdal.call_count)
+        # The pages which weren't requested yet are dropped.
+        self.assertLess(len(server.pages), 10)
+        self.assertEquals([], [name for name in os.listdir(stage_dir) if name.endswith('.gml')])
+
+    @override_settings(WFS_PAGE_SIZE=10)
+    @patch('eventkit_cloud.utils.wfs.check_content_exists')
+    def test_convert_without_paging(self, check_content_exists):
+        stage_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, stage_dir)
+        gpkg = os.path.join(stage_dir, 'wfs.gpkg')
+        check_content_exists.return_value = True
+        self.run_gdal.return_value = Mock(exitcode=0)
 
+        # Services without WFS 2.0 and layers which fit in a page are fetched in one request.
+        for supports_paging, features in [(False, 25), (True, 5)]:
+            self.run_gdal.reset_mock()
+            with StandInWFSServer(features=features, supports_paging=supports_paging) as server:
+                w2g = WFSToGPKG(gpkg=gpkg, service_url=server.url, layer='test:point', name='wfs',
+                                task_uid=self.task_uid)
+                w2g.convert()
+            self.assertEquals([], server.pages)
+            self.run_gdal.assert_called_once_with(
+                "ogr2ogr -skipfailures -f GPKG {0} WFS:'{1}?SERVICE=WFS&VERSION=1.0.0&REQUEST=GetFeature"
+                "&TYPENAME=test:point&SRSNAME=EPSG:4326'".format(gpkg, server.url), task_uid=self.task_uid,
+                executable='/bin/sh')
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import itertools
+
+from django.test import TestCase
+from pysqlite2 import dbapi2 as sqlite3
+
+from ..zindex import NOT_EMPTY, NOT_NULL, zindex_sql
+
+# The passes which zindex_sql replaces, as run by the thematic geopackage.
+LEGACY_SQL = """
+UPDATE {table} SET z_index = 3 WHERE highway IN ('path', 'track', 'footway', 'minor', 'road', 'service', 'unclassified', 'residential');
+UPDATE {table} SET z_index = 4 WHERE highway IN ('tertiary_link', 'tertiary');
+UPDATE {table} SET z_index = 6 WHERE highway IN ('secondary_link', 'secondary');
+UPDATE {table} SET z_index = 7 WHERE highway IN ('primary_link', 'primary');
+UPDATE {table} SET z_index = 8 WHERE highway IN  ('trunk_link', 'trunk');
+UPDATE {table} SET z_index = 9 WHERE highway IN  ('motorway_link', 'motorway');
+UPDATE {table} SET z_index = z_index + 5 WHERE {railway};
+UPDATE {table} SET z_index = z_index + 10 * cast(layer AS SMALLINT) WHERE {layer};
+UPDATE {table} SET z_index = z_index + 10 WHERE bridge IN ('yes', 'true', 1);
+UPDATE {table} SET z_index = z_index - 10 WHERE tunnel IN ('yes', 'true', 1);
+"""
+
+
+class TestZIndex(TestCase):
+
+    def zindexes(self, sql, values):
+        conn = sqlite3.connect(':memory:')
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE lines (fid INTEGER PRIMARY KEY, highway TEXT, railway TEXT, layer TEXT, "
+                    "bridge TEXT, tunnel TEXT, z_index SMALLINT DEFAULT 0)")
+        cur.executemany("INSERT INTO lines (highway, railway, layer, bridge, tunnel) VALUES (?,?,?,?,?)", values)
+        cur.executescript(sql)
+        zindexes = cur.execute("SELECT fid, z_index FROM lines ORDER BY fid").fetchall()
+        conn.close()
+        return zindexes
+
+    def test_zindex_sql(self):
+        values = list(itertools.product(
+            [None, '', 'residential', 'tertiary', 'secondary_link', 'primary', 'trunk', 'motorway', 'platform'],
+            [None, '', 'rail'],
+            [None, '', '-1', '2', 'x'],
+            [None, '', 'yes', 'no', '1'],
+            [None, '', 'true', 'no']
+        ))
+        for present in [NOT_NULL, NOT_EMPTY]:
+            legacy = LEGACY_SQL.format(table='lines', railway=present.format('railway'), layer=present.format('layer'))
+            sql = zindex_sql('lines', ['highway', 'railway', 'layer', 'bridge', 'tunnel'], present=present)
+            self.assertEqual(sql.count(';'), 1)
+            self.assertEqual(self.zindexes(sql, values), self.zindexes(legacy, values))
+
+    def test_zindex_sql_missing_keys(self):
+        self.assertIsNone(zindex_sql('points', ['name', 'amenity']))
+        sql = zindex_sql('lines', ['name', 'railway'])
+        self.assertEqual(sql, "UPDATE lines SET z_index = z_index + (CASE WHEN railway IS NOT NULL THEN 5 ELSE 0 END) "
+                              "WHERE railway IS NOT NULL;")
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+import glob
+import logging
+import math
+import os
+import time
+from contextlib import closing
+
+from django.conf import settings
+from pysqlite2 import dbapi2 as sqlite3
+
+logger = logging.getLogger(__name__)
+
+# The table MapProxy stores the tiles of the shared cache in.
+TILE_TABLE = 'tiles'
+
+# Added to the shared GeoPackage once MapProxy has created it.  The trigger records when each tile was fetched from
+# the provider, which the TTL and the eviction of the oldest tiles are based on.
+META_SQL = '''
+CREATE TABLE IF NOT EXISTS tile_cache_meta (
+    zoom_level INTEGER NOT NULL,
+    tile_column INTEGER NOT NULL,
+    tile_row INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (zoom_level, tile_column, tile_row)
+);
+CREATE INDEX IF NOT EXISTS tile_cache_meta_created ON tile_cache_meta (created);
+CREATE TABLE IF NOT EXISTS tile_cache_stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO tile_cache_stats VALUES ('hits', 0);
+INSERT OR IGNORE INTO tile_cache_stats VALUES ('misses', 0);
+INSERT OR IGNORE INTO tile_cache_stats VALUES ('expirations', 0);
+INSERT OR IGNORE INTO tile_cache_stats VALUES ('evictions', 0);
+INSERT OR IGNORE INTO tile_cache_meta SELECT zoom_level, tile_column, tile_row, length(tile_data), {now} FROM {table};
+CREATE TRIGGER IF NOT EXISTS tile_cache_insert AFTER INSERT ON {table} BEGIN
+    INSERT OR REPLACE INTO tile_cache_meta VALUES (NEW.zoom_level, NEW.tile_column, NEW.tile_row,
+        length(NEW.tile_data), CAST(strftime('%s', 'now') AS REAL));
+END;
+'''
+
+DELETE_OLDER_SQL = '''
+DELETE FROM {table} WHERE EXISTS (SELECT 1 FROM tile_cache_meta m WHERE m.zoom_level = {table}.zoom_level
+    AND m.tile_column = {table}.tile_column AND m.tile_row = {table}.tile_row AND m.created <= ?);
+'''
+
+
+class TileCache(object):
+    """
+    A GeoPackage of tiles shared by the raster exports of a provider.
+
+    MapProxy seeds each run from the shared cache, which only requests the tiles it doesn't have from the provider.
+    Tiles fetched more than ttl seconds ago are expired before seeding so that they are fetched again, and the oldest
+    tiles are evicted whenever the cache is larger than max_size bytes.  Hits are the tiles of a run which were already
+    in the cache, they are approximate when runs of the same provider overlap.
+    """
+
+    def __init__(self, cache_dir, provider, max_size=None, ttl=None):
+        """
+        Initialize the cache.
+
+        Args:
+            cache_dir: the directory to store the cache of each provider in
+            provider: the slug of the provider
+            max_size: the byte budget for the tiles of the provider
+            ttl: the freshness window, in seconds
+        """
+        self.cache_dir = cache_dir
+        self.provider = provider
+        self.max_size = int(max_size if max_size is not None else settings.TILE_CACHE_MAX_SIZE)
+        self.ttl = int(ttl if ttl is not None else settings.TILE_CACHE_TTL)
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Another worker may have created it.
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        self.filename = os.path.join(self.cache_dir, '{0}.gpkg'.format(provider))
+
+    @classmethod
+    def from_settings(cls, provider):
+        """
+        Return:
+            the cache of the provider, or None if TILE_CACHE_DIR isn't set.
+        """
+        cache_dir = getattr(settings, 'TILE_CACHE_DIR', None)
+        if not cache_dir or not provider:
+            return None
+        try:
+            return cls(cache_dir, provider)
+        except OSError as e:
+            logger.error('The tile cache at {0} could not be opened: {1}'.format(cache_dir, e))
+            return None
+
+    @classmethod
+    def all_from_settings(cls):
+        """
+        Return:
+            the cache of each provider in TILE_CACHE_DIR.
+        """
+        cache_dir = getattr(settings, 'TILE_CACHE_DIR', None)
+        if not cache_dir:
+            return []
+        return [cls(cache_dir, os.path.splitext(os.path.basename(filename))[0])
+                for filename in sorted(glob.glob(os.path.join(cache_dir, '*.gpkg')))]
+
+    def connect(self):
+        # A generous timeout, since MapProxy may be writing tiles from several workers at once.  Using the connection as
+        # a context manager only commits or rolls back, so callers close it with contextlib.closing and commit
+        # themselves.
+        return sqlite3.connect(self.filename, timeout=30)
+
+    def install(self, conn):
+        """
+        Add the tables and trigger tracking the tiles, once MapProxy has created the GeoPackage.
+
+        Return:
+            True if the cache is ready to be tracked.
+        """
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                            (TILE_TABLE,)).fetchone():
+            return False
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'tile_cache_insert';"
+                            ).fetchone():
+            # Tiles stored before the trigger existed are timed from now.
+            conn.executescript(META_SQL.format(table=TILE_TABLE, now=time.time()))
+        return True
+
+    def prepare(self):
+        """
+        Expire and evict tiles before seeding.
+
+        Return:
+            the time seeding starts, to pass to record.
+        """
+        if os.path.isfile(self.filename):
+            try:
+                with closing(self.connect()) as conn:
+                    if self.install(conn):
+                        self.evict(conn)
+                        conn.commit()
+            except sqlite3.Error as e:
+                # The run can still be seeded, the tiles will be expired next time.
+                logger.error('Could not evict tiles from the {0} tile cache: {1}'.format(self.provider, e))
+        return time.time()
+
+    def record(self, gpkg, start):
+        """
+        Count the tiles of a run seeded from the cache, and evict tiles if the cache grew too large.
+
+        Args:
+            gpkg: the GeoPackage of the run
+            start: the time seeding started, from prepare
+        Return:
+            the number of hits and misses.
+        """
+        from .geopackage import get_tile_table_names
+
+        run_tiles = 0
+        with closing(sqlite3.connect(gpkg)) as conn:
+            for table_name in get_tile_table_names(gpkg):
+                run_tiles += conn.execute('SELECT COUNT(*) FROM [{0}];'.format(table_name)).fetchone()[0]
+        if not os.path.isfile(self.filename):
+            return 0, 0
+        try:
+            with closing(self.connect()) as conn:
+                if not self.install(conn):
+                    return 0, 0
+                # Timestamps are stored in whole seconds.
+                misses = conn.execute('SELECT COUNT(*) FROM tile_cache_meta WHERE created >= ?;',
+                                      (math.floor(start),)).fetchone()[0]
+                misses = min(misses, run_tiles)
+                hits = run_tiles - misses
+                self.increment(conn, 'hits', hits)
+                self.increment(conn, 'misses', misses)
+                self.evict(conn)
+                conn.commit()
+        except sqlite3.Error as e:
+            # The run is complete, only the metrics are lost.
+            logger.error('Could not update the {0} tile cache: {1}'.format(self.provider, e))
+            return 0, 0
+        logger.info('Seeded {0} tiles from the {1} tile cache, {2} hits and {3} misses.'.format(
+            run_tiles, self.provider, hits, misses))
+        return hits, misses
+
+    def evict(self, conn):
+        """
+        Remove the tiles older than the ttl, then the oldest tiles until the cache fits in max_size.
+        """
+        expired = self.delete_older(conn, time.time() - self.ttl)
+        self.increment(conn, 'expirations', expired)
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM tile_cache_meta;').fetchone()[0]
+        if total <= self.max_size:
+            return
+        cutoff = None
+        for created, size in conn.execute('SELECT created, size FROM tile_cache_meta ORDER BY created ASC;'):
+            if total <= self.max_size:
+                break
+            cutoff = created
+            total -= size
+        self.increment(conn, 'evictions', self.delete_older(conn, cutoff))
+
+    @staticmethod
+    def delete_older(conn, cutoff):
+        """
+        Delete the tiles fetched at or before cutoff.
+
+        Return:
+            the number of tiles deleted.
+        """
+        conn.execute(DELETE_OLDER_SQL.format(table=TILE_TABLE), (cutoff,))
+        return conn.execute('DELETE FROM tile_cache_meta WHERE created <= ?;', (cutoff,)).rowcount
+
+    @staticmethod
+    def increment(conn, name, value=1):
+        conn.execute('UPDATE tile_cache_stats SET value = value + ? WHERE name = ?;', (value, name))
+
+    def stats(self):
+        """
+        Return:
+            a dict with the hit, miss, expiration and eviction counters and the current size of the cache.
+        """
+        stats = {'hits': 0, 'misses': 0, 'expirations': 0, 'evictions': 0, 'tiles': 0, 'size': 0}
+        if os.path.isfile(self.filename):
+            with closing(self.connect()) as conn:
+                if self.install(conn):
+                    conn.commit()
+                    stats.update(dict(conn.execute('SELECT name, value FROM tile_cache_stats;').fetchall()))
+                    stats['tiles'], stats['size'] = conn.execute(
+                        'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tile_cache_meta;').fetchone()
+        stats['max_size'] = self.max_size
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
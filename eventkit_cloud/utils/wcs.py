@@ -6,6 +6,7 @@ from string import Template
 import subprocess
 from ..tasks.task_process import TaskProcess
 import tempfile
+from .gdalutils import get_raster_options
 
 logger = logging.getLogger(__name__)
 
@@ -49,11 +50,11 @@ class WCSConverter(object):
         self.wcs_xml_path = None # determined after mkstemp call
         if self.bbox:
             self.cmd = Template(
-                "gdal_translate -projwin $minX $maxY $maxX $minY -of $fmt $type $wcs $out"
+                "gdal_translate $profile -projwin $minX $maxY $maxX $minY -of $fmt $type $wcs $out"
             )
         else:
             self.cmd = Template(
-                "gdal_translate -of $fmt $type $wcs $out"
+                "gdal_translate $profile -of $fmt $type $wcs $out"
             )
 
         self.format = fmt or "gtiff"
@@ -89,10 +90,12 @@ class WCSConverter(object):
         if self.bbox:
             convert_cmd = self.cmd.safe_substitute(
                 {'out': self.out, 'wcs': self.wcs_xml_path, 'minX': self.bbox[0], 'minY': self.bbox[1],
-                 'maxX': self.bbox[2], 'maxY': self.bbox[3], 'fmt': self.format, 'type': self.band_type})
+                 'maxX': self.bbox[2], 'maxY': self.bbox[3], 'fmt': self.format, 'type': self.band_type,
+                 'profile': get_raster_options(warp=False)})
         else:
             convert_cmd = self.cmd.safe_substitute({'out': self.out, 'wcs': self.wcs_xml_path, 'fmt': self.format,
-                                                    'type': self.band_type})
+                                                    'type': self.band_type,
+                                                    'profile': get_raster_options(warp=False)})
 
         logger.debug('WCS command: %s' % convert_cmd)
 
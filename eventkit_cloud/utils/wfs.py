@@ -2,12 +2,22 @@ from __future__ import absolute_import
 
 import logging
 import os
-import subprocess
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from string import Template
-from ..tasks.task_process import TaskProcess
+from xml.etree import cElementTree as ElementTree
+
+from django.conf import settings
+from requests import exceptions
+
+from . import auth_requests
+from .gdalutils import run_gdal
 from ..utils.geopackage import check_content_exists
 logger = logging.getLogger(__name__)
 
+OWS_NAMESPACE = '{http://www.opengis.net/ows/1.1}'
+XSD_NAMESPACE = '{http://www.w3.org/2001/XMLSchema}'
+
 
 class WFSToGPKG(object):
     """
@@ -15,13 +25,14 @@ class WFSToGPKG(object):
     """
 
     def __init__(self, config=None, gpkg=None, bbox=None, service_url=None, layer=None, debug=None, name=None,
-                 service_type=None, task_uid=None):
+                 service_type=None, task_uid=None, max_concurrency=None):
         """
         Initialize the WFSToGPKG utility.
 
         Args:
             gpkg: where to write the gpkg output
             debug: turn debugging on / off
+            max_concurrency: the most pages to request from the service at once, defaults to WFS_PAGE_WORKERS
         """
         self.gpkg = gpkg
         self.bbox = bbox
@@ -31,6 +42,8 @@ class WFSToGPKG(object):
         self.layer = layer
         self.config = config
         self.task_uid = task_uid
+        self.max_concurrency = max_concurrency
+        self.verify_ssl = not getattr(settings, "DISABLE_SSL_VERIFICATION", False)
         if self.bbox:
             self.cmd = Template(
                 "ogr2ogr -skipfailures -spat $minX $minY $maxX $maxY -f GPKG $gpkg WFS:'$url'")
@@ -50,9 +63,25 @@ class WFSToGPKG(object):
         except ValueError:
             # if no url params we can just check for trailing slash and move on
             self.service_url = self.service_url.rstrip('/\\')
-        finally:
-            self.service_url = '{}?SERVICE=WFS&VERSION=1.0.0&REQUEST=GetFeature&TYPENAME={}&SRSNAME=EPSG:4326'\
-                .format(self.service_url, self.layer)
+
+        # Layers with more features than fit in a page are fetched in pages, if the service supports WFS 2.0.
+        page_size = int(settings.WFS_PAGE_SIZE)
+        if page_size:
+            hits = self.get_hit_count(self.service_url)
+            if hits is not None:
+                constraints = self.get_constraints(self.service_url)
+                # Services return at most CountDefault features, whatever COUNT asks for.
+                count_default = constraints.get('CountDefault')
+                if count_default and count_default.isdigit() and int(count_default):
+                    page_size = min(page_size, int(count_default))
+                if hits > page_size:
+                    sort_by = None
+                    if constraints.get('ImplementsSorting', '').lower() == 'true':
+                        sort_by = self.get_sort_by(self.service_url)
+                    return self.convert_pages(self.service_url, hits, page_size, sort_by=sort_by)
+
+        self.service_url = '{}?SERVICE=WFS&VERSION=1.0.0&REQUEST=GetFeature&TYPENAME={}&SRSNAME=EPSG:4326'\
+            .format(self.service_url, self.layer)
 
         if self.bbox:
             convert_cmd = self.cmd.safe_substitute(
@@ -64,9 +93,7 @@ class WFSToGPKG(object):
         logger.info('Running: %s' % convert_cmd)
         if self.debug:
             logger.debug('Running: %s' % convert_cmd)
-        task_process = TaskProcess(task_uid=self.task_uid)
-        task_process.start_process(convert_cmd, shell=True, executable='/bin/sh',
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        task_process = run_gdal(convert_cmd, task_uid=self.task_uid, executable='/bin/sh')
         if task_process.exitcode != 0:
             logger.error('%s', task_process.stderr)
             raise Exception, "ogr2ogr process failed with returncode {0}".format(task_process.exitcode)
@@ -79,3 +106,186 @@ class WFSToGPKG(object):
             logger.debug('ogr2ogr returned: %s' % task_process.exitcode)
 
         return self.gpkg
+
+    def get_params(self, **params):
+        """
+        :return: The parameters of a WFS 2.0 GetFeature request for the layer in the bounding box.
+        """
+        params.update({'SERVICE': 'WFS', 'VERSION': '2.0.0', 'REQUEST': 'GetFeature', 'TYPENAMES': self.layer,
+                       'SRSNAME': 'urn:ogc:def:crs:EPSG::4326'})
+        if self.bbox:
+            # The axes of EPSG:4326 are latitude, longitude in WFS 2.0.
+            params['BBOX'] = '{1},{0},{3},{2},urn:ogc:def:crs:EPSG::4326'.format(*self.bbox)
+        return params
+
+    def get_hit_count(self, url):
+        """
+        :param url: The url of the service.
+        :return: The number of features the service has for the layer in the bounding box, or None if it can't tell.
+        """
+        try:
+            response = auth_requests.get(url, slug=self.name, params=self.get_params(RESULTTYPE='hits'),
+                                         verify=self.verify_ssl)
+            response.raise_for_status()
+            return int(ElementTree.fromstring(response.content).get('numberMatched'))
+        except (exceptions.RequestException, SyntaxError, TypeError, ValueError) as e:
+            logger.info('WFS 2.0 hit count of {0} failed, requesting it in one page: {1}'.format(self.layer, e))
+            return None
+
+    def get_constraints(self, url):
+        """
+        :param url: The url of the service.
+        :return: The default values of the constraints in the WFS 2.0 capabilities of the service, such as CountDefault
+            and ImplementsSorting, by name.
+        """
+        params = {'SERVICE': 'WFS', 'VERSION': '2.0.0', 'REQUEST': 'GetCapabilities'}
+        try:
+            response = auth_requests.get(url, slug=self.name, params=params, verify=self.verify_ssl)
+            response.raise_for_status()
+            capabilities = ElementTree.fromstring(response.content)
+        except (exceptions.RequestException, SyntaxError) as e:
+            logger.info('WFS 2.0 capabilities of {0} could not be read: {1}'.format(self.name, e))
+            return {}
+        constraints = {}
+        for constraint in capabilities.iter('{0}Constraint'.format(OWS_NAMESPACE)):
+            value = constraint.findtext('{0}DefaultValue'.format(OWS_NAMESPACE))
+            if value is not None:
+                constraints.setdefault(constraint.get('name'), value.strip())
+        return constraints
+
+    def get_sort_by(self, url):
+        """
+        :param url: The url of the service.
+        :return: A SORTBY on the first property of the layer which isn't a geometry, so the pages are cut from the same
+            order of features, or None if the layer has none.
+        """
+        params = {'SERVICE': 'WFS', 'VERSION': '2.0.0', 'REQUEST': 'DescribeFeatureType', 'TYPENAMES': self.layer}
+        try:
+            response = auth_requests.get(url, slug=self.name, params=params, verify=self.verify_ssl)
+            response.raise_for_status()
+            schema = ElementTree.fromstring(response.content)
+        except (exceptions.RequestException, SyntaxError) as e:
+            logger.info('WFS 2.0 feature type of {0} could not be read: {1}'.format(self.layer, e))
+            return None
+        for sequence in schema.iter('{0}sequence'.format(XSD_NAMESPACE)):
+            for element in sequence.findall('{0}element'.format(XSD_NAMESPACE)):
+                # Geometries are of GML property types, such as gml:PointPropertyType.
+                if element.get('name') and not element.get('type', '').endswith('PropertyType'):
+                    return '{0} ASC'.format(element.get('name'))
+        return None
+
+    def check_canceled(self):
+        """
+        Raise a CancelException if the task has been canceled.
+        """
+        if not self.task_uid:
+            return
+        from ..tasks.export_tasks import TaskStates
+        from ..tasks.models import ExportTaskRecord
+        export_task = ExportTaskRecord.objects.filter(uid=self.task_uid).first()
+        if export_task and export_task.status == TaskStates.CANCELED.value:
+            from ..tasks.exceptions import CancelException
+            raise CancelException(task_name=export_task.export_provider_task.name,
+                                  user_name=export_task.cancel_user.username if export_task.cancel_user else None)
+
+    def fetch_page(self, url, start, count, out_file, stopped=None, sort_by=None):
+        """
+        Stream up to count features from start to out_file, retrying it WFS_PAGE_RETRIES times.
+        Stops without the page once the stopped event is set.
+        :return: The number of features the service returned, which may be fewer than asked for, or None if stopped.
+        """
+        params = self.get_params(STARTINDEX=start, COUNT=count)
+        if sort_by:
+            params['SORTBY'] = sort_by
+        retries = int(settings.WFS_PAGE_RETRIES)
+        for attempt in range(retries + 1):
+            try:
+                response = auth_requests.get(url, slug=self.name, params=params, stream=True, verify=self.verify_ssl)
+                response.raise_for_status()
+                with open(out_file, 'wb') as page:
+                    for chunk in response.iter_content(1024 * 1024):
+                        if stopped and stopped.is_set():
+                            response.close()
+                            return None
+                        page.write(chunk)
+                return get_number_returned(out_file, count)
+            except exceptions.RequestException as e:
+                logger.warn('WFS page at {0} of {1} failed on attempt {2}: {3}'.format(
+                    start, self.layer, attempt + 1, e))
+        raise Exception('WFS page at {0} of {1} could not be retrieved.'.format(start, self.layer))
+
+    def convert_pages(self, url, hits, page_size, sort_by=None):
+        """
+        Fetch the features in pages, max_concurrency at a time, and append each page to the gpkg as it arrives.
+        The rest of a page the service returns short is fetched as another page.
+        The task is checked for cancellation as each page arrives, a canceled task stops the remaining downloads.
+        """
+        from ..tasks.export_tasks import update_progress
+
+        name, ext = os.path.splitext(self.gpkg)
+        logger.info('Fetching {0} features of {1} in pages of {2}.'.format(hits, self.layer, page_size))
+        page_files = []
+        executor = ThreadPoolExecutor(max_workers=int(self.max_concurrency or settings.WFS_PAGE_WORKERS))
+        stopped = threading.Event()
+        pages = {}
+        appended = 0
+        progress_offset = 0.0
+
+        def fetch(start, count):
+            page_file = '{0}_page_{1}.gml'.format(name, len(page_files))
+            page_files.append(page_file)
+            future = executor.submit(self.fetch_page, url, start, count, page_file, stopped, sort_by)
+            pages[future] = (start, count, page_file)
+
+        try:
+            for start in range(0, hits, page_size):
+                fetch(start, min(page_size, hits - start))
+            while pages:
+                for future in wait(pages, return_when=FIRST_COMPLETED).done:
+                    start, count, page_file = pages.pop(future)
+                    self.check_canceled()
+                    returned = future.result()
+                    if not returned:
+                        raise Exception('WFS page at {0} of {1} returned none of the {2} features expected.'.format(
+                            start, self.layer, count))
+                    if returned < count:
+                        fetch(start + returned, count - returned)
+                    # The GeoPackage is written by one process at a time, so pages are appended here as they arrive.
+                    convert_cmd = 'ogr2ogr -skipfailures {0}-nln {1} -f GPKG {2} {3}'.format(
+                        '-append ' if appended else '', self.layer, self.gpkg, page_file)
+                    logger.info('Running: %s' % convert_cmd)
+                    # ogr2ogr reports its progress within the page's share of the task, so the progress doesn't go back.
+                    progress_scale = float(returned) / hits
+                    task_process = run_gdal(convert_cmd, task_uid=self.task_uid, progress_offset=progress_offset,
+                                            progress_scale=progress_scale)
+                    if task_process.exitcode != 0:
+                        logger.error('%s', task_process.stderr)
+                        raise Exception("ogr2ogr process failed with returncode {0}".format(task_process.exitcode))
+                    appended += returned
+                    progress_offset += progress_scale
+                    update_progress(self.task_uid, progress=progress_offset * 100)
+        finally:
+            stopped.set()
+            for future in pages:
+                future.cancel()
+            executor.shutdown()
+            for page_file in page_files:
+                if os.path.isfile(page_file):
+                    os.remove(page_file)
+
+        if not check_content_exists(self.gpkg):
+            raise Exception("Empty response: Unknown layer name '{}' or invalid AOI bounds".format(self.layer))
+        return self.gpkg
+
+
+def get_number_returned(page_file, count):
+    """
+    :param page_file: A WFS 2.0 FeatureCollection.
+    :param count: The number of features asked for, returned when the collection doesn't tell.
+    :return: The numberReturned of the collection.
+    """
+    with open(page_file, 'rb') as page:
+        for event, collection in ElementTree.iterparse(page, events=('start',)):
+            number_returned = collection.get('numberReturned', '')
+            return int(number_returned) if number_returned.isdigit() else count
+    return count
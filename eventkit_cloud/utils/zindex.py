@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Computes the z_index of OSM features, the drawing order used by the map styles, from their highway, railway, layer,
+bridge and tunnel tags.
+"""
+
+HIGHWAY_ZINDEXES = (
+    (3, ('path', 'track', 'footway', 'minor', 'road', 'service', 'unclassified', 'residential')),
+    (4, ('tertiary_link', 'tertiary')),
+    (6, ('secondary_link', 'secondary')),
+    (7, ('primary_link', 'primary')),
+    (8, ('trunk_link', 'trunk')),
+    (9, ('motorway_link', 'motorway')),
+)
+
+ZINDEX_KEYS = ['highway', 'railway', 'layer', 'bridge', 'tunnel']
+
+# The values of bridge and tunnel which raise or lower a feature.
+TRUE_VALUES = "('yes', 'true', 1)"
+
+# How a tag is tested for a value. The thematic geopackage leaves missing tags NULL,
+# ogr2ogr with the hotosm.ini config writes some of them as empty strings.
+NOT_NULL = '{0} IS NOT NULL'
+NOT_EMPTY = "{0} <> ''"
+
+
+def zindex_sql(table, columns, present=NOT_NULL):
+    """
+    Build a single UPDATE which sets the z_index of every feature in table in one pass, instead of a pass per highway
+    class and per adjustment.  The highway class sets the z_index, railways are raised by 5, layer adds 10 per level,
+    bridges are raised by 10 and tunnels lowered by 10.  Only the features with one of the tags are written.
+
+    Args:
+        table: the table to update, it must have a z_index column.
+        columns: the columns of the table, keys which aren't in the table are left out.
+        present: the test for a railway or layer tag, NOT_NULL or NOT_EMPTY.
+
+    Return:
+        the UPDATE statement or None if the table has none of the z_index keys.
+    """
+    keys = [key for key in ZINDEX_KEYS if key in columns]
+    if not keys:
+        return None
+    terms = []
+    conditions = []
+    if 'highway' in keys:
+        highways = ' '.join(["WHEN highway IN ('{0}') THEN {1}".format("', '".join(values), zindex)
+                             for zindex, values in HIGHWAY_ZINDEXES])
+        terms.append('(CASE {0} ELSE z_index END)'.format(highways))
+        conditions.append("highway IN ('{0}')".format(
+            "', '".join([value for zindex, values in HIGHWAY_ZINDEXES for value in values])))
+    else:
+        terms.append('z_index')
+    if 'railway' in keys:
+        terms.append('(CASE WHEN {0} THEN 5 ELSE 0 END)'.format(present.format('railway')))
+        conditions.append(present.format('railway'))
+    if 'layer' in keys:
+        terms.append('(CASE WHEN {0} THEN 10 * cast(layer AS INTEGER) ELSE 0 END)'.format(present.format('layer')))
+        conditions.append(present.format('layer'))
+    if 'bridge' in keys:
+        terms.append('(CASE WHEN bridge IN {0} THEN 10 ELSE 0 END)'.format(TRUE_VALUES))
+        conditions.append('bridge IN {0}'.format(TRUE_VALUES))
+    if 'tunnel' in keys:
+        terms.append('(CASE WHEN tunnel IN {0} THEN -10 ELSE 0 END)'.format(TRUE_VALUES))
+        conditions.append('tunnel IN {0}'.format(TRUE_VALUES))
+    return 'UPDATE {0} SET z_index = {1} WHERE {2};'.format(table, ' + '.join(terms), ' OR '.join(conditions))
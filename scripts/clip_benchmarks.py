@@ -0,0 +1,121 @@
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from django.contrib.gis.geos import Polygon
+from pysqlite2 import dbapi2 as sqlite3
+
+from eventkit_cloud.utils.hotosm_geopackage import CLIP_SQL, SPATIAL_SQL, OSMConfig
+from eventkit_cloud.utils.pbf import OSMToPBF
+
+
+"""
+    Compares the indexed clipping stage of the thematic geopackage (CLIP_SQL) with the
+    intersection of every feature it replaced.
+    A synthetic OSM file of points, roads and buildings is converted to a PBF and ingested with
+    ogr2ogr the same way as the OSM pipeline, then both clipping stages run on copies of it.
+    From the project directory run:
+    ./manage.py runscript clip_benchmarks -v2 --script-args 10000 100000 1000000
+    Depends on django-extensions, osmconvert, ogr2ogr and mod_spatialite.
+"""
+
+LEGACY_CLIP_SQL = '''
+UPDATE points SET geom = (SELECT ST_Intersection(boundary.geom,p.geom) FROM boundary,points p WHERE points.fid = p.fid);
+UPDATE lines SET geom = (SELECT ST_Intersection(boundary.geom,l.geom) FROM boundary,lines l WHERE lines.fid = l.fid);
+UPDATE multipolygons SET geom = (SELECT ST_Intersection(boundary.geom,m.geom) FROM boundary,multipolygons m WHERE multipolygons.fid = m.fid);
+
+DELETE FROM points where geom IS NULL;
+DELETE FROM lines where geom IS NULL;
+DELETE FROM multipolygons where geom IS NULL;
+'''
+
+# The data covers [0, 0, 1, 1], the boundary is an L shape covering about half of it.
+BOUNDARY = Polygon(((0.1, 0.1), (0.9, 0.1), (0.9, 0.4), (0.4, 0.4), (0.4, 0.9), (0.1, 0.9), (0.1, 0.1)), srid=4326)
+
+
+def write_osm(osm_file, count):
+    """
+    Write count features, a third each of points, roads and buildings, at random positions.
+    """
+    node_id = 0
+    ways = []
+    with open(osm_file, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="eventkit">\n')
+        for index in range(count):
+            x, y = random.uniform(0, 0.99), random.uniform(0, 0.99)
+            kind = index % 3
+            if kind == 0:
+                node_id += 1
+                f.write('<node id="{0}" lat="{1}" lon="{2}"><tag k="amenity" v="school"/></node>\n'.format(
+                    node_id, y, x))
+                continue
+            if kind == 1:
+                coords = [(x, y), (x + 0.01, y + 0.005), (x + 0.02, y)]
+            else:
+                coords = [(x, y), (x + 0.001, y), (x + 0.001, y + 0.001), (x, y + 0.001)]
+            refs = []
+            for lon, lat in coords:
+                node_id += 1
+                refs.append(node_id)
+                f.write('<node id="{0}" lat="{1}" lon="{2}"/>\n'.format(node_id, lat, lon))
+            if kind == 2:
+                refs.append(refs[0])
+            ways.append((kind, refs))
+        for way_id, (kind, refs) in enumerate(ways, 1):
+            tag = '<tag k="highway" v="residential"/>' if kind == 1 else '<tag k="building" v="yes"/>'
+            f.write('<way id="{0}">{1}{2}</way>\n'.format(
+                way_id, ''.join('<nd ref="{0}"/>'.format(ref) for ref in refs), tag))
+        f.write('</osm>\n')
+
+
+def ingest(stage_dir, count):
+    osm_file = os.path.join(stage_dir, 'fixture.osm')
+    write_osm(osm_file, count)
+    pbf_file = OSMToPBF(osm=osm_file, pbffile=os.path.join(stage_dir, 'fixture.pbf')).convert()
+    conf = OSMConfig(stage_dir, points=['amenity'], lines=['highway'], polygons=['building']).create_osm_conf()
+    gpkg = os.path.join(stage_dir, 'fixture.gpkg')
+    subprocess.check_call(['ogr2ogr', '-f', 'GPKG', gpkg, pbf_file, '--config', 'OSM_CONFIG_FILE', conf,
+                           '--config', 'OGR_INTERLEAVED_READING', 'YES', '-gt', '65536'])
+    return gpkg
+
+
+def time_clip(source_gpkg, clip_sql):
+    gpkg = '{0}.clip.gpkg'.format(source_gpkg)
+    shutil.copy(source_gpkg, gpkg)
+    conn = sqlite3.connect(gpkg)
+    conn.enable_load_extension(True)
+    cur = conn.cursor()
+    cur.execute("select load_extension('mod_spatialite')")
+    cur.execute("CREATE TABLE boundary (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, geom GEOMETRY)")
+    cur.execute("INSERT INTO boundary (geom) VALUES (GeomFromWKB(?,4326));", (BOUNDARY.wkb,))
+    # Drop the rtree triggers and convert the geometries, as SPATIAL_SQL does before clipping.
+    cur.executescript(SPATIAL_SQL[:SPATIAL_SQL.index(CLIP_SQL)])
+    start = time.time()
+    cur.executescript(clip_sql)
+    elapsed = time.time() - start
+    kept = sum(cur.execute('SELECT COUNT(*) FROM {0}'.format(table)).fetchone()[0]
+               for table in ['points', 'lines', 'multipolygons'])
+    conn.close()
+    os.remove(gpkg)
+    return elapsed, kept
+
+
+def run(*script_args):
+    counts = [int(count) for count in script_args] or [10000, 100000, 1000000]
+    random.seed(0)
+    for count in counts:
+        stage_dir = tempfile.mkdtemp()
+        try:
+            gpkg = ingest(stage_dir, count)
+            legacy, legacy_kept = time_clip(gpkg, LEGACY_CLIP_SQL)
+            indexed, indexed_kept = time_clip(gpkg, CLIP_SQL)
+            print "=============="
+            print "{0} features".format(count)
+            print "Intersect every feature: {0:.2f}s, {1} features kept".format(legacy, legacy_kept)
+            print "Indexed clipping:        {0:.2f}s, {1} features kept".format(indexed, indexed_kept)
+            print "Speed-up: {0:.1f}x".format(legacy / indexed if indexed else 0)
+        finally:
+            shutil.rmtree(stage_dir)
@@ -0,0 +1,83 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from pysqlite2 import dbapi2 as sqlite3
+
+from eventkit_cloud.utils.zindex import ZINDEX_KEYS, zindex_sql
+
+
+"""
+    Compares the single pass z_index update (zindex_sql) with the passes per highway class and per adjustment it
+    replaced, on a lines table of random OSM tags.
+    From the project directory run:
+    ./manage.py runscript zindex_benchmarks -v2 --script-args 100000 1000000
+    Depends on django-extensions.
+"""
+
+LEGACY_SQL = [
+    "UPDATE lines SET z_index = 3 WHERE highway IN ('path', 'track', 'footway', 'minor', 'road', 'service', 'unclassified', 'residential')",
+    "UPDATE lines SET z_index = 4 WHERE highway IN ('tertiary_link', 'tertiary')",
+    "UPDATE lines SET z_index = 6 WHERE highway IN ('secondary_link', 'secondary')",
+    "UPDATE lines SET z_index = 7 WHERE highway IN ('primary_link', 'primary')",
+    "UPDATE lines SET z_index = 8 WHERE highway IN  ('trunk_link', 'trunk')",
+    "UPDATE lines SET z_index = 9 WHERE highway IN  ('motorway_link', 'motorway')",
+    "UPDATE lines SET z_index = z_index + 5 WHERE railway IS NOT NULL",
+    "UPDATE lines SET z_index = z_index + 10 * cast(layer AS SMALLINT) WHERE layer IS NOT NULL",
+    "UPDATE lines SET z_index = z_index + 10 WHERE bridge IN ('yes', 'true', 1)",
+    "UPDATE lines SET z_index = z_index - 10 WHERE tunnel IN ('yes', 'true', 1)",
+]
+
+HIGHWAYS = [None, None, 'residential', 'service', 'tertiary', 'secondary', 'primary', 'trunk', 'motorway', 'platform']
+
+
+def create_lines(db_file, count):
+    conn = sqlite3.connect(db_file)
+    cur = conn.cursor()
+    # a blob stands in for the geometry, so the rows are about the size of real features
+    cur.execute("CREATE TABLE lines (fid INTEGER PRIMARY KEY, geom BLOB, highway TEXT, railway TEXT, layer TEXT, "
+                "bridge TEXT, tunnel TEXT, z_index SMALLINT DEFAULT 0)")
+    cur.executemany("INSERT INTO lines (geom, highway, railway, layer, bridge, tunnel) VALUES (?,?,?,?,?,?)", (
+        (buffer(os.urandom(200)), random.choice(HIGHWAYS), random.choice([None] * 9 + ['rail']),
+         random.choice([None] * 8 + ['1', '-1']), random.choice([None] * 19 + ['yes']),
+         random.choice([None] * 19 + ['yes'])) for index in range(count)))
+    conn.commit()
+    conn.close()
+
+
+def time_update(source_file, queries):
+    db_file = '{0}.update.sqlite'.format(source_file)
+    shutil.copy(source_file, db_file)
+    conn = sqlite3.connect(db_file)
+    cur = conn.cursor()
+    start = time.time()
+    for query in queries:
+        cur.execute(query)
+    conn.commit()
+    elapsed = time.time() - start
+    zindexes = cur.execute("SELECT z_index FROM lines ORDER BY fid").fetchall()
+    conn.close()
+    os.remove(db_file)
+    return elapsed, zindexes
+
+
+def run(*script_args):
+    counts = [int(count) for count in script_args] or [100000, 1000000]
+    random.seed(0)
+    for count in counts:
+        stage_dir = tempfile.mkdtemp()
+        try:
+            source_file = os.path.join(stage_dir, 'lines.sqlite')
+            create_lines(source_file, count)
+            legacy, legacy_zindexes = time_update(source_file, LEGACY_SQL)
+            single, single_zindexes = time_update(source_file, [zindex_sql('lines', ZINDEX_KEYS)])
+            print "=============="
+            print "{0} features".format(count)
+            print "Pass per update: {0} passes, {1:.2f}s".format(len(LEGACY_SQL), legacy)
+            print "Single pass:     1 pass, {0:.2f}s".format(single)
+            print "Speed-up: {0:.1f}x".format(legacy / single if single else 0)
+            print "Same z_indexes: {0}".format(legacy_zindexes == single_zindexes)
+        finally:
+            shutil.rmtree(stage_dir)